@@ -0,0 +1,430 @@
+# Copyright (c) 2018 StackHPC Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import logging
+import os
+import threading
+import time
+
+import monasca_agent.collector.checks as checks
+
+
+log = logging.getLogger(__name__)
+
+_METRIC_NAME_PREFIX = "ib_network"
+
+_IB_DEVICE_PATH = "/sys/class/infiniband/"
+
+# Directories of counters under each port. Extended counters are read from
+# counters_ext by older drivers, and replace the counters of the same name
+# without the _64 suffix.
+_COUNTERS_DIR = 'counters'
+_COUNTERS_EXT_DIR = 'counters_ext'
+_HW_COUNTERS_DIR = 'hw_counters'
+
+# The port data counters count 4 byte words, per the InfiniBand spec
+_DATA_COUNTERS = ('port_xmit_data', 'port_rcv_data')
+_DATA_WORD_BYTES = 4
+
+# Traffic counters which are only 32 bits wide when the HCA does not support
+# extended counters. Per the InfiniBand spec, these saturate at their maximum
+# rather than wrapping, as do the smaller error counters.
+_LEGACY_32_BIT_COUNTERS = ('port_xmit_data', 'port_rcv_data',
+                           'port_xmit_packets', 'port_rcv_packets',
+                           'port_xmit_wait')
+
+# Files in hw_counters which are settings rather than counters
+_HW_COUNTER_SETTINGS = ('lifespan',)
+
+
+# Counters sampled at a high rate by default, which show congestion and
+# link errors that only last a fraction of a second
+_DEFAULT_SAMPLE_COUNTERS = ('port_xmit_wait', 'symbol_error',
+                            'link_error_recovery', 'link_downed',
+                            'port_rcv_errors', 'port_xmit_discards')
+# The number of rates kept for each counter by the sampler
+_DEFAULT_SAMPLE_WINDOW = 1000
+
+# Bytes read from each counter file, which holds a decimal number
+_COUNTER_READ_SIZE = 64
+
+
+def _rate_base_name(name):
+    # The data counters are reported in bytes rather than words
+    if name in _DATA_COUNTERS:
+        return name.replace('_data', '_bytes')
+    return name
+
+
+def _list_dir(path):
+    try:
+        return sorted(os.listdir(path))
+    except (IOError, OSError):
+        return None
+
+
+class _CounterFiles(object):
+    """Keeps the counter files of every InfiniBand port open
+
+    The ports and their counter files are found once, and the files are
+    kept open and read from the start on each check, rather than opening
+    hundreds of files every time. They are found again when an HCA is
+    added or removed, or a counter can no longer be read.
+    """
+
+    def __init__(self, ib_device_path):
+        self.ib_device_path = ib_device_path
+        self.hcas = None
+        # The file descriptor and width of each counter, keyed by HCA and
+        # port, and then counter name
+        self.ports = {}
+        self.stale = True
+        # Held while the files are read, so that they are not closed under
+        # the sampler
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _find_counters(port_path):
+        """Find the counter files of a port
+
+        Returns a dict of counter name to (path, bits), where bits is the
+        width of the counter if it may saturate, or None.
+        """
+        counters = {}
+        for directory, prefix in ((_COUNTERS_DIR, ''),
+                                  (_COUNTERS_EXT_DIR, ''),
+                                  (_HW_COUNTERS_DIR, 'hw_')):
+            try:
+                entries = list(os.scandir(os.path.join(port_path, directory)))
+            except (IOError, OSError):
+                continue
+            for entry in entries:
+                name = entry.name
+                if directory == _COUNTERS_DIR:
+                    bits = 32 if name in _LEGACY_32_BIT_COUNTERS else None
+                else:
+                    bits = None
+                if directory == _COUNTERS_EXT_DIR and name.endswith('_64'):
+                    # Prefer the 64 bit extended counters
+                    name = name[:-len('_64')]
+                if directory == _HW_COUNTERS_DIR:
+                    if name in _HW_COUNTER_SETTINGS:
+                        continue
+                counters[prefix + name] = (entry.path, bits)
+        return counters
+
+    @staticmethod
+    def _read_fd(fd):
+        return int(os.pread(fd, _COUNTER_READ_SIZE, 0))
+
+    def _open_counters(self, port_path):
+        counters = {}
+        for name, (path, bits) in _CounterFiles._find_counters(
+                port_path).items():
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except (IOError, OSError) as err:
+                log.debug('Failed to open IB counter {}: {}'.format(
+                    path, err))
+                continue
+            try:
+                _CounterFiles._read_fd(fd)
+            except (IOError, OSError, ValueError) as err:
+                # Some counters can't be read on some HCAs
+                log.debug('Failed to read IB counter {}: {}'.format(
+                    path, err))
+                os.close(fd)
+                continue
+            counters[name] = (fd, bits)
+        return counters
+
+    def _discover(self, hcas):
+        self.close()
+        self.hcas = hcas
+        for hca in hcas or []:
+            ports_path = os.path.join(self.ib_device_path, hca, 'ports')
+            for port in _list_dir(ports_path) or []:
+                self.ports[(hca, port)] = self._open_counters(
+                    os.path.join(ports_path, port))
+        self.stale = False
+        log.info('Found {} InfiniBand ports in {}'.format(
+            len(self.ports), self.ib_device_path))
+
+    def refresh(self):
+        """Find the ports again if an HCA has been added or removed"""
+        hcas = _list_dir(self.ib_device_path)
+        if not self.stale and hcas == self.hcas:
+            return
+        if hcas is None:
+            log.warning('Failed to list IB devices in {}'.format(
+                self.ib_device_path))
+        with self._lock:
+            self._discover(hcas)
+
+    def read(self, names=None, hca=None, port=None):
+        """Read the counters of every port
+
+        Returns a dict of counter name to (value, bits), keyed by HCA and
+        port. If names is given, only those counters are read, and if hca or
+        port are given, only the matching ports are read.
+        """
+        port_counters = {}
+        with self._lock:
+            for (port_hca, port_number), counters in sorted(
+                    self.ports.items()):
+                if hca is not None and port_hca != hca:
+                    continue
+                if port is not None and port_number != str(port):
+                    continue
+                values = {}
+                for name, (fd, bits) in counters.items():
+                    if names is not None and name not in names:
+                        continue
+                    try:
+                        values[name] = (_CounterFiles._read_fd(fd), bits)
+                    except (IOError, OSError, ValueError) as err:
+                        # For example, the HCA has been removed
+                        log.warning('Failed to read IB counter {} of {} '
+                                    'port {}: {}'.format(name, port_hca,
+                                                         port_number, err))
+                        self.stale = True
+                port_counters[(port_hca, port_number)] = values
+        return port_counters
+
+    def close(self):
+        with self._lock:
+            for counters in self.ports.values():
+                for fd, _ in counters.values():
+                    try:
+                        os.close(fd)
+                    except OSError:
+                        pass
+            self.ports = {}
+            self.stale = True
+
+
+class _Sampler(object):
+    """Samples selected counters in a background thread
+
+    The rate of each counter between samples is kept in a fixed size ring
+    buffer, and summarised when the check runs, so that congestion and
+    errors lasting a fraction of a second are not averaged away over the
+    check interval.
+    """
+
+    def __init__(self, counter_files, interval, counters,
+                 window=_DEFAULT_SAMPLE_WINDOW, burst_rate=0):
+        self.counter_files = counter_files
+        self.interval = interval
+        self.counters = set(counters)
+        self.window = window
+        # A burst is a run of samples with a rate above this
+        self.burst_rate = burst_rate
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        # The previous sample of each counter as (timestamp, value), keyed
+        # by HCA, port and counter name
+        self._previous = {}
+        # Ring buffers of rates, keyed by HCA and port, then counter name
+        self._buffers = {}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='ib-network-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(self.interval * 2)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        timestamp = time.time()
+        port_counters = self.counter_files.read(self.counters)
+        with self._lock:
+            # Forget the counters of ports which have gone
+            for key in list(self._previous):
+                if key[:2] not in port_counters:
+                    del self._previous[key]
+            for (hca, port), counters in port_counters.items():
+                buffers = self._buffers.setdefault((hca, port), {})
+                for name, (value, bits) in counters.items():
+                    key = (hca, port, name)
+                    previous = self._previous.get(key)
+                    self._previous[key] = (timestamp, value)
+                    if previous is None:
+                        continue
+                    rate = IBNetwork._rate(name, previous,
+                                           (timestamp, value), bits)
+                    if rate is None:
+                        continue
+                    if name not in buffers:
+                        buffers[name] = collections.deque(maxlen=self.window)
+                    buffers[name].append(rate)
+
+    def pop_summary(self, hca, port):
+        """Summarise and discard the rates sampled since the last call"""
+        with self._lock:
+            buffers = self._buffers.pop((hca, port), {})
+        summary = {}
+        for name, rates in buffers.items():
+            if not rates:
+                continue
+            bursts = 0
+            in_burst = False
+            for rate in rates:
+                if rate > self.burst_rate and not in_burst:
+                    bursts += 1
+                in_burst = rate > self.burst_rate
+            rate_name = IBNetwork._rate_name(name)
+            summary['{}_peak'.format(rate_name)] = max(rates)
+            summary['{}_mean'.format(rate_name)] = sum(rates) / len(rates)
+            summary['{}_bursts'.format(_rate_base_name(name))] = bursts
+        return summary
+
+
+class IBNetwork(checks.AgentCheck):
+    """Reports the traffic and error rates of InfiniBand ports
+
+    The counters of each port are read from sysfs and converted to rates
+    using the previous sample of each counter, which is kept between checks.
+    """
+
+    def __init__(self, name, init_config, agent_config, instances=None):
+        super(IBNetwork, self).__init__(
+            name, init_config, agent_config, instances)
+        # The previous sample of each counter as (timestamp, value),
+        # keyed by HCA, port and counter name
+        self._previous = {}
+        # Open counter files, keyed by the IB device path
+        self._counter_files = {}
+        # Samplers, keyed by the IB device path
+        self._samplers = {}
+
+    def stop(self):
+        for sampler in self._samplers.values():
+            sampler.stop()
+        self._samplers = {}
+        for counter_files in self._counter_files.values():
+            counter_files.close()
+        self._counter_files = {}
+
+    def _get_counter_files(self, ib_device_path):
+        if ib_device_path not in self._counter_files:
+            self._counter_files[ib_device_path] = _CounterFiles(
+                ib_device_path)
+        counter_files = self._counter_files[ib_device_path]
+        counter_files.refresh()
+        return counter_files
+
+    @staticmethod
+    def _counter_delta(previous, value):
+        """Return the increase in a counter since its previous value
+
+        Returns None if the counter has been reset, for example by
+        `perfquery -R`, since the increase is unknown. The counters
+        saturate rather than wrap, so any decrease is a reset.
+        """
+        if value >= previous:
+            return value - previous
+        return None
+
+    @staticmethod
+    def _rate_name(name):
+        return '{}_per_second'.format(_rate_base_name(name))
+
+    @staticmethod
+    def _rate(name, previous, current, bits):
+        """Return the rate of a counter between two samples
+
+        Returns None if the rate is unknown, because the counter is
+        saturated or has been reset.
+        """
+        previous_timestamp, previous_value = previous
+        timestamp, value = current
+        elapsed = timestamp - previous_timestamp
+        if elapsed <= 0:
+            return None
+        if bits and value == 2 ** bits - 1:
+            log.debug('IB counter {} is saturated'.format(name))
+            return None
+        delta = IBNetwork._counter_delta(previous_value, value)
+        if delta is None:
+            log.debug('IB counter {} was reset'.format(name))
+            return None
+        if name in _DATA_COUNTERS:
+            delta *= _DATA_WORD_BYTES
+        return delta / float(elapsed)
+
+    def _get_rates(self, hca, port, counters, timestamp):
+        rates = {}
+        for name, (value, bits) in counters.items():
+            key = (hca, port, name)
+            previous = self._previous.get(key)
+            self._previous[key] = (timestamp, value)
+            if previous is None:
+                continue
+            rate = IBNetwork._rate(name, previous, (timestamp, value), bits)
+            if rate is not None:
+                rates[IBNetwork._rate_name(name)] = rate
+        return rates
+
+    def _get_sampler(self, instance, counter_files):
+        interval = instance.get('sample_interval')
+        if not interval:
+            return None
+        ib_device_path = counter_files.ib_device_path
+        if ib_device_path not in self._samplers:
+            sampler = _Sampler(
+                counter_files, interval,
+                instance.get('sample_counters', _DEFAULT_SAMPLE_COUNTERS),
+                window=instance.get('sample_window', _DEFAULT_SAMPLE_WINDOW),
+                burst_rate=instance.get('sample_burst_rate', 0))
+            sampler.start()
+            self._samplers[ib_device_path] = sampler
+        return self._samplers[ib_device_path]
+
+    def check(self, instance):
+        ib_device_path = instance.get('ib_device_path', _IB_DEVICE_PATH)
+        counter_files = self._get_counter_files(ib_device_path)
+        sampler = self._get_sampler(instance, counter_files)
+        # Forget the counters of ports which have gone
+        for key in list(self._previous):
+            if key[:2] not in counter_files.ports:
+                del self._previous[key]
+        timestamp = time.time()
+        port_counters = counter_files.read(hca=instance.get('hca'),
+                                           port=instance.get('port'))
+        for (hca, port), counters in sorted(port_counters.items()):
+            rates = self._get_rates(hca, port, counters, timestamp)
+            if sampler:
+                rates.update(sampler.pop_summary(hca, port))
+            dimensions = self._set_dimensions({'hca': hca, 'port': port},
+                                              instance)
+            for measurement, value in rates.items():
+                metric_name = '{0}.{1}'.format(
+                    _METRIC_NAME_PREFIX, measurement)
+                self.gauge(metric_name,
+                           value,
+                           device_name=hca,
+                           dimensions=dimensions)
+            log.debug('Collected {} counters from {} port {}'.format(
+                len(counters), hca, port))
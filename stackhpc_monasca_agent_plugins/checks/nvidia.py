@@ -12,28 +12,657 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+from concurrent import futures
+import ctypes
+import functools
 import logging
+import math
+import os
+import queue
+import re
+import threading
+import time
 
 import monasca_agent.collector.checks as checks
+from prometheus_client.parser import text_string_to_metric_families
 from py3nvml import py3nvml as pynvml
+import requests
+
+from stackhpc_monasca_agent_plugins.common import instrumentation
+from stackhpc_monasca_agent_plugins.common import prometheus
 
 
 log = logging.getLogger(__name__)
 
 _METRIC_NAME_PREFIX = "nvidia"
 
+# Seconds before a query which a GPU reported as not supported is tried
+# again
+_UNSUPPORTED_QUERY_TTL = 3600
+
+# The maximum number of GPUs queried concurrently
+_DEFAULT_COLLECTION_THREADS = 4
+# Seconds to wait for the measurements from each GPU
+_DEFAULT_GPU_TIMEOUT = 5
+
+_DEFAULT_BACKEND = 'nvml'
+_DEFAULT_DCGM_EXPORTER_ENDPOINT = 'http://localhost:9400/metrics'
+# Seconds to wait for dcgm-exporter to respond
+_DEFAULT_DCGM_EXPORTER_TIMEOUT = 3
+
+# dcgm-exporter fields reported with the same names as the NVML backend,
+# with the factor converting them to the same units. Other DCGM fields are
+# reported with their field name, for example DCGM_FI_PROF_SM_OCCUPANCY
+# becomes nvidia.prof_sm_occupancy.
+_DCGM_FIELDS = {
+    'DCGM_FI_DEV_GPU_UTIL': ('utilisation_gpu_percent', 1),
+    'DCGM_FI_DEV_MEM_COPY_UTIL': ('utilisation_memory_percent', 1),
+    'DCGM_FI_DEV_GPU_TEMP': ('temperature_deg_c', 1),
+    'DCGM_FI_DEV_POWER_USAGE': ('power_watts', 1),
+    'DCGM_FI_DEV_FAN_SPEED': ('fan_speed_percent', 1),
+    'DCGM_FI_DEV_FB_USED': ('memory_fb_used_bytes', 1024 ** 2),
+    'DCGM_FI_DEV_FB_FREE': ('memory_fb_free_bytes', 1024 ** 2),
+    'DCGM_FI_DEV_SM_CLOCK': ('clock_freq_sm_mhz', 1),
+    'DCGM_FI_DEV_MEM_CLOCK': ('clock_freq_memory_mhz', 1),
+    'DCGM_FI_PROF_PCIE_TX_BYTES': ('pcie_tx_bytes_per_second', 1),
+    'DCGM_FI_PROF_PCIE_RX_BYTES': ('pcie_rx_bytes_per_second', 1),
+}
+
+# The number of samples kept for each reading from each GPU by the sampler
+_DEFAULT_SAMPLE_WINDOW = 1000
+
+# The union field holding the value of a driver sample, by value type
+_NVML_SAMPLE_VALUE_FIELDS = {
+    pynvml.NVML_VALUE_TYPE_DOUBLE: 'dVal',
+    pynvml.NVML_VALUE_TYPE_UNSIGNED_INT: 'uiVal',
+    pynvml.NVML_VALUE_TYPE_UNSIGNED_LONG: 'ulVal',
+    pynvml.NVML_VALUE_TYPE_UNSIGNED_LONG_LONG: 'ullVal',
+}
+
+# The NvLink utilisation counter read from each link. This must be
+# configured to count bytes, for example with `nvidia-smi nvlink -sc 0bz`.
+_NVLINK_COUNTER = 0
+# The most NvLinks on any GPU, if not defined by the NVML bindings
+_NVLINK_MAX_LINKS = 18
+# The MIG mode of a GPU with MIG enabled, from nvml.h
+_NVML_DEVICE_MIG_ENABLE = 1
+
+# MIG and NvLink queries missing from older NVML bindings such as py3nvml,
+# which are bound from the NVML library instead. Each maps to the ctypes
+# types of its arguments after the device handle, and of the values it
+# returns through pointers.
+_NVML_FALLBACK_FUNCTIONS = {
+    'nvmlDeviceGetMigMode': ((), (ctypes.c_uint, ctypes.c_uint)),
+    'nvmlDeviceGetMaxMigDeviceCount': ((), (ctypes.c_uint,)),
+    'nvmlDeviceGetMigDeviceHandleByIndex': (
+        (ctypes.c_uint,), (pynvml.c_nvmlDevice_t,)),
+    'nvmlDeviceGetGpuInstanceId': ((), (ctypes.c_uint,)),
+    'nvmlDeviceGetComputeInstanceId': ((), (ctypes.c_uint,)),
+    'nvmlDeviceGetNvLinkState': ((ctypes.c_uint,), (ctypes.c_uint,)),
+    'nvmlDeviceGetNvLinkUtilizationCounter': (
+        (ctypes.c_uint, ctypes.c_uint),
+        (ctypes.c_ulonglong, ctypes.c_ulonglong)),
+}
+
+# Clock throttle reasons reported as counters, from nvml.h. Some of these
+# are missing from older NVML bindings.
+_CLOCKS_THROTTLE_REASONS = (
+    ('gpu_idle', 0x1),
+    ('applications_clocks_setting', 0x2),
+    ('sw_power_cap', 0x4),
+    ('hw_slowdown', 0x8),
+    ('sync_boost', 0x10),
+    ('sw_thermal_slowdown', 0x20),
+    ('hw_thermal_slowdown', 0x40),
+    ('hw_power_brake_slowdown', 0x80),
+    ('display_clock_setting', 0x100),
+)
+
+# Events reported as the number received since the previous check
+_NVML_EVENTS = (
+    ('xid_errors', pynvml.nvmlEventTypeXidCriticalError),
+    ('ecc_single_bit_errors', pynvml.nvmlEventTypeSingleBitEccError),
+    ('ecc_double_bit_errors', pynvml.nvmlEventTypeDoubleBitEccError),
+)
+
+# The most events drained from the event set on each check, so that a storm
+# of events can't hold up the check
+_MAX_EVENTS_PER_CHECK = 1000
+
+# Matches the Slurm job ID in the cgroup path of a process in a job, for
+# example /slurm/uid_1000/job_1234/step_0/task_0
+_SLURM_JOB_CGROUP_REGEX = re.compile(r'/job_(\d+)(?:/|$)')
+# Matches the container ID in the cgroup path of a process in a container
+# run by Docker, containerd, CRI-O or Podman, for example
+# /system.slice/docker-<id>.scope or /kubepods/burstable/pod<uid>/<id>
+_CONTAINER_CGROUP_REGEX = re.compile(r'[/-]([0-9a-f]{64})(?:\.scope)?$')
+# The most characters of each list of PIDs or cgroups posted as value meta,
+# which Monasca limits to 2048 characters in all
+_MAX_VALUE_META_LENGTH = 900
+
+# Errors which mean that the NVML session or the device handles are no
+# longer valid, for example because the driver was reloaded or a GPU fell
+# off the bus. NVML is initialised again when these are raised.
+_NVML_REINIT_ERRORS = (
+    pynvml.NVML_ERROR_UNINITIALIZED,
+    pynvml.NVML_ERROR_INVALID_ARGUMENT,
+    pynvml.NVML_ERROR_GPU_IS_LOST,
+    pynvml.NVML_ERROR_DRIVER_NOT_LOADED,
+    pynvml.NVML_ERROR_LIB_RM_VERSION_MISMATCH,
+)
+
+
+def _device_key(handle):
+    """Return a hashable key for an NVML device handle
+
+    The device handles of the NVML bindings are ctypes pointers, which
+    can't be hashed, so are keyed by the address of the device they point
+    to. This stays the same for each GPU while NVML is initialised.
+    """
+    if handle is None:
+        return None
+    return ctypes.cast(handle, ctypes.c_void_p).value
+
+
+class _UnsupportedQueries(object):
+    """Remembers which NVML queries each GPU does not support
+
+    Queries which fail with NVML_ERROR_NOT_SUPPORTED, such as the fan speed
+    of a passively cooled GPU, are skipped on later checks rather than
+    being retried for every GPU on every check. Each is tried again after
+    the TTL, since some depend on settings which can be changed while NVML
+    is initialised, such as the persistence or accounting mode.
+    """
+
+    def __init__(self, ttl=_UNSUPPORTED_QUERY_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # When each query was found to be unsupported, keyed by query
+        self._added = {}
+        self.skipped = 0
+
+    @property
+    def queries(self):
+        """The queries currently being skipped"""
+        now = time.time()
+        with self._lock:
+            return {query for query, added in self._added.items()
+                    if now - added < self.ttl}
+
+    def add(self, query):
+        with self._lock:
+            self._added[query] = time.time()
+
+    def skip(self, query):
+        """Return whether to skip a query, counting the queries skipped"""
+        with self._lock:
+            added = self._added.get(query)
+            if added is None:
+                return False
+            if time.time() - added >= self.ttl:
+                # Try the query again
+                del self._added[query]
+                return False
+            self.skipped += 1
+            return True
+
+    def pop_skipped(self):
+        """Return the number of queries skipped since the last call"""
+        with self._lock:
+            skipped, self.skipped = self.skipped, 0
+        return skipped
+
+    def clear(self):
+        with self._lock:
+            self._added = {}
+            self.skipped = 0
+
+
+def _bind_nvml_function(name, arg_types, result_types):
+    """Return a function calling name in the NVML library through ctypes
+
+    Like the functions of the NVML bindings, it takes the device handle and
+    arguments, raises NVMLError on failure and returns the value or list of
+    values which NVML returns through pointers.
+    """
+    def function(device, *args):
+        results = [result_type() for result_type in result_types]
+        ret = pynvml._nvmlGetFunctionPointer(name)(
+            device,
+            *[arg_type(arg) for arg_type, arg in zip(arg_types, args)],
+            *[ctypes.byref(result) for result in results])
+        pynvml._nvmlCheckReturn(ret)
+        # Device handles are pointers, which are passed back to NVML
+        results = [result if isinstance(result, pynvml.c_nvmlDevice_t)
+                   else result.value for result in results]
+        return results[0] if len(results) == 1 else results
+    function.__name__ = name
+    return function
+
+
+def _nvml_function(name):
+    """Return an NVML function, or None if the bindings are too old
+
+    MIG and NvLink queries are missing from older versions of the NVML
+    bindings, such as py3nvml, in which case they are bound from the NVML
+    library. If that is not possible either, their measurements are not
+    collected.
+    """
+    function = getattr(pynvml, name, None)
+    if function is not None or name not in _NVML_FALLBACK_FUNCTIONS:
+        return function
+    if not hasattr(pynvml, '_nvmlGetFunctionPointer'):
+        return None
+    return _bind_nvml_function(name, *_NVML_FALLBACK_FUNCTIONS[name])
+
+
+class _DaemonThreadPool(object):
+    """Runs calls on a fixed number of daemon threads
+
+    Unlike ThreadPoolExecutor, whose threads are joined when the interpreter
+    exits, a thread hung in an NVML call can't hold up the agent stopping.
+    """
+
+    def __init__(self, max_workers, name='nvidia-collector'):
+        self._queue = queue.Queue()
+        self._threads = []
+        for index in range(max_workers):
+            thread = threading.Thread(target=self._work,
+                                      name='{}-{}'.format(name, index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn, *args, **kwargs):
+        future = futures.Future()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def _work(self):
+        while True:
+            work = self._queue.get()
+            if work is None:
+                return
+            future, fn, args, kwargs = work
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as err:
+                future.set_exception(err)
+            else:
+                future.set_result(result)
+
+    def shutdown(self):
+        """Stop the threads once they finish the calls already submitted"""
+        for _ in self._threads:
+            self._queue.put(None)
+
+
+class _CounterRates(object):
+    """Converts cumulative counters to rates
+
+    The previous sample of each counter is kept between checks, so that the
+    rate is calculated from the counter values rather than posting counters
+    which are hard to use.
+    """
+
+    def __init__(self):
+        self._previous = {}
+
+    def rate(self, key, value, timestamp):
+        """Return the rate of a counter since its previous sample
+
+        Returns None for the first sample of a counter, or if the counter
+        has been reset, for example by the driver being reloaded.
+        """
+        previous = self._previous.get(key)
+        self._previous[key] = (timestamp, value)
+        if previous is None:
+            return None
+        previous_timestamp, previous_value = previous
+        elapsed = timestamp - previous_timestamp
+        if elapsed <= 0 or value < previous_value:
+            return None
+        return (value - previous_value) / float(elapsed)
+
+
+def _summarise(name, values):
+    """Reduce a window of samples to a few summary measurements"""
+    if not values:
+        return {}
+    values = sorted(values)
+    p95_index = max(int(math.ceil(0.95 * len(values))) - 1, 0)
+    return {
+        '{}_min'.format(name): values[0],
+        '{}_mean'.format(name): float(sum(values)) / len(values),
+        '{}_max'.format(name): values[-1],
+        '{}_p95'.format(name): values[p95_index],
+    }
+
+
+class _GpuSampler(object):
+    """Samples fast changing GPU readings in a background thread
+
+    Readings are kept in a fixed size ring buffer for each GPU and
+    summarised when the check runs, so that bursts of activity between
+    checks are captured without posting every sample.
+    """
+
+    def __init__(self, interval, window=_DEFAULT_SAMPLE_WINDOW):
+        self.interval = interval
+        self.window = window
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        # GPU handles keyed by UUID
+        self._gpus = {}
+        # Ring buffers for each reading, keyed by GPU UUID
+        self._buffers = {}
+        # Kept apart from the check's, so that the skips made between
+        # checks aren't counted against the check
+        self._unsupported = _UnsupportedQueries()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='nvidia-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(self.interval * 2)
+
+    def set_gpus(self, gpus):
+        """Set the GPUs to sample, for example after NVML is initialised"""
+        gpus = dict(gpus)
+        with self._lock:
+            if gpus != self._gpus:
+                # The handles have changed
+                self._unsupported.clear()
+            self._gpus = gpus
+            for uuid in list(self._buffers):
+                if uuid not in self._gpus:
+                    del self._buffers[uuid]
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:
+                # Keep sampling, rather than the thread dying silently
+                log.exception('Failed to sample GPUs')
+
+    @staticmethod
+    def _read(gpu, unsupported=None):
+        readings = {}
+        readings.update(Nvidia._get_utilisation_stats(
+            gpu, unsupported=unsupported))
+        readings.update(Nvidia._get_power_usage_watts(
+            gpu, unsupported=unsupported))
+        readings.update(Nvidia._get_device_temperature(
+            gpu, unsupported=unsupported))
+        return readings
+
+    def sample(self):
+        with self._lock:
+            gpus = list(self._gpus.items())
+        for uuid, gpu in gpus:
+            try:
+                readings = _GpuSampler._read(gpu, self._unsupported)
+            except pynvml.NVMLError as err:
+                # The check takes care of re-initialising NVML
+                log.debug('Failed to sample GPU {}: {}'.format(uuid, err))
+                continue
+            with self._lock:
+                buffers = self._buffers.setdefault(uuid, {})
+                for name, value in readings.items():
+                    if name not in buffers:
+                        buffers[name] = collections.deque(maxlen=self.window)
+                    buffers[name].append(value)
+
+    def pop_summary(self, uuid):
+        """Summarise and discard the samples taken since the last call"""
+        with self._lock:
+            buffers = self._buffers.pop(uuid, {})
+        summary = {}
+        for name, values in buffers.items():
+            summary.update(_summarise(name, values))
+        return summary
+
+
+class _ProcessResolver(object):
+    """Maps the PIDs of GPU processes to their cgroup, Slurm job or container
+
+    The mapping is read from /proc once per process and cached for as long
+    as the process keeps using a GPU, so that each check only reads /proc
+    for processes which have started since the previous check.
+    """
+
+    def __init__(self, proc_root='/proc'):
+        self.proc_root = proc_root
+        self._cache = {}
+
+    def _read_cgroup(self, pid):
+        path = os.path.join(self.proc_root, str(pid), 'cgroup')
+        try:
+            with open(path) as cgroup_file:
+                lines = cgroup_file.read().splitlines()
+        except (IOError, OSError) as err:
+            # The process may have exited, or be in another PID namespace
+            log.debug('Failed to read cgroup of PID {}: {}'.format(pid, err))
+            return None
+        # Each line is hierarchy-ID:controller-list:cgroup-path. Prefer the
+        # unified (v2) hierarchy, then the v1 memory controller.
+        cgroups = {}
+        for line in lines:
+            fields = line.split(':', 2)
+            if len(fields) != 3:
+                continue
+            hierarchy, controllers, cgroup = fields
+            if hierarchy == '0':
+                cgroups['unified'] = cgroup
+            for controller in controllers.split(','):
+                cgroups.setdefault(controller, cgroup)
+        return cgroups.get('unified') or cgroups.get('memory')
+
+    def resolve(self, pid):
+        """Return the cgroup of a PID, and the job or container it is in"""
+        if pid not in self._cache:
+            resolved = {}
+            cgroup = self._read_cgroup(pid)
+            if cgroup:
+                resolved['cgroup'] = cgroup
+                match = _SLURM_JOB_CGROUP_REGEX.search(cgroup)
+                if match:
+                    resolved['slurm_job_id'] = match.group(1)
+                match = _CONTAINER_CGROUP_REGEX.search(cgroup)
+                if match:
+                    resolved['container_id'] = match.group(1)
+            self._cache[pid] = resolved
+        return self._cache[pid]
+
+    def prune(self, pids):
+        """Forget PIDs which are no longer using any GPU
+
+        This also stops the mapping of a PID from outliving its process if
+        the PID is reused.
+        """
+        for pid in set(self._cache) - set(pids):
+            del self._cache[pid]
+
 
 class Nvidia(checks.AgentCheck):
     def __init__(self, name, init_config, agent_config):
         super(Nvidia, self).__init__(name, init_config, agent_config)
+        self._nvml_initialised = False
+        self._driver_version = None
+        self._gpu_handles = []
+        self._gpu_handles_by_uuid = {}
+        # Attributes of each GPU which don't change while the driver is
+        # loaded, in the same order as the handles
+        self._static_gpu_info = []
+        self._executor = None
+        self._executor_threads = None
+        # Outstanding collections from each GPU, keyed by index
+        self._gpu_futures = {}
+        self._sampler = None
+        # Timestamp of the latest driver sample of each type, keyed by UUID
+        self._driver_sample_times = {}
+        self._process_resolver = _ProcessResolver()
+        self._nvlink_rates = _CounterRates()
+        self._event_set = None
+        # Events registered for each GPU, keyed by UUID
+        self._event_types = {}
+        # Number of checks each GPU was throttled for each reason, keyed by
+        # UUID and reason
+        self._throttle_counts = collections.defaultdict(collections.Counter)
+        self._dcgm_exporter_session = None
+        self._instrumentation = instrumentation.CheckInstrumentation(
+            _METRIC_NAME_PREFIX)
+        # Queries which GPUs don't support, keyed by handle and query name
+        self._unsupported_queries = _UnsupportedQueries()
+
+    def stop(self):
+        if self._dcgm_exporter_session:
+            self._dcgm_exporter_session.close()
+            self._dcgm_exporter_session = None
+        if self._sampler:
+            self._sampler.stop()
+            self._sampler = None
+        self._shutdown_nvml()
+        self._shutdown_executor()
+
+    def _shutdown_executor(self):
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+            self._executor_threads = None
+        self._gpu_futures = {}
+
+    def _get_executor(self, threads):
+        if self._executor_threads != threads:
+            self._shutdown_executor()
+            self._executor = _DaemonThreadPool(threads)
+            self._executor_threads = threads
+        return self._executor
+
+    def _init_nvml(self):
+        """Initialise NVML and cache the device handles
+
+        NVML is left initialised between checks, since initialising it is
+        slow and wakes up idle GPUs.
+        """
+        pynvml.nvmlInit()
+        self._nvml_initialised = True
+        # The handles are about to change, and a new driver may support
+        # different queries.
+        self._unsupported_queries.clear()
+        self._driver_version = pynvml.nvmlSystemGetDriverVersion()
+        self._gpu_handles = []
+        self._gpu_handles_by_uuid = {}
+        self._static_gpu_info = []
+        self._driver_sample_times = {}
+        for i in range(0, pynvml.nvmlDeviceGetCount()):
+            gpu = pynvml.nvmlDeviceGetHandleByIndex(i)
+            static_info = self._get_static_gpu_info(gpu)
+            self._gpu_handles.append(gpu)
+            self._gpu_handles_by_uuid[
+                static_info['dimensions'].get('uuid')] = gpu
+            self._static_gpu_info.append(static_info)
+        log.info('Initialised NVML with driver version {} and {} '
+                 'GPUs'.format(self._driver_version, len(self._gpu_handles)))
+        self._register_events()
+
+    def _register_events(self):
+        """Register for XID and ECC error events from every GPU
+
+        The events are queued by the driver until they are drained by the
+        next check, so that faults are not missed between checks.
+        """
+        self._event_types = {}
+        wanted = 0
+        for _, event_type in _NVML_EVENTS:
+            wanted |= event_type
+        try:
+            self._event_set = pynvml.nvmlEventSetCreate()
+        except pynvml.NVMLError as err:
+            log.info('Failed to create NVML event set: {}'.format(err))
+            return
+        for uuid, gpu in self._gpu_handles_by_uuid.items():
+            try:
+                event_types = (
+                    pynvml.nvmlDeviceGetSupportedEventTypes(gpu) & wanted)
+                if event_types:
+                    pynvml.nvmlDeviceRegisterEvents(
+                        gpu, event_types, self._event_set)
+                    self._event_types[uuid] = event_types
+            except pynvml.NVMLError as err:
+                log.info('Failed to register for events from GPU {}: '
+                         '{}'.format(uuid, err))
+
+    def _shutdown_nvml(self):
+        if not self._nvml_initialised:
+            return
+        self._nvml_initialised = False
+        # Threads may still be hung in calls on the old handles. Leave them
+        # to finish in the old pool, and forget their results, so that they
+        # don't hold up or skip queries of the new handles.
+        self._shutdown_executor()
+        self._gpu_handles = []
+        self._gpu_handles_by_uuid = {}
+        self._static_gpu_info = []
+        self._event_types = {}
+        if self._event_set is not None:
+            try:
+                pynvml.nvmlEventSetFree(self._event_set)
+            except pynvml.NVMLError as err:
+                log.debug('Failed to free NVML event set: {}'.format(err))
+            self._event_set = None
+        try:
+            pynvml.nvmlShutdown()
+        except pynvml.NVMLError as err:
+            log.debug('Failed to shut down NVML: {}'.format(err))
+
+    def _ensure_nvml(self):
+        """Make sure NVML is initialised and the device handles are current
+        """
+        if self._nvml_initialised:
+            # A driver upgrade or GPU hot-plug invalidates the handles
+            current = (pynvml.nvmlSystemGetDriverVersion(),
+                       pynvml.nvmlDeviceGetCount())
+            if current == (self._driver_version, len(self._gpu_handles)):
+                return
+            log.info('NVML driver or GPUs changed, re-initialising')
+            self._shutdown_nvml()
+        self._init_nvml()
 
     def handle_not_supported(f):
+        """Return nothing from a query which is not supported
+
+        If an _UnsupportedQueries is passed as the unsupported keyword
+        argument, the query is remembered as not supported for the device,
+        or None for system queries, and skipped until it expires.
+        """
+        @functools.wraps(f)
         def wrapper(*args, **kw):
+            unsupported = kw.pop('unsupported', None)
+            query = (_device_key(args[0] if args else None), f.__name__)
+            if unsupported is not None and unsupported.skip(query):
+                return {}
             try:
                 return f(*args, **kw)
             except pynvml.NVMLError as err:
-                if err == pynvml.NVMLError(pynvml.NVML_ERROR_NOT_SUPPORTED):
+                # A driver older than the bindings may not have the function
+                if err in (
+                        pynvml.NVMLError(pynvml.NVML_ERROR_NOT_SUPPORTED),
+                        pynvml.NVMLError(
+                            pynvml.NVML_ERROR_FUNCTION_NOT_FOUND)):
                     log.info('Not supported: {}'.format(f.__name__))
+                    if unsupported is not None:
+                        unsupported.add(query)
                     return {}
                 else:
                     raise
@@ -81,6 +710,11 @@ class Nvidia(checks.AgentCheck):
         power_state = "P{}".format(pynvml.nvmlDeviceGetPowerState(gpu))
         return {'power_state': power_state}
 
+    @staticmethod
+    @handle_not_supported
+    def _get_power_state_number(gpu):
+        return {'power_state': pynvml.nvmlDeviceGetPowerState(gpu)}
+
     @staticmethod
     @handle_not_supported
     def _get_framebuffer_memory_stats(gpu):
@@ -172,54 +806,720 @@ class Nvidia(checks.AgentCheck):
         }
 
     @staticmethod
-    def _get_gpu_info():
-        pynvml.nvmlInit()
-        deviceCount = pynvml.nvmlDeviceGetCount()
-        all_info = []
-        for i in range(0, deviceCount):
-            gpu = pynvml.nvmlDeviceGetHandleByIndex(i)
+    @handle_not_supported
+    def _get_supported_throttle_reasons(gpu):
+        return {'clocks_throttle_reasons_supported':
+                pynvml.nvmlDeviceGetSupportedClocksThrottleReasons(gpu)}
 
-            dimensions = {}
-            dimensions.update(Nvidia._get_driver_version())
-            dimensions.update(Nvidia._get_device_uuid(gpu))
-            dimensions.update(Nvidia._get_info_rom_image_version(gpu))
-            dimensions.update(Nvidia._get_device_power_state(gpu))
-            dimensions.update(Nvidia._get_device_vbios_version(gpu))
-
-            measurements = {}
-            measurements.update(Nvidia._get_fan_speed_percent(gpu))
-            measurements.update(Nvidia._get_framebuffer_memory_stats(gpu))
-            measurements.update(Nvidia._get_bar1_memory_stats(gpu))
-            measurements.update(Nvidia._get_utilisation_stats(gpu))
-            measurements.update(Nvidia._get_device_temperature(gpu))
-            measurements.update(Nvidia._get_device_shutdown_temp(gpu))
-            measurements.update(Nvidia._get_device_slowdown_temp(gpu))
-            measurements.update(Nvidia._get_power_usage_watts(gpu))
-            measurements.update(Nvidia._get_power_limit_watts(gpu))
-            measurements.update(Nvidia._get_clock_info(gpu))
-            measurements.update(Nvidia._get_clock_max_info(gpu))
-
-            gpu_name = "{}_{}".format(
-                Nvidia._get_device_name(gpu).get('name'),
-                Nvidia._get_device_serial(gpu).get('serial'))
-            gpu_info = {
-                'name': gpu_name,
-                'dimensions': dimensions,
-                'measurements': measurements
+    @staticmethod
+    @handle_not_supported
+    def _get_throttle_reasons(gpu):
+        return {'clocks_throttle_reasons':
+                pynvml.nvmlDeviceGetCurrentClocksThrottleReasons(gpu)}
+
+    @staticmethod
+    @handle_not_supported
+    def _get_pcie_throughput(gpu):
+        # NVML samples the link for 20ms to measure each direction, and
+        # reports the throughput in KB/s
+        tx_kb = pynvml.nvmlDeviceGetPcieThroughput(
+            gpu, pynvml.NVML_PCIE_UTIL_TX_BYTES)
+        rx_kb = pynvml.nvmlDeviceGetPcieThroughput(
+            gpu, pynvml.NVML_PCIE_UTIL_RX_BYTES)
+        return {
+            'pcie_tx_bytes_per_second': tx_kb * 1024,
+            'pcie_rx_bytes_per_second': rx_kb * 1024,
+        }
+
+    @staticmethod
+    @handle_not_supported
+    def _get_nvlink_links(gpu):
+        get_state = _nvml_function('nvmlDeviceGetNvLinkState')
+        if get_state is None:
+            return {}
+        links = []
+        for link in range(getattr(pynvml, 'NVML_NVLINK_MAX_LINKS',
+                                  _NVLINK_MAX_LINKS)):
+            try:
+                state = get_state(gpu, link)
+            except pynvml.NVMLError as err:
+                if err == pynvml.NVMLError(pynvml.NVML_ERROR_INVALID_ARGUMENT):
+                    # The GPU has no more links
+                    break
+                raise
+            if state == pynvml.NVML_FEATURE_ENABLED:
+                links.append(link)
+        return {'nvlink_links': links}
+
+    @staticmethod
+    @handle_not_supported
+    def _get_nvlink_counters(gpu, links):
+        get_counter = _nvml_function('nvmlDeviceGetNvLinkUtilizationCounter')
+        if get_counter is None or not links:
+            return {}
+        counters = {}
+        for link in links:
+            rx_bytes, tx_bytes = get_counter(gpu, link, _NVLINK_COUNTER)
+            counters[link] = {'rx_bytes': rx_bytes, 'tx_bytes': tx_bytes}
+        return {'nvlink': {'timestamp': time.time(), 'links': counters}}
+
+    @staticmethod
+    @handle_not_supported
+    def _get_mig_devices(gpu):
+        get_mode = _nvml_function('nvmlDeviceGetMigMode')
+        if get_mode is None:
+            return {}
+        current_mode, _ = get_mode(gpu)
+        if current_mode != getattr(pynvml, 'NVML_DEVICE_MIG_ENABLE',
+                                   _NVML_DEVICE_MIG_ENABLE):
+            return {}
+        get_count = _nvml_function('nvmlDeviceGetMaxMigDeviceCount')
+        get_device = _nvml_function('nvmlDeviceGetMigDeviceHandleByIndex')
+        devices = []
+        for index in range(get_count(gpu)):
+            try:
+                devices.append(get_device(gpu, index))
+            except pynvml.NVMLError as err:
+                if err == pynvml.NVMLError(pynvml.NVML_ERROR_NOT_FOUND):
+                    # No MIG device has been created in this slot
+                    continue
+                raise
+        return {'mig_devices': devices}
+
+    @staticmethod
+    def _get_mig_utilisation_stats(mig):
+        # MIG device handles are fetched on every check, so they can't be
+        # used to remember unsupported queries
+        try:
+            util = pynvml.nvmlDeviceGetUtilizationRates(mig)
+        except pynvml.NVMLError as err:
+            if err == pynvml.NVMLError(pynvml.NVML_ERROR_NOT_SUPPORTED):
+                return {}
+            raise
+        return {
+            'utilisation_gpu_percent': util.gpu,
+            'utilisation_memory_percent': util.memory
+        }
+
+    @staticmethod
+    def _get_mig_info(gpu, unsupported=None):
+        get_gpu_instance_id = _nvml_function('nvmlDeviceGetGpuInstanceId')
+        get_compute_instance_id = _nvml_function(
+            'nvmlDeviceGetComputeInstanceId')
+        mig_info = []
+        for mig in Nvidia._get_mig_devices(
+                gpu, unsupported=unsupported).get('mig_devices', []):
+            mem_info = pynvml.nvmlDeviceGetMemoryInfo(mig)
+            measurements = {
+                'memory_fb_total_bytes': mem_info.total,
+                'memory_fb_used_bytes': mem_info.used,
+                'memory_fb_free_bytes': (mem_info.total - mem_info.used)
             }
-            all_info.append(gpu_info)
-        pynvml.nvmlShutdown()
-        return all_info
+            measurements.update(Nvidia._get_mig_utilisation_stats(mig))
+            mig_info.append({
+                'dimensions': {
+                    'mig_uuid': pynvml.nvmlDeviceGetUUID(mig),
+                    'gpu_instance_id': str(get_gpu_instance_id(mig)),
+                    'compute_instance_id': str(
+                        get_compute_instance_id(mig)),
+                },
+                'measurements': measurements
+            })
+        return mig_info
+
+    @staticmethod
+    @handle_not_supported
+    def _get_compute_processes(gpu):
+        return {'processes': [
+            {'pid': process.pid,
+             'memory_used_bytes': process.usedGpuMemory}
+            for process in pynvml.nvmlDeviceGetComputeRunningProcesses(gpu)]}
+
+    @staticmethod
+    @handle_not_supported
+    def _get_accounting_stats(gpu, pid):
+        # Only available if accounting mode is enabled on the GPU
+        try:
+            stats = pynvml.nvmlDeviceGetAccountingStats(gpu, pid)
+        except pynvml.NVMLError as err:
+            if err == pynvml.NVMLError(pynvml.NVML_ERROR_NOT_FOUND):
+                # The process started before accounting was enabled
+                return {}
+            raise
+        return {
+            'utilisation_gpu_percent': stats.gpuUtilization,
+            'utilisation_memory_percent': stats.memoryUtilization,
+            'memory_max_used_bytes': stats.maxMemoryUsage,
+        }
+
+    @staticmethod
+    def _get_process_info(gpu, unsupported=None):
+        processes = Nvidia._get_compute_processes(
+            gpu, unsupported=unsupported).get('processes', [])
+        for process in processes:
+            if process['memory_used_bytes'] is None:
+                del process['memory_used_bytes']
+            # Not remembered as unsupported, since this is only supported
+            # while accounting mode is enabled
+            process.update(Nvidia._get_accounting_stats(gpu, process['pid']))
+        return processes
+
+    @staticmethod
+    def _get_samples(gpu, sample_type, last_seen):
+        try:
+            value_type, samples = pynvml.nvmlDeviceGetSamples(
+                gpu, sample_type, last_seen)
+        except pynvml.NVMLError as err:
+            if err == pynvml.NVMLError(pynvml.NVML_ERROR_NOT_FOUND):
+                # There are no samples newer than the last one seen
+                return []
+            raise
+        field = _NVML_SAMPLE_VALUE_FIELDS[value_type]
+        return [(sample.timeStamp, getattr(sample.sampleValue, field))
+                for sample in samples]
+
+    @staticmethod
+    @handle_not_supported
+    def _get_utilisation_samples(gpu, last_seen=0):
+        return {'utilisation_gpu_percent': Nvidia._get_samples(
+            gpu, pynvml.NVML_GPU_UTILIZATION_SAMPLES, last_seen)}
+
+    @staticmethod
+    @handle_not_supported
+    def _get_power_samples(gpu, last_seen=0):
+        return {'power_watts': [
+            (timestamp, value / 1000.0) for timestamp, value in
+            Nvidia._get_samples(gpu, pynvml.NVML_TOTAL_POWER_SAMPLES,
+                                last_seen)]}
+
+    def _get_driver_sample_summary(self, uuid):
+        """Summarise the samples buffered by the driver since the last check
+
+        The driver samples utilisation and power at a higher rate than is
+        practical to poll, so this avoids the need for a sampler thread for
+        these readings.
+        """
+        gpu = self._gpu_handles_by_uuid.get(uuid)
+        if gpu is None:
+            return {}
+        last_seen = self._driver_sample_times.setdefault(uuid, {})
+        summary = {}
+        for name, get_samples in (
+                ('utilisation_gpu_percent', Nvidia._get_utilisation_samples),
+                ('power_watts', Nvidia._get_power_samples)):
+            samples = get_samples(
+                gpu, last_seen.get(name, 0),
+                unsupported=self._unsupported_queries).get(name)
+            if not samples:
+                continue
+            last_seen[name] = max(t for t, _ in samples)
+            summary.update(_summarise(name, [v for _, v in samples]))
+        return summary
+
+    def _get_sampler(self, instance):
+        interval = instance.get('sample_interval')
+        if not interval:
+            return None
+        if self._sampler is None:
+            self._sampler = _GpuSampler(
+                interval, instance.get('sample_window',
+                                       _DEFAULT_SAMPLE_WINDOW))
+            self._sampler.start()
+        return self._sampler
+
+    def _get_gpu_info(self, instance=None):
+        instance = instance or {}
+        try:
+            return self._collect_gpu_info(instance)
+        except pynvml.NVMLError as err:
+            if err.value not in _NVML_REINIT_ERRORS:
+                raise
+            log.warning('NVML error: {}, re-initialising'.format(err))
+            self._shutdown_nvml()
+            return self._collect_gpu_info(instance)
+
+    def _get_static_gpu_info(self, gpu):
+        """Query the attributes of a GPU which never change
+
+        These are cached until NVML is initialised again, for example after
+        the driver is reloaded, so that each check only queries the
+        attributes which change.
+        """
+        def query(get):
+            return get(gpu, unsupported=self._unsupported_queries)
+
+        dimensions = {'driver_version': self._driver_version}
+        dimensions.update(query(Nvidia._get_device_uuid))
+        dimensions.update(query(Nvidia._get_info_rom_image_version))
+        dimensions.update(query(Nvidia._get_device_vbios_version))
+
+        measurements = {}
+        measurements.update(query(Nvidia._get_device_shutdown_temp))
+        measurements.update(query(Nvidia._get_device_slowdown_temp))
+        measurements.update(query(Nvidia._get_clock_max_info))
+
+        gpu_name = "{}_{}".format(
+            query(Nvidia._get_device_name).get('name'),
+            query(Nvidia._get_device_serial).get('serial'))
+        return {
+            'name': gpu_name,
+            'dimensions': dimensions,
+            'measurements': measurements,
+            'nvlink_links': query(Nvidia._get_nvlink_links).get(
+                'nvlink_links', []),
+            'clocks_throttle_reasons_supported':
+                query(Nvidia._get_supported_throttle_reasons).get(
+                    'clocks_throttle_reasons_supported', 0)
+        }
+
+    @staticmethod
+    def _get_single_gpu_info(gpu, static_info, process_metrics=False,
+                             pcie_throughput=False, stable_dimensions=False,
+                             unsupported=None):
+        def query(get):
+            return get(gpu, unsupported=unsupported)
+
+        dimensions = dict(static_info['dimensions'])
+        measurements = dict(static_info['measurements'])
+        if stable_dimensions:
+            # The P-state changes frequently, and as a dimension would start
+            # a new set of series for the GPU each time it changes
+            measurements.update(query(Nvidia._get_power_state_number))
+        else:
+            dimensions.update(query(Nvidia._get_device_power_state))
+
+        measurements.update(query(Nvidia._get_fan_speed_percent))
+        measurements.update(query(Nvidia._get_framebuffer_memory_stats))
+        measurements.update(query(Nvidia._get_bar1_memory_stats))
+        measurements.update(query(Nvidia._get_utilisation_stats))
+        measurements.update(query(Nvidia._get_device_temperature))
+        measurements.update(query(Nvidia._get_power_usage_watts))
+        measurements.update(query(Nvidia._get_power_limit_watts))
+        measurements.update(query(Nvidia._get_clock_info))
+
+        if pcie_throughput:
+            measurements.update(Nvidia._get_optional(
+                'PCIe throughput', Nvidia._get_pcie_throughput, gpu,
+                unsupported=unsupported))
+
+        gpu_info = {
+            'name': static_info['name'],
+            'dimensions': dimensions,
+            'measurements': measurements
+        }
+        if static_info['clocks_throttle_reasons_supported']:
+            gpu_info.update(Nvidia._get_optional(
+                'clock throttle reasons', Nvidia._get_throttle_reasons, gpu,
+                unsupported=unsupported))
+            gpu_info['clocks_throttle_reasons_supported'] = (
+                static_info['clocks_throttle_reasons_supported'])
+        mig_info = Nvidia._get_optional('MIG devices', Nvidia._get_mig_info,
+                                        gpu, unsupported=unsupported)
+        if mig_info:
+            gpu_info['mig'] = mig_info
+        gpu_info.update(Nvidia._get_optional(
+            'NvLink counters', Nvidia._get_nvlink_counters, gpu,
+            static_info['nvlink_links'], unsupported=unsupported))
+        if process_metrics:
+            gpu_info['processes'] = Nvidia._get_optional(
+                'processes', Nvidia._get_process_info, gpu,
+                unsupported=unsupported) or []
+        return gpu_info
+
+    @staticmethod
+    def _get_optional(description, query, *args, **kwargs):
+        """Run a query for measurements which can be left out of a GPU's
+
+        A failure which doesn't mean that NVML must be initialised again only
+        loses these measurements, rather than all of those from the GPU.
+        """
+        try:
+            return query(*args, **kwargs)
+        except pynvml.NVMLError as err:
+            if err.value in _NVML_REINIT_ERRORS:
+                raise
+            log.warning('Failed to get {}: {}'.format(description, err))
+            return {}
+
+    def _query_gpu(self, index, started, *args):
+        # Time out each GPU from when its query starts, not from when it
+        # was queued behind other GPUs
+        started[index] = time.time()
+        return self._instrumentation.timed(
+            'gpu_queries', Nvidia._get_single_gpu_info)(
+                *args, unsupported=self._unsupported_queries)
+
+    def _collect_gpu_info(self, instance):
+        """Collect measurements from all GPUs concurrently
+
+        NVML is thread safe, and some calls block for milliseconds on busy
+        GPUs, so each GPU is queried from a thread pool. A GPU which does
+        not respond within the timeout of its query starting, or which
+        fails, is left out of the results rather than holding up or failing
+        the whole check.
+        """
+        with self._instrumentation.stage('nvml_init'):
+            self._ensure_nvml()
+        threads = instance.get('collection_threads',
+                               _DEFAULT_COLLECTION_THREADS)
+        executor = self._get_executor(threads)
+        timeout = instance.get('gpu_timeout', _DEFAULT_GPU_TIMEOUT)
+        process_metrics = instance.get('process_metrics', False)
+        pcie_throughput = instance.get('pcie_throughput', False)
+        stable_dimensions = instance.get('stable_dimensions', False)
+        # The indices of the GPUs to collect from, or None for all GPUs
+        gpus = instance.get('gpus')
+        submitted = {}
+        # When the query of each GPU started, keyed by index
+        started = {}
+        for index, (gpu, static_info) in enumerate(
+                zip(self._gpu_handles, self._static_gpu_info)):
+            if gpus is not None and index not in gpus:
+                continue
+            previous = self._gpu_futures.get(index)
+            if previous and not previous.done():
+                # Don't tie up another thread on a GPU which is still hung
+                log.warning('Skipping GPU {} which has not responded since '
+                            'a previous check'.format(index))
+                continue
+            submitted[index] = executor.submit(
+                self._query_gpu, index, started, gpu, static_info,
+                process_metrics, pcie_throughput, stable_dimensions)
+        self._gpu_futures.update(submitted)
+
+        results = {}
+        reinit_error = None
+        pending = dict(submitted)
+        while pending:
+            done, _ = futures.wait(
+                pending.values(),
+                timeout=self._next_gpu_timeout(pending, started, timeout),
+                return_when=futures.FIRST_COMPLETED)
+            for index, future in list(pending.items()):
+                if future in done:
+                    del pending[index]
+                    try:
+                        results[index] = future.result()
+                    except pynvml.NVMLError as err:
+                        if err.value in _NVML_REINIT_ERRORS:
+                            reinit_error = err
+                        else:
+                            log.warning('Failed to collect from GPU {}: '
+                                        '{}'.format(index, err))
+                elif index in started and (
+                        started[index] + timeout <= time.time()):
+                    del pending[index]
+                    log.warning('Timed out after {} seconds collecting from '
+                                'GPU {}'.format(timeout, index))
+            running = set(pending.values())
+            hung = [future for future in self._gpu_futures.values()
+                    if not future.done() and future not in running]
+            if pending and len(hung) >= threads:
+                # Every thread is hung, so the GPUs still queued won't be
+                # queried. Cancel them, so that they are tried next check.
+                for index, future in sorted(pending.items()):
+                    if future.cancel():
+                        log.warning('Skipping GPU {} since every collection '
+                                    'thread is hung'.format(index))
+                        del pending[index]
+        if reinit_error:
+            raise reinit_error
+        return [info for _, info in sorted(results.items())]
+
+    @staticmethod
+    def _next_gpu_timeout(pending, started, timeout):
+        """Return the seconds until the first pending GPU times out
+
+        A GPU which is still queued can't time out before it starts, so is
+        counted as if it had just started.
+        """
+        now = time.time()
+        return max(min(started.get(index, now) + timeout - now
+                       for index in pending), 0)
+
+    def _get_dcgm_exporter_session(self):
+        if self._dcgm_exporter_session is None:
+            # Keep the connection to dcgm-exporter open between checks
+            self._dcgm_exporter_session = requests.Session()
+        return self._dcgm_exporter_session
+
+    @staticmethod
+    def _parse_dcgm_exporter_metrics(text):
+        """Group the fields scraped from dcgm-exporter by GPU
+
+        dcgm-exporter watches a group of fields on every GPU using the DCGM
+        host engine, so a single scrape returns all of the fields for all
+        of the GPUs, including profiling fields which NVML does not report.
+        """
+        metrics = prometheus.MetricStore(whitelist=[r'DCGM_FI_'])
+        prometheus.parse_metrics(metrics, text_string_to_metric_families(text))
+
+        gpus = collections.OrderedDict()
+        for metric in metrics.get_metrics():
+            labels = metric['dimensions']
+            dimensions = {'uuid': labels.get('UUID')}
+            if 'DCGM_FI_DRIVER_VERSION' in labels:
+                dimensions['driver_version'] = labels['DCGM_FI_DRIVER_VERSION']
+            if 'GPU_I_ID' in labels:
+                # A MIG device
+                dimensions['gpu_instance_id'] = labels['GPU_I_ID']
+            key = tuple(sorted(dimensions.items()))
+            if key not in gpus:
+                # Named like the GPUs found through NVML, which are named
+                # by serial number. dcgm-exporter has no serial number label.
+                gpus[key] = {
+                    'name': '{}_{}'.format(labels.get('modelName'),
+                                           labels.get('UUID')),
+                    'dimensions': dimensions,
+                    'measurements': {}
+                }
+            measurement, factor = _DCGM_FIELDS.get(
+                metric['name'],
+                (metric['name'][len('DCGM_FI_'):].lower(), 1))
+            gpus[key]['measurements'][measurement] = metric['value'] * factor
+        return list(gpus.values())
+
+    def _get_dcgm_exporter_gpu_info(self, instance):
+        endpoint = instance.get('dcgm_exporter_endpoint',
+                                _DEFAULT_DCGM_EXPORTER_ENDPOINT)
+        try:
+            with self._instrumentation.stage('fetch'):
+                response = self._get_dcgm_exporter_session().get(
+                    endpoint, timeout=instance.get(
+                        'timeout', _DEFAULT_DCGM_EXPORTER_TIMEOUT))
+                response.raise_for_status()
+            with self._instrumentation.stage('parse'):
+                return Nvidia._parse_dcgm_exporter_metrics(response.text)
+        except Exception as e:
+            log.error('Could not get metrics from dcgm-exporter at {}: '
+                      '{}'.format(endpoint, e))
+            return []
+
+    def _send_gpu_metrics(self, gpu_metrics):
+        for measurement, value in gpu_metrics['measurements'].items():
+            metric_name = '{0}.{1}'.format(
+                _METRIC_NAME_PREFIX, measurement)
+            self.gauge(metric_name,
+                       value,
+                       device_name=gpu_metrics.get('name'),
+                       dimensions=gpu_metrics.get('dimensions'),
+                       value_meta=None)
 
     def check(self, instance):
-        for gpu_metrics in Nvidia._get_gpu_info():
-            for measurement, value in gpu_metrics['measurements'].items():
+        with self._instrumentation.run(instance):
+            self._check(instance)
+        self._instrumentation.send_metrics(
+            self, self._set_dimensions(None, instance), instance.get('name'))
+
+    def _check(self, instance):
+        backend = instance.get('backend', _DEFAULT_BACKEND)
+        if backend == 'dcgm_exporter':
+            gpu_info = self._get_dcgm_exporter_gpu_info(instance)
+            with self._instrumentation.stage('emit'):
+                for gpu_metrics in gpu_info:
+                    self._send_gpu_metrics(gpu_metrics)
+            return
+        elif backend != 'nvml':
+            log.error('Unsupported nvidia backend: {}'.format(backend))
+            return
+
+        sampler = self._get_sampler(instance)
+        gpu_info = self._get_gpu_info(instance)
+        if sampler:
+            sampler.set_gpus(self._gpu_handles_by_uuid.items())
+        with self._instrumentation.stage('emit'):
+            self._send_all_metrics(instance, sampler, gpu_info)
+
+    def _send_all_metrics(self, instance, sampler, gpu_info):
+        for gpu_metrics in gpu_info:
+            uuid = gpu_metrics['dimensions'].get('uuid')
+            if sampler:
+                gpu_metrics['measurements'].update(sampler.pop_summary(uuid))
+            if instance.get('use_driver_samples'):
+                gpu_metrics['measurements'].update(
+                    self._get_driver_sample_summary(uuid))
+            self._send_gpu_metrics(gpu_metrics)
+            self._send_throttle_metrics(gpu_metrics)
+            self._send_mig_metrics(gpu_metrics)
+            self._send_nvlink_metrics(gpu_metrics)
+            self._send_process_metrics(gpu_metrics)
+            log.debug('Collected info for GPU {}'.format(
+                gpu_metrics.get('name')))
+        if instance.get('process_metrics', False):
+            self._process_resolver.prune(
+                process['pid'] for gpu_metrics in gpu_info
+                for process in gpu_metrics.get('processes', []))
+        self._send_event_metrics(gpu_info)
+        self._send_collector_metrics(instance)
+
+    def _drain_events(self):
+        """Read the events queued since the last check without waiting
+
+        Returns the number of events of each type, and the XIDs reported,
+        keyed by GPU UUID.
+        """
+        events = collections.defaultdict(lambda: {
+            'counts': collections.Counter(), 'xids': set()})
+        if self._event_set is None:
+            return events
+        for _ in range(_MAX_EVENTS_PER_CHECK):
+            try:
+                event = pynvml.nvmlEventSetWait(self._event_set, 0)
+                uuid = pynvml.nvmlDeviceGetUUID(event.device)
+            except pynvml.NVMLError as err:
+                if err == pynvml.NVMLError(pynvml.NVML_ERROR_TIMEOUT):
+                    # There are no more events
+                    break
+                log.warning('Failed to read NVML events: {}'.format(err))
+                if err.value in _NVML_REINIT_ERRORS:
+                    self._shutdown_nvml()
+                break
+            events[uuid]['counts'][event.eventType] += 1
+            if event.eventType == pynvml.nvmlEventTypeXidCriticalError:
+                events[uuid]['xids'].add(event.eventData)
+        else:
+            log.warning('More than {} NVML events since the last check, '
+                        'leaving the rest for the next '
+                        'check'.format(_MAX_EVENTS_PER_CHECK))
+        return events
+
+    def _send_event_metrics(self, gpu_info):
+        with self._instrumentation.stage('events'):
+            events = self._drain_events()
+        for gpu_metrics in gpu_info:
+            uuid = gpu_metrics['dimensions'].get('uuid')
+            event_types = self._event_types.get(uuid, 0)
+            for measurement, event_type in _NVML_EVENTS:
+                if not event_types & event_type:
+                    continue
+                value_meta = None
+                if event_type == pynvml.nvmlEventTypeXidCriticalError:
+                    xids = events[uuid]['xids']
+                    if xids:
+                        value_meta = {'xids': ','.join(
+                            str(xid) for xid in sorted(xids))}
                 metric_name = '{0}.{1}'.format(
                     _METRIC_NAME_PREFIX, measurement)
                 self.gauge(metric_name,
-                           value,
+                           events[uuid]['counts'][event_type],
                            device_name=gpu_metrics.get('name'),
                            dimensions=gpu_metrics.get('dimensions'),
+                           value_meta=value_meta)
+
+    def _send_throttle_metrics(self, gpu_metrics):
+        if 'clocks_throttle_reasons' not in gpu_metrics:
+            return
+        uuid = gpu_metrics['dimensions'].get('uuid')
+        counts = self._throttle_counts[uuid]
+        for reason, mask in _CLOCKS_THROTTLE_REASONS:
+            if not gpu_metrics['clocks_throttle_reasons_supported'] & mask:
+                continue
+            if gpu_metrics['clocks_throttle_reasons'] & mask:
+                counts[reason] += 1
+            metric_name = '{0}.clocks_throttle.{1}_count'.format(
+                _METRIC_NAME_PREFIX, reason)
+            self.gauge(metric_name,
+                       counts[reason],
+                       device_name=gpu_metrics.get('name'),
+                       dimensions=gpu_metrics.get('dimensions'),
+                       value_meta=None)
+
+    def _send_mig_metrics(self, gpu_metrics):
+        for mig_metrics in gpu_metrics.get('mig', []):
+            dimensions = dict(gpu_metrics.get('dimensions'))
+            dimensions.update(mig_metrics['dimensions'])
+            for measurement, value in mig_metrics['measurements'].items():
+                metric_name = '{0}.mig.{1}'.format(
+                    _METRIC_NAME_PREFIX, measurement)
+                self.gauge(metric_name,
+                           value,
+                           device_name=gpu_metrics.get('name'),
+                           dimensions=dimensions,
                            value_meta=None)
-            log.debug('Collected info for GPU {}'.format(
-                gpu_metrics.get('name')))
+
+    def _send_nvlink_metrics(self, gpu_metrics):
+        nvlink = gpu_metrics.get('nvlink')
+        if not nvlink:
+            return
+        uuid = gpu_metrics['dimensions'].get('uuid')
+        for link, counters in nvlink['links'].items():
+            dimensions = dict(gpu_metrics.get('dimensions'))
+            dimensions['link'] = str(link)
+            for counter, value in counters.items():
+                rate = self._nvlink_rates.rate(
+                    (uuid, link, counter), value, nvlink['timestamp'])
+                if rate is None:
+                    continue
+                metric_name = '{0}.nvlink.{1}_per_second'.format(
+                    _METRIC_NAME_PREFIX, counter)
+                self.gauge(metric_name,
+                           rate,
+                           device_name=gpu_metrics.get('name'),
+                           dimensions=dimensions,
+                           value_meta=None)
+
+    def _group_processes(self, processes):
+        """Sum the measurements of the processes in each job or container
+
+        PIDs and cgroups change with every process, so as dimensions would
+        start new series for each one. Processes are instead grouped by
+        Slurm job or container, with other processes grouped together.
+        """
+        groups = collections.OrderedDict()
+        for process in sorted(processes, key=lambda p: p['pid']):
+            resolved = self._process_resolver.resolve(process['pid'])
+            key = tuple((name, resolved[name])
+                        for name in ('slurm_job_id', 'container_id')
+                        if name in resolved)
+            group = groups.setdefault(key, {
+                'measurements': collections.OrderedDict(),
+                'pids': [],
+                'cgroups': []})
+            group['pids'].append(str(process['pid']))
+            cgroup = resolved.get('cgroup')
+            if cgroup and cgroup not in group['cgroups']:
+                group['cgroups'].append(cgroup)
+            for measurement, value in process.items():
+                if measurement == 'pid':
+                    continue
+                group['measurements'][measurement] = (
+                    group['measurements'].get(measurement, 0) + value)
+        return groups
+
+    @staticmethod
+    def _join_value_meta(values):
+        joined = ','.join(values)
+        if len(joined) > _MAX_VALUE_META_LENGTH:
+            joined = joined[:_MAX_VALUE_META_LENGTH - 4] + ',...'
+        return joined
+
+    def _send_process_metrics(self, gpu_metrics):
+        processes = gpu_metrics.get('processes', [])
+        for key, group in self._group_processes(processes).items():
+            dimensions = dict(gpu_metrics.get('dimensions'))
+            dimensions.update(key)
+            value_meta = {'pids': Nvidia._join_value_meta(group['pids'])}
+            if group['cgroups']:
+                value_meta['cgroups'] = Nvidia._join_value_meta(
+                    group['cgroups'])
+            for measurement, value in group['measurements'].items():
+                metric_name = '{0}.process.{1}'.format(
+                    _METRIC_NAME_PREFIX, measurement)
+                self.gauge(metric_name,
+                           value,
+                           device_name=gpu_metrics.get('name'),
+                           dimensions=dimensions,
+                           value_meta=value_meta)
+
+    def _send_collector_metrics(self, instance):
+        skipped = self._unsupported_queries.pop_skipped()
+        log.debug('Skipped {} unsupported NVML queries'.format(skipped))
+        dimensions = self._set_dimensions(None, instance)
+        self.gauge('{0}.collector.unsupported_queries'.format(
+            _METRIC_NAME_PREFIX),
+            len(self._unsupported_queries.queries),
+            dimensions=dimensions)
+        self.gauge('{0}.collector.skipped_queries'.format(
+            _METRIC_NAME_PREFIX),
+            skipped,
+            dimensions=dimensions)
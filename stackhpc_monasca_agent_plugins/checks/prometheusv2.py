@@ -14,65 +14,14 @@
 # under the License.
 
 import copy
-import math
-import re
-from collections import defaultdict
 
 import monasca_agent.collector.checks as checks
 from prometheus_client.parser import text_string_to_metric_families
 import requests
 import yaml
 
-
-class MetricStore(object):
-    def __init__(self, whitelist=None, label_whitelist=None):
-        self.metrics = defaultdict(lambda: defaultdict(list))
-        # This whitelist is a list of regexes hence why we don't use a set
-        self.whitelist_regex = ('(?:' + ')|(?:'.join(whitelist) + ')'
-                                if whitelist else None)
-        self.label_whitelist = (set(label_whitelist)
-                                if label_whitelist else None)
-
-    def add_sample(self, name, metric_type, value, labels={}, timestamp=None):
-        sample = {'labels': labels, 'value': value, 'timestamp': timestamp}
-        self.metrics[name]['samples'].append(sample)
-
-        # Let this be set once and error if it doesn't match?
-        self.metrics[name]['type'] = metric_type
-
-    def get_samples(self, name):
-        return self.metrics.get(name, {}).get('samples', {})
-
-    def get_type(self, name):
-        metric = self.metrics.get(name)
-        return metric['type'] if metric else None
-
-    def set_type(self, name, metric_type):
-        metric = self.metrics.get(name)
-        if metric:
-            metric['type'] = metric_type
-
-    def get_metrics(self):
-        metrics_list = []
-        for metric_name, metric in self.metrics.items():
-            if self.whitelist_regex and not re.match(
-                    self.whitelist_regex, metric_name):
-                # Filter out metric
-                continue
-            for sample in metric.get('samples'):
-                # Filter labels
-                if self.label_whitelist:
-                    labels = {k: v for k, v in sample['labels'].items(
-                    ) if k in self.label_whitelist}
-                else:
-                    labels = sample['labels']
-                metric = {'name': metric_name,
-                          'value': sample['value'],
-                          'dimensions': labels,
-                          'timestamp': sample['timestamp'],
-                          'type': metric['type']}
-                metrics_list.append(metric)
-        return metrics_list
+from stackhpc_monasca_agent_plugins.common import instrumentation
+from stackhpc_monasca_agent_plugins.common import prometheus
 
 
 class PrometheusV2(checks.AgentCheck):
@@ -83,8 +32,17 @@ class PrometheusV2(checks.AgentCheck):
         super(PrometheusV2, self).__init__(
             name, init_config, agent_config, instances)
         self.connection_timeout = init_config.get("timeout", 3)
+        self._instrumentation = instrumentation.CheckInstrumentation(
+            'prometheusv2')
 
     def check(self, instance):
+        with self._instrumentation.run(instance):
+            self._check(instance)
+        self._instrumentation.send_metrics(
+            self, self._set_dimensions(None, instance),
+            instance.get('name', instance.get('metric_endpoint')))
+
+    def _check(self, instance):
         dimensions = self._set_dimensions(None, instance)
         if instance.get("remove_hostname"):
             del dimensions['hostname']
@@ -102,8 +60,9 @@ class PrometheusV2(checks.AgentCheck):
         # TODO: member var instance
 
         try:
-            result = requests.get(instance['metric_endpoint'],
-                                  timeout=self.connection_timeout)
+            with self._instrumentation.stage('fetch'):
+                result = requests.get(instance['metric_endpoint'],
+                                      timeout=self.connection_timeout)
         except Exception as e:
             self.log.error(
                 "Could not get metrics from {} with error {}".format(
@@ -129,44 +88,20 @@ class PrometheusV2(checks.AgentCheck):
                         result_content_type))
 
     def _send_metrics(self, metric_families, dimensions, instance):
-        metrics = MetricStore(whitelist=instance.get('whitelist'),
-                              label_whitelist=instance.get('label_whitelist'))
-        self._parse_metrics(metrics, metric_families)
-        self._compute_derived_metrics(metrics, instance)
-        self._write_out_metrics(metrics, dimensions, instance)
+        metrics = prometheus.MetricStore(
+            whitelist=instance.get('whitelist'),
+            label_whitelist=instance.get('label_whitelist'))
+        # The metric families are parsed as they are read
+        with self._instrumentation.stage('parse'):
+            self._parse_metrics(metrics, metric_families)
+        with self._instrumentation.stage('derive'):
+            self._compute_derived_metrics(metrics, instance)
+        with self._instrumentation.stage('emit'):
+            self._write_out_metrics(metrics, dimensions, instance)
 
     def _parse_metrics(self, metric_store, metric_families):
         """Load metrics into a store which can be queried later"""
-        for metric_family in metric_families:
-            for metric in metric_family.samples:
-                metric_name = metric.name
-                metric_labels = metric.labels
-                metric_value = float(metric.value)
-                metric_timestamp = metric.timestamp
-
-                if PrometheusV2._skip_metric(metric_value):
-                    self.log.debug(
-                        'Filtered out metric with NaN value %s{%s}',
-                        metric_name,
-                        metric_labels)
-                    continue
-
-                metric_dimensions = PrometheusV2._labels_to_dimensions(
-                    metric_labels)
-                metric_store.add_sample(metric_name,
-                                        metric_family.type,
-                                        metric_value,
-                                        metric_dimensions,
-                                        metric_timestamp)
-
-    @staticmethod
-    def _skip_metric(metric_value):
-        return True if math.isnan(metric_value) else False
-
-    @staticmethod
-    def _labels_to_dimensions(labels):
-        # TODO: Check if we could create invalid dimensions from the labels
-        return {k: v for k, v in labels.items() if len(v) > 0}
+        prometheus.parse_metrics(metric_store, metric_families)
 
     def _lookup_metric_type(self, metric_name, metrics):
         metric_type = metrics.get_type(metric_name)
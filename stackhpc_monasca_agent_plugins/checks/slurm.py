@@ -13,17 +13,36 @@
 # under the License.
 
 import copy
+import errno
+import fcntl
 import logging
+import math
 import re
+import time
+from collections import defaultdict
 
 import monasca_agent.collector.checks as checks
 from monasca_agent.common.util import timeout_command
+import requests
 
+from stackhpc_monasca_agent_plugins.common import instrumentation
 
 log = logging.getLogger(__name__)
 
 _METRIC_NAME_PREFIX = "slurm"
 _METRIC_NAME = "job_status"
+_QUEUE_METRIC_NAME_PREFIX = "queue"
+_NODE_METRIC_NAME_PREFIX = "node"
+
+_BACKEND_SCONTROL = 'scontrol'
+_BACKEND_SLURMRESTD = 'slurmrestd'
+
+_SLURMRESTD_DEFAULT_ENDPOINT = 'http://localhost:6820'
+_SLURMRESTD_DEFAULT_API_VERSION = 'v0.0.39'
+# The job list is fetched in full at least this often, in case a change is
+# missed. For example, an empty list is returned both when nothing changed
+# and when the last job has been purged.
+_SLURMRESTD_FULL_REFRESH_SECONDS = 300
 
 _SLURM_LIST_JOBS_CMD = ['/usr/bin/scontrol', '-o', 'show', 'job']
 _SLURM_LIST_NODES_CMD = ['/usr/bin/scontrol', '-o', 'show', 'node']
@@ -31,13 +50,304 @@ _SLURM_LIST_NODES_CMD = ['/usr/bin/scontrol', '-o', 'show', 'node']
 _SLURM_JOB_FIELD_REGEX = (r'^JobId=([\d]+)\sJobName=(.*?)\sUserI'
                           r'd=([\w-]+\([\w-]+\)) GroupId=([\w-]+\([\w-]+\))\s.'
                           r'*JobState=([\w]+)\s.*\sNodeList=(.*?)\s.*$')
-_SLURM_NODE_FIELD_REGEX = r'^NodeName=(.*?)\s.*State=(.*?)\s.*$'
+_SLURM_JOB_QUEUE_FIELD_REGEX = (r'\sReason=(\S+)\s.*?\sSubmitTime=(\S+)\s'
+                                r'.*?\sPartition=(\S+)\s')
+# Splits a line of scontrol output into alternating keys and values. Keys
+# must follow whitespace, so nested values such as TRES=cpu=1,mem=1G and
+# values containing spaces are kept intact.
+_SLURM_FIELD_TOKENIZER = re.compile(r'(?:^|\s)([\w:/]+)=')
+# Counts of GPUs in a generic resource list, such as gpu:4 or
+# gpu:tesla:2(IDX:0-1),mps:100
+_SLURM_GRES_GPU_REGEX = re.compile(r'(?:^|,)gpu(?::[^:(,]+)?:(\d+)')
 _SLURM_NODE_SEQUENCE_REGEX = r'^(.*)\[(.*)\]$'
+_SLURM_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# Fields which can change during the lifetime of a job. A job is only parsed
+# again when one of these changes. Note the leading space, which avoids
+# matching ReqNodeList and ExcNodeList.
+_SLURM_JOB_CHANGE_FIELDS = (' JobState=', ' Reason=', ' NodeList=',
+                            ' Partition=')
+
+# Jobs in these states have left the system and are not reported
+_SLURM_FINISHED_JOB_STATES = ('BOOT_FAIL', 'CANCELLED', 'COMPLETED',
+                              'DEADLINE', 'FAILED', 'NODE_FAIL',
+                              'OUT_OF_MEMORY', 'PREEMPTED', 'TIMEOUT')
+
+# Pending jobs held by these reasons will not start until released, so they
+# are counted separately and excluded from the wait time statistics.
+_SLURM_HELD_REASONS = ('JobHeldUser', 'JobHeldAdmin')
+
+# Wait time quantiles reported for each partition
+_WAIT_TIME_QUANTILES = [('p50', 0.5), ('p95', 0.95)]
+
+
+def _count_gpus(gres):
+    if not gres:
+        return 0
+    return sum(int(count) for count in _SLURM_GRES_GPU_REGEX.findall(gres))
+
+
+def _node_record(node_state, cpus_allocated=None, cpus_total=None,
+                 cpu_load=None, memory_allocated_mb=None,
+                 memory_total_mb=None, gres=None, gres_used=None):
+    return {
+        'node_state': node_state,
+        'cpus_allocated': cpus_allocated,
+        'cpus_total': cpus_total,
+        'cpu_load': cpu_load,
+        'memory_allocated_mb': memory_allocated_mb,
+        'memory_total_mb': memory_total_mb,
+        'gpus_allocated': _count_gpus(gres_used),
+        'gpus_total': _count_gpus(gres),
+    }
+
+
+class _QuantileSketch(object):
+    """Streaming quantile estimator with bounded relative error
+
+    Values are counted in buckets whose boundaries grow geometrically, so
+    memory is proportional to the logarithm of the range of values added
+    rather than to the number of values. Any quantile is returned within
+    `relative_accuracy` of the true value.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = defaultdict(int)
+        self.zero_count = 0
+        self.count = 0
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        if self.max is None or value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zero_count += 1
+            return
+        self.buckets[int(math.ceil(math.log(value) / self._log_gamma))] += 1
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                # Return the midpoint of the bucket, which is within the
+                # relative accuracy of every value counted in it.
+                return min(2 * self.gamma ** key / (self.gamma + 1),
+                           self.max)
+        return self.max
+
+
+class _SlurmRestClient(object):
+    """Queries slurmrestd over a persistent HTTP session
+
+    The session is kept between checks, so the connection to slurmrestd is
+    reused rather than forking scontrol and authenticating with munge on
+    every check. Jobs are requested with the time of the previous listing,
+    so that slurmrestd only sends them if something changed.
+    """
+
+    def __init__(self, endpoint, api_version=_SLURMRESTD_DEFAULT_API_VERSION,
+                 user=None, token=None, token_file=None, timeout=10):
+        self.base_url = '{0}/slurm/{1}'.format(endpoint.rstrip('/'),
+                                               api_version)
+        self.user = user
+        self.token = token
+        self.token_file = token_file
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=1)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._job_records = None
+        self._jobs_update_time = None
+        self._jobs_full_refresh_time = None
+
+    def close(self):
+        self.session.close()
+
+    def _get_token(self):
+        if self.token_file:
+            # Re-read the token each time so that it can be rotated
+            with open(self.token_file) as f:
+                return f.read().strip()
+        return self.token
+
+    def _get(self, path, params=None):
+        headers = {}
+        if self.user:
+            headers['X-SLURM-USER-NAME'] = self.user
+        token = self._get_token()
+        if token:
+            headers['X-SLURM-USER-TOKEN'] = token
+        url = self.base_url + path
+        try:
+            response = self.session.get(url, params=params, headers=headers,
+                                        timeout=self.timeout)
+            response.raise_for_status()
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise Exception('Failed to query slurmrestd at {0}, error: {1}.'
+                            .format(url, e))
+        if data.get('errors'):
+            raise Exception('Failed to query slurmrestd at {0}, error: {1}.'
+                            .format(url, data['errors']))
+        return data
+
+    @staticmethod
+    def _number(field):
+        # From v0.0.39 numbers are wrapped in an object with flags
+        if isinstance(field, dict):
+            return field.get('number') if field.get('set', True) else None
+        return field
+
+    @staticmethod
+    def _state(field, flags=True):
+        # From v0.0.39 states are a list with the base state first, followed
+        # by any flags. Join them in the same way as scontrol.
+        if isinstance(field, list):
+            return '+'.join(field) if flags else field[0]
+        return field
+
+    @staticmethod
+    def _to_job_record(job):
+        job_state = _SlurmRestClient._state(job.get('job_state'), flags=False)
+        if job_state in _SLURM_FINISHED_JOB_STATES:
+            return None
+        record = {
+            'job_id': str(job['job_id']),
+            'job_name': job.get('name'),
+            'user_id': job.get('user_name'),
+            'user_group': job.get('group_name'),
+            'job_state': job_state,
+            'node_list': job.get('nodes') or '(null)',
+        }
+        if job_state == 'PENDING':
+            record['reason'] = job.get('state_reason')
+            record['submit_time'] = float(
+                _SlurmRestClient._number(job.get('submit_time')))
+            record['partition'] = job.get('partition')
+        return record
+
+    def get_job_records(self):
+        now = time.time()
+        params = None
+        if self._job_records is not None:
+            since_refresh = now - self._jobs_full_refresh_time
+            if since_refresh < _SLURMRESTD_FULL_REFRESH_SECONDS:
+                params = {'update_time': int(self._jobs_update_time)}
+        data = self._get('/jobs', params)
+        jobs = data.get('jobs') or []
+        if params and not jobs:
+            # Nothing has changed since the last listing
+            return self._job_records
+        if not params:
+            self._jobs_full_refresh_time = now
+        self._jobs_update_time = (
+            _SlurmRestClient._number(data.get('last_update')) or now)
+        records = (_SlurmRestClient._to_job_record(job) for job in jobs)
+        self._job_records = [record for record in records if record]
+        return self._job_records
+
+    def get_nodes(self):
+        nodes = {}
+        for node in self._get('/nodes').get('nodes') or []:
+            cpu_load = _SlurmRestClient._number(node.get('cpu_load'))
+            nodes[node['name']] = _node_record(
+                _SlurmRestClient._state(node.get('state')),
+                cpus_allocated=node.get('alloc_cpus'),
+                cpus_total=node.get('cpus'),
+                # The load is reported multiplied by 100
+                cpu_load=cpu_load / 100.0 if cpu_load is not None else None,
+                memory_allocated_mb=node.get('alloc_memory'),
+                memory_total_mb=node.get('real_memory'),
+                gres=node.get('gres'),
+                gres_used=node.get('gres_used'))
+        return nodes
 
 
 class Slurm(checks.AgentCheck):
     def __init__(self, name, init_config, agent_config):
         super(Slurm, self).__init__(name, init_config, agent_config)
+        # Open lock files, keyed by path, which elect this agent as the
+        # cluster collector for as long as they are held.
+        self._collector_locks = {}
+        # Parsed job records keyed by job ID
+        self._job_cache = {}
+        # Clients for the slurmrestd backend, keyed by endpoint
+        self._rest_clients = {}
+        self._instrumentation = instrumentation.CheckInstrumentation('slurm')
+
+    def stop(self):
+        for lock_file in self._collector_locks.values():
+            lock_file.close()
+        self._collector_locks = {}
+        for client in self._rest_clients.values():
+            client.close()
+        self._rest_clients = {}
+
+    def _get_rest_client(self, instance):
+        endpoint = instance.get('slurmrestd_endpoint',
+                                _SLURMRESTD_DEFAULT_ENDPOINT)
+        client = self._rest_clients.get(endpoint)
+        if client is None:
+            client = _SlurmRestClient(
+                endpoint,
+                api_version=instance.get('slurmrestd_api_version',
+                                         _SLURMRESTD_DEFAULT_API_VERSION),
+                user=instance.get('slurmrestd_user'),
+                token=instance.get('slurmrestd_token'),
+                token_file=instance.get('slurmrestd_token_file'),
+                timeout=instance.get('timeout', 10))
+            self._rest_clients[endpoint] = client
+        return client
+
+    def _acquire_collector_lock(self, lock_path):
+        """Try to become the cluster collector by locking a shared file
+
+        The lock is held until the agent stops, so that the collector only
+        changes if the agent holding the lock goes away. The lock file must
+        be on a filesystem shared by all agents which supports locking.
+        """
+        if lock_path in self._collector_locks:
+            return True
+        lock_file = open(lock_path, 'a+')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            lock_file.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        # Record which agent holds the lock to help with debugging
+        lock_file.truncate(0)
+        lock_file.write('{0}\n'.format(self.hostname))
+        lock_file.flush()
+        self._collector_locks[lock_path] = lock_file
+        log.info('Elected as the Slurm cluster collector using lock file '
+                 '{0}'.format(lock_path))
+        return True
+
+    def _get_cluster_collector(self, instance):
+        """Decide whether this agent collects metrics for the cluster
+
+        Returns None if no collector is configured, in which case every agent
+        queries Slurm and reports metrics with its own hostname. Otherwise
+        returns True if this agent is the collector, and False if it should
+        leave querying Slurm to another agent.
+        """
+        lock_path = instance.get('cluster_collector_lock')
+        if lock_path:
+            return self._acquire_collector_lock(lock_path)
+        return instance.get('cluster_collector')
 
     @staticmethod
     def _get_raw_data(cmd, timeout=10):
@@ -93,42 +403,273 @@ class Slurm(checks.AgentCheck):
         """
         return re.sub(r'[(\d+)]', '', field)
 
-    def _get_jobs(self):
-        raw_job_data = self._get_raw_job_data()
-        pattern = re.compile(_SLURM_JOB_FIELD_REGEX)
-        jobs = {}
+    @staticmethod
+    def _parse_time(field):
+        return time.mktime(time.strptime(field, _SLURM_TIME_FORMAT))
+
+    @staticmethod
+    def _get_job_id(job):
+        if not job.startswith('JobId='):
+            # If there are no jobs there will be no job ID
+            return None
+        return job[len('JobId='):job.find(' ')]
+
+    @staticmethod
+    def _get_field(job, key):
+        """Cheaply extract a single space delimited field from a job"""
+        start = job.find(key)
+        if start < 0:
+            return None
+        start += len(key)
+        end = job.find(' ', start)
+        return job[start:end] if end >= 0 else job[start:]
+
+    @staticmethod
+    def _parse_job(job):
+        m = re.match(_SLURM_JOB_FIELD_REGEX, job)
+        if not m or m.group(5) in _SLURM_FINISHED_JOB_STATES:
+            return None
+        record = {
+            'job_id': m.group(1),
+            'job_name': m.group(2),
+            'user_id': Slurm._extract_name(m.group(3)),
+            'user_group': Slurm._extract_name(m.group(4)),
+            'job_state': m.group(5),
+            'node_list': m.group(6),
+        }
+        if record['job_state'] == 'PENDING':
+            q = re.search(_SLURM_JOB_QUEUE_FIELD_REGEX, job)
+            if q:
+                record['reason'] = q.group(1)
+                record['submit_time'] = Slurm._parse_time(q.group(2))
+                record['partition'] = q.group(3)
+        return record
+
+    def _parse_jobs(self):
+        """Parse the raw job data into a list of job records
+
+        Records are cached by job ID and a job is only parsed again when one
+        of the fields which change during its lifetime has changed. The cost
+        of parsing is then proportional to the number of jobs which changed
+        since the last check, rather than to the number of jobs in the
+        system. Finished jobs are not reported, and are evicted from the
+        cache once Slurm stops listing them.
+        """
+        with self._instrumentation.stage('subprocess'):
+            raw_job_data = self._get_raw_job_data()
+        job_cache = {}
+        job_records = []
         for job in raw_job_data:
-            m = pattern.match(job)
-            if not m:
-                # If there are no jobs there will be no match
+            job_id = Slurm._get_job_id(job)
+            if job_id is None:
                 continue
-            job = {
-                'job_id': m.group(1),
-                'job_name': m.group(2),
-                'user_id': Slurm._extract_name(m.group(3)),
-                'user_group': Slurm._extract_name(m.group(4)),
-                'job_state': m.group(5),
-            }
-            if 'RUNNING' in job['job_state']:
-                # Ignore pending jobs for now
-                nodes = self._extract_node_names(m.group(6))
+            fingerprint = tuple(Slurm._get_field(job, key)
+                                for key in _SLURM_JOB_CHANGE_FIELDS)
+            cached = self._job_cache.get(job_id)
+            if cached and cached[0] == fingerprint:
+                record = cached[1]
+            else:
+                record = Slurm._parse_job(job)
+            # Finished jobs are cached without a record, so they are skipped
+            # without being parsed for as long as they are listed.
+            job_cache[job_id] = (fingerprint, record)
+            if record:
+                job_records.append(record)
+        self._job_cache = job_cache
+        return job_records
+
+    def _get_jobs(self, job_records=None):
+        if job_records is None:
+            job_records = self._parse_jobs()
+        jobs = {}
+        for record in job_records:
+            if 'RUNNING' in record['job_state']:
+                job = {k: record[k] for k in ('job_id', 'job_name', 'user_id',
+                                              'user_group', 'job_state')}
+                nodes = self._extract_node_names(record['node_list'])
                 for node in nodes:
                     # TODO: Nodes could have multiple jobs
                     jobs[node] = copy.deepcopy(job)
         return jobs
 
+    def _get_queue_stats(self, job_records, now=None):
+        """Summarise pending jobs for each partition
+
+        Wait times are accumulated in a quantile sketch so that the cost of
+        the summary does not depend on how deep the queue is.
+        """
+        now = time.time() if now is None else now
+        stats = {}
+        for record in job_records:
+            if record['job_state'] != 'PENDING' or 'partition' not in record:
+                continue
+            wait_time = max(now - record['submit_time'], 0.0)
+            held = record['reason'] in _SLURM_HELD_REASONS
+            # Pending jobs may be queued against more than one partition
+            for partition in record['partition'].split(','):
+                queue = stats.get(partition)
+                if queue is None:
+                    queue = {'pending': 0, 'held': 0,
+                             'wait_time': _QuantileSketch()}
+                    stats[partition] = queue
+                if held:
+                    queue['held'] += 1
+                else:
+                    queue['pending'] += 1
+                    queue['wait_time'].add(wait_time)
+        return stats
+
+    def _send_queue_metrics(self, queue_stats, instance,
+                            cluster_collector=None):
+        metric_prefix = '{0}.{1}'.format(_METRIC_NAME_PREFIX,
+                                         _QUEUE_METRIC_NAME_PREFIX)
+        for partition, queue in queue_stats.items():
+            dimensions = self._set_dimensions({'partition': partition},
+                                              instance)
+            hostname = None
+            if cluster_collector:
+                # Queues belong to the cluster rather than to the host which
+                # happens to be the collector. The aggregator adds the
+                # agent's hostname back unless it is suppressed.
+                dimensions.pop('hostname', None)
+                hostname = 'SUPPRESS'
+            self.gauge('{0}.pending_jobs'.format(metric_prefix),
+                       float(queue['pending']),
+                       dimensions=dimensions,
+                       hostname=hostname)
+            self.gauge('{0}.held_jobs'.format(metric_prefix),
+                       float(queue['held']),
+                       dimensions=dimensions,
+                       hostname=hostname)
+            wait_time = queue['wait_time']
+            if not wait_time.count:
+                continue
+            for name, q in _WAIT_TIME_QUANTILES:
+                self.gauge('{0}.wait_time_{1}_seconds'.format(
+                    metric_prefix, name),
+                    wait_time.quantile(q),
+                    dimensions=dimensions,
+                    hostname=hostname)
+            self.gauge('{0}.wait_time_max_seconds'.format(metric_prefix),
+                       wait_time.max,
+                       dimensions=dimensions,
+                       hostname=hostname)
+            log.debug('Collected slurm queue statistics for partition '
+                      '{0}'.format(partition))
+
+    @staticmethod
+    def _tokenize(line):
+        """Split a line of scontrol output into a dict of fields"""
+        tokens = _SLURM_FIELD_TOKENIZER.split(line.strip())
+        return {k: v.strip() for k, v in zip(tokens[1::2], tokens[2::2])}
+
+    @staticmethod
+    def _to_number(field, cast=int):
+        try:
+            return cast(field)
+        except (TypeError, ValueError):
+            # For example, the CPU load of a node which is down is N/A
+            return None
+
     def _get_nodes(self):
-        raw_node_data = self._get_raw_node_data()
-        pattern = re.compile(_SLURM_NODE_FIELD_REGEX)
+        with self._instrumentation.stage('subprocess'):
+            raw_node_data = self._get_raw_node_data()
         nodes = {}
         for node in raw_node_data:
-            m = pattern.match(node)
-            nodes[m.group(1)] = {'node_state': m.group(2)}
+            fields = Slurm._tokenize(node)
+            if 'NodeName' not in fields:
+                continue
+            nodes[fields['NodeName']] = _node_record(
+                fields.get('State'),
+                cpus_allocated=Slurm._to_number(fields.get('CPUAlloc')),
+                cpus_total=Slurm._to_number(fields.get('CPUTot')),
+                cpu_load=Slurm._to_number(fields.get('CPULoad'), float),
+                memory_allocated_mb=Slurm._to_number(fields.get('AllocMem')),
+                memory_total_mb=Slurm._to_number(fields.get('RealMemory')),
+                gres=fields.get('Gres'),
+                gres_used=fields.get('GresUsed'))
         return nodes
 
+    @staticmethod
+    def _get_node_utilisation(node):
+        """Compute allocation and efficiency gauges for a node"""
+        utilisation = {}
+        for resource, unit in (('cpus', ''), ('memory', '_mb'),
+                               ('gpus', '')):
+            allocated = node['{0}_allocated{1}'.format(resource, unit)]
+            total = node['{0}_total{1}'.format(resource, unit)]
+            if allocated is None or not total:
+                continue
+            utilisation['{0}_allocated{1}'.format(resource, unit)] = (
+                float(allocated))
+            utilisation['{0}_total{1}'.format(resource, unit)] = float(total)
+            utilisation['{0}_allocated_percent'.format(resource)] = (
+                100.0 * allocated / total)
+        cpu_load = node['cpu_load']
+        if cpu_load is not None:
+            utilisation['cpu_load'] = cpu_load
+            # How busy the allocated CPUs are kept by the jobs using them
+            if node['cpus_allocated']:
+                utilisation['cpu_efficiency_percent'] = (
+                    100.0 * cpu_load / node['cpus_allocated'])
+        return utilisation
+
+    def _is_own_node(self, node):
+        # Slurm node names are usually short hostnames
+        return node in (self.hostname, self.hostname.split('.')[0])
+
+    def _send_node_metrics(self, node, node_info, instance,
+                           cluster_collector=None):
+        if not cluster_collector and not self._is_own_node(node):
+            # Without a collector every agent sees every node, so each only
+            # reports its own to avoid duplicating the series of the others.
+            return
+        dimensions = self._set_dimensions({}, instance)
+        if cluster_collector:
+            dimensions['hostname'] = node
+        for measurement, value in sorted(
+                Slurm._get_node_utilisation(node_info).items()):
+            self.gauge('{0}.{1}.{2}'.format(_METRIC_NAME_PREFIX,
+                                            _NODE_METRIC_NAME_PREFIX,
+                                            measurement),
+                       value,
+                       device_name=node,
+                       dimensions=dimensions)
+
     def check(self, instance):
-        jobs = self._get_jobs()
-        for node in self._get_nodes():
+        cluster_collector = self._get_cluster_collector(instance)
+        if cluster_collector is False:
+            log.debug('Not the Slurm cluster collector, skipping check')
+            return
+        with self._instrumentation.run(instance):
+            self._check(instance, cluster_collector)
+        self._instrumentation.send_metrics(
+            self, self._set_dimensions({}, instance), instance.get('name'))
+
+    def _check(self, instance, cluster_collector):
+        backend = instance.get('backend', _BACKEND_SCONTROL)
+        if backend == _BACKEND_SLURMRESTD:
+            client = self._get_rest_client(instance)
+            with self._instrumentation.stage('fetch'):
+                job_records = client.get_job_records()
+                nodes = client.get_nodes()
+        elif backend == _BACKEND_SCONTROL:
+            with self._instrumentation.stage('parse'):
+                job_records = self._parse_jobs()
+                nodes = self._get_nodes()
+        else:
+            log.error('Unsupported Slurm backend: {0}'.format(backend))
+            return
+        with self._instrumentation.stage('parse'):
+            jobs = self._get_jobs(job_records)
+            queue_stats = self._get_queue_stats(job_records)
+        with self._instrumentation.stage('emit'):
+            self._send_metrics(instance, cluster_collector, jobs, nodes,
+                               queue_stats)
+
+    def _send_metrics(self, instance, cluster_collector, jobs, nodes,
+                      queue_stats):
+        for node, node_info in nodes.items():
             metric_name = '{0}.{1}'.format(_METRIC_NAME_PREFIX, _METRIC_NAME)
             job_info = jobs.get(node, {})
             # TODO - If node is down set to -1?
@@ -139,9 +680,14 @@ class Slurm(checks.AgentCheck):
                 'job_name': job_info.pop(
                     'job_name')} if 'job_name' in job_info else {}
             dimensions = self._set_dimensions(job_info, instance)
+            if cluster_collector:
+                dimensions['hostname'] = node
             self.gauge(metric_name,
                        metric_value,
                        device_name=node,
                        dimensions=dimensions,
                        value_meta=value_meta)
+            self._send_node_metrics(node, node_info, instance,
+                                    cluster_collector)
             log.debug('Collected slurm status for node {0}'.format(node))
+        self._send_queue_metrics(queue_stats, instance, cluster_collector)
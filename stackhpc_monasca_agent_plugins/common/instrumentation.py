@@ -0,0 +1,169 @@
+# Copyright (c) 2018 StackHPC Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Measures where the time of a check goes
+
+The agent only reports how long each check takes as a whole. A check using
+CheckInstrumentation times the stages of each run, such as fetching and
+parsing, and posts the results as <plugin>.collector.* metrics. The
+following instance options enable more expensive measurements:
+
+* collector_trace_allocations: trace the memory allocated by each run with
+  tracemalloc.
+* collector_profile_path: profile the first run, and every
+  collector_profile_interval runs after it, with cProfile, and dump the
+  statistics to this file.
+"""
+
+import cProfile
+import collections
+import contextlib
+import functools
+import logging
+import threading
+import time
+import tracemalloc
+
+log = logging.getLogger(__name__)
+
+_DEFAULT_PROFILE_INTERVAL = 10
+
+
+class CheckInstrumentation(object):
+    """Times the stages of the runs of a check
+
+    Stages may be nested, in which case the time spent in the inner stage
+    is only counted against the inner stage. Stages may run concurrently in
+    several threads, for example one for each device, in which case their
+    times are summed.
+    """
+
+    def __init__(self, plugin_name):
+        self.plugin_name = plugin_name
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Seconds spent in each stage of the current run
+        self._stages = collections.OrderedDict()
+        # Measurements of the last run, keyed by metric name
+        self.last_run = {}
+        # Number of runs of each instance, keyed by instance name
+        self._runs = collections.Counter()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stack = self._stack()
+        # The time spent in nested stages
+        frame = [0.0]
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            if stack:
+                stack[-1][0] += elapsed
+            exclusive = elapsed - frame[0]
+            with self._lock:
+                self._stages[name] = self._stages.get(name, 0.0) + exclusive
+
+    def timed(self, name, func):
+        """Wrap a function so that each call is timed as a stage"""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def _start_profile(self, instance, run):
+        path = instance.get('collector_profile_path')
+        interval = instance.get('collector_profile_interval',
+                                _DEFAULT_PROFILE_INTERVAL)
+        if not path or (run - 1) % interval:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Another profiler is active
+            log.warning('Could not profile {}: {}'.format(
+                self.plugin_name, e))
+            return None
+        return profile
+
+    def _stop_profile(self, profile, path):
+        profile.disable()
+        try:
+            profile.dump_stats(path)
+        except (IOError, OSError) as e:
+            log.warning('Could not write {} profile to {}: {}'.format(
+                self.plugin_name, path, e))
+
+    @contextlib.contextmanager
+    def run(self, instance):
+        """Measure a run of the check for an instance"""
+        self._runs[instance.get('name', '')] += 1
+        run = self._runs[instance.get('name', '')]
+        with self._lock:
+            self._stages = collections.OrderedDict()
+        trace_allocations = instance.get('collector_trace_allocations')
+        started_tracing = False
+        if trace_allocations:
+            # Leave tracing alone if something else started it
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start()
+            elif hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            traced_before, _ = tracemalloc.get_traced_memory()
+        profile = self._start_profile(instance, run)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if profile:
+                self._stop_profile(profile,
+                                   instance['collector_profile_path'])
+            last_run = {'check_seconds': elapsed}
+            with self._lock:
+                for name, seconds in self._stages.items():
+                    last_run['{}_seconds'.format(name)] = seconds
+            if trace_allocations:
+                traced, peak = tracemalloc.get_traced_memory()
+                if started_tracing:
+                    tracemalloc.stop()
+                last_run['allocated_bytes'] = traced - traced_before
+                last_run['peak_allocated_bytes'] = peak - traced_before
+            self.last_run = last_run
+
+    def send_metrics(self, check, dimensions, instance_name=None):
+        """Post the measurements of the last run as gauges
+
+        The instance name, if given, is added as the check_instance
+        dimension, so that instances which differ only in their
+        configuration, such as several exporters scraped from one host,
+        are told apart.
+        """
+        if instance_name:
+            dimensions = dict(dimensions, check_instance=instance_name)
+        for name, value in self.last_run.items():
+            check.gauge('{0}.collector.{1}'.format(self.plugin_name, name),
+                        value,
+                        dimensions=dimensions)
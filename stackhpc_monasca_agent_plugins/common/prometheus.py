@@ -0,0 +1,110 @@
+# Copyright 2019 StackHPC Ltd.
+# Copyright 2017-2018 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Parses metrics in the Prometheus text format
+
+Shared by the checks which scrape Prometheus endpoints, such as the
+prometheusv2 check and the dcgm_exporter backend of the nvidia check.
+"""
+
+from collections import defaultdict
+import logging
+import math
+import re
+
+log = logging.getLogger(__name__)
+
+
+class MetricStore(object):
+    def __init__(self, whitelist=None, label_whitelist=None):
+        self.metrics = defaultdict(lambda: defaultdict(list))
+        # This whitelist is a list of regexes hence why we don't use a set
+        self.whitelist_regex = ('(?:' + ')|(?:'.join(whitelist) + ')'
+                                if whitelist else None)
+        self.label_whitelist = (set(label_whitelist)
+                                if label_whitelist else None)
+
+    def add_sample(self, name, metric_type, value, labels={}, timestamp=None):
+        sample = {'labels': labels, 'value': value, 'timestamp': timestamp}
+        self.metrics[name]['samples'].append(sample)
+
+        # Let this be set once and error if it doesn't match?
+        self.metrics[name]['type'] = metric_type
+
+    def get_samples(self, name):
+        return self.metrics.get(name, {}).get('samples', {})
+
+    def get_type(self, name):
+        metric = self.metrics.get(name)
+        return metric['type'] if metric else None
+
+    def set_type(self, name, metric_type):
+        metric = self.metrics.get(name)
+        if metric:
+            metric['type'] = metric_type
+
+    def get_metrics(self):
+        metrics_list = []
+        for metric_name, metric in self.metrics.items():
+            if self.whitelist_regex and not re.match(
+                    self.whitelist_regex, metric_name):
+                # Filter out metric
+                continue
+            for sample in metric.get('samples'):
+                # Filter labels
+                if self.label_whitelist:
+                    labels = {k: v for k, v in sample['labels'].items(
+                    ) if k in self.label_whitelist}
+                else:
+                    labels = sample['labels']
+                metric = {'name': metric_name,
+                          'value': sample['value'],
+                          'dimensions': labels,
+                          'timestamp': sample['timestamp'],
+                          'type': metric['type']}
+                metrics_list.append(metric)
+        return metrics_list
+
+
+def skip_metric(metric_value):
+    return True if math.isnan(metric_value) else False
+
+
+def labels_to_dimensions(labels):
+    # TODO: Check if we could create invalid dimensions from the labels
+    return {k: v for k, v in labels.items() if len(v) > 0}
+
+
+def parse_metrics(metric_store, metric_families):
+    """Load metrics into a store which can be queried later"""
+    for metric_family in metric_families:
+        for metric in metric_family.samples:
+            metric_name = metric.name
+            metric_labels = metric.labels
+            metric_value = float(metric.value)
+            metric_timestamp = metric.timestamp
+
+            if skip_metric(metric_value):
+                log.debug('Filtered out metric with NaN value %s{%s}',
+                          metric_name,
+                          metric_labels)
+                continue
+
+            metric_dimensions = labels_to_dimensions(metric_labels)
+            metric_store.add_sample(metric_name,
+                                    metric_family.type,
+                                    metric_value,
+                                    metric_dimensions,
+                                    metric_timestamp)
@@ -35,9 +35,35 @@ class IBNetworkDetect(monasca_setup.detection.Plugin):
 
     def build_config(self):
         config = monasca_setup.agent_config.Plugins()
-        config['ib_network'] = {'init_config': None,
-                                'instances': [{'name': 'ib_network_stats'}]}
+        # An instance for each port, so that ports can be configured, or
+        # left out, individually
+        instances = [
+            {'name': 'ib_network_stats_{}_{}'.format(hca, port),
+             'hca': hca,
+             'port': port}
+            for hca, port in self._find_ports()]
+        config['ib_network'] = {
+            'init_config': None,
+            'instances': instances or [{'name': 'ib_network_stats'}]}
         return config
 
     def _detect_infiniband(self):
         return os.path.isdir(_IB_DEVICE_PATH)
+
+    @staticmethod
+    def _find_ports():
+        """Return the HCA and number of every InfiniBand port"""
+        ports = []
+        try:
+            hcas = sorted(os.listdir(_IB_DEVICE_PATH))
+        except (IOError, OSError):
+            return ports
+        for hca in hcas:
+            try:
+                port_numbers = os.listdir(
+                    os.path.join(_IB_DEVICE_PATH, hca, 'ports'))
+            except (IOError, OSError):
+                continue
+            for port in sorted(port_numbers, key=int):
+                ports.append((hca, port))
+        return ports
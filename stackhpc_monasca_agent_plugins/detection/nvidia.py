@@ -13,28 +13,113 @@
 # under the License.
 
 import logging
-import subprocess
+import os
 
 import monasca_setup.agent_config
 import monasca_setup.detection
 
 LOG = logging.getLogger(__name__)
 
+_PCI_DEVICES_PATH = "/sys/bus/pci/devices/"
+_NVIDIA_PCI_VENDOR_ID = "0x10de"
+# PCI display controllers, such as VGA (0x0300) and 3D (0x0302) controllers.
+# This excludes other nVidia functions such as HDMI audio and NVSwitches.
+_PCI_DISPLAY_CLASS_PREFIX = "0x03"
+_NVIDIA_DRIVER_GPUS_PATH = "/proc/driver/nvidia/gpus/"
+
+# GPUs are queried concurrently, up to this many at a time
+_MAX_COLLECTION_THREADS = 8
+
+
+def _read_sysfs_attr(path):
+    try:
+        with open(path) as attr_file:
+            return attr_file.read().strip().lower()
+    except (IOError, OSError):
+        return None
+
 
 class NvidiaDetect(monasca_setup.detection.Plugin):
     """Detects and configures nVidia plugin."""
 
     def _detect(self):
         self.available = False
-        if 'nvidia' not in subprocess.check_output(
-                ["lshw", "-C", "display"]).lower():
+        self.gpu_count = self._detect_gpus()
+        if not self.gpu_count:
             LOG.info('No nVidia hardware detected.')
             return
         self.available = True
 
     def build_config(self):
         config = monasca_setup.agent_config.Plugins()
+        instance = {'name': 'nvidia_stats'}
+        if self.gpu_count:
+            # Leave out gpus, so that every GPU is queried, including any
+            # added later. The count may include GPUs bound to vfio which
+            # NVML does not see, so only use it to size the thread pool.
+            instance['collection_threads'] = min(self.gpu_count,
+                                                 _MAX_COLLECTION_THREADS)
         config['nvidia'] = {
             'init_config': None,
-            'instances': [{'name': 'nvidia_stats'}]}
+            'instances': [instance]}
         return config
+
+    def _detect_gpus(self):
+        """Return the number of nVidia GPUs, using the cheapest probe first
+        """
+        for probe in (NvidiaDetect._count_pci_gpus,
+                      NvidiaDetect._count_driver_gpus,
+                      NvidiaDetect._count_nvml_gpus):
+            count = probe()
+            if count:
+                return count
+        return 0
+
+    @staticmethod
+    def _count_pci_gpus():
+        """Count nVidia display controllers on the PCI bus"""
+        try:
+            devices = os.listdir(_PCI_DEVICES_PATH)
+        except (IOError, OSError):
+            return 0
+        count = 0
+        for device in devices:
+            device_path = os.path.join(_PCI_DEVICES_PATH, device)
+            vendor = _read_sysfs_attr(os.path.join(device_path, 'vendor'))
+            if vendor != _NVIDIA_PCI_VENDOR_ID:
+                continue
+            pci_class = _read_sysfs_attr(os.path.join(device_path, 'class'))
+            if pci_class and pci_class.startswith(_PCI_DISPLAY_CLASS_PREFIX):
+                count += 1
+        return count
+
+    @staticmethod
+    def _count_driver_gpus():
+        """Count the GPUs known to a loaded nVidia driver"""
+        try:
+            return len(os.listdir(_NVIDIA_DRIVER_GPUS_PATH))
+        except (IOError, OSError):
+            return 0
+
+    @staticmethod
+    def _count_nvml_gpus():
+        """Count the GPUs reported by NVML, for example in a container"""
+        try:
+            from py3nvml import py3nvml as pynvml
+        except ImportError:
+            return 0
+        try:
+            pynvml.nvmlInit()
+        except Exception as err:
+            LOG.debug('Failed to initialise NVML: {}'.format(err))
+            return 0
+        try:
+            return pynvml.nvmlDeviceGetCount()
+        except Exception as err:
+            LOG.debug('Failed to count GPUs with NVML: {}'.format(err))
+            return 0
+        finally:
+            try:
+                pynvml.nvmlShutdown()
+            except Exception:
+                pass
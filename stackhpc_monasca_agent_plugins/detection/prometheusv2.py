@@ -0,0 +1,239 @@
+# Copyright (c) 2018 StackHPC Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import binascii
+import logging
+import re
+import socket
+
+import monasca_setup.agent_config
+import monasca_setup.detection
+import requests
+
+LOG = logging.getLogger(__name__)
+
+_PROC_NET_TCP_PATHS = ("/proc/net/tcp", "/proc/net/tcp6")
+_TCP_LISTEN_STATE = '0A'
+_PROBE_TIMEOUT = 3
+# The metric name is everything up to the labels or the value
+_SAMPLE_NAME_REGEX = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)')
+
+# What to ingest from each exporter. An exporter is recognised by the
+# prefix shared by its metric names, so it is found on any of the ports
+# probed. The whitelist and label_whitelist are passed to the prometheusv2
+# check. Counters are reported with a _total suffix.
+_EXPORTER_PROFILES = {
+    'ceph': {
+        'ports': (9283,),
+        'prefix': 'ceph_',
+        'whitelist': [
+            'ceph_health_status',
+            'ceph_cluster_total_(used_)?bytes',
+            'ceph_pool_(stored|max_avail|objects|percent_used)',
+            'ceph_osd_(up|in)$',
+            'ceph_osd_stat_bytes',
+            'ceph_osd_op_[rw](_total)?$',
+            'ceph_osd_op_(in|out)_bytes',
+            'ceph_pg_(active|clean|degraded|undersized|stale)',
+        ],
+        'label_whitelist': ['ceph_daemon', 'pool_id'],
+        # The metrics describe the cluster, and move with the active mgr
+        'remove_hostname': True,
+    },
+    'cadvisor': {
+        'ports': (8080, 18080),
+        'prefix': 'container_',
+        'whitelist': [
+            'container_cpu_usage_seconds_total',
+            'container_memory_(usage|working_set)_bytes',
+            'container_network_(receive|transmit)_bytes_total',
+            'container_fs_(reads|writes)_bytes_total',
+        ],
+        'label_whitelist': ['name', 'image', 'interface', 'device'],
+    },
+    'haproxy': {
+        'ports': (8405, 9101),
+        'prefix': 'haproxy_',
+        'whitelist': [
+            'haproxy_up',
+            'haproxy_(backend|server)_up',
+            'haproxy_(backend|frontend)_current_sessions',
+            'haproxy_backend_http_responses_total',
+            'haproxy_backend_http_total_time_average_seconds',
+            'haproxy_server_downtime_seconds_total',
+        ],
+        'label_whitelist': ['backend', 'frontend', 'server', 'code'],
+    },
+    'node': {
+        'ports': (9100,),
+        'prefix': 'node_',
+        'whitelist': [
+            'node_load(1|5|15)$',
+            'node_cpu_seconds_total',
+            'node_memory_Mem(Total|Available)_bytes',
+            'node_filesystem_(avail|size)_bytes',
+            'node_network_(receive|transmit)_bytes_total',
+            'node_disk_(read|written)_bytes_total',
+        ],
+        'label_whitelist': ['cpu', 'mode', 'device', 'mountpoint', 'fstype'],
+    },
+}
+
+
+def _decode_address(address):
+    """Return the host to probe for an address from /proc/net/tcp*
+
+    Addresses are hex encoded in host byte order, a 32 bit word at a time.
+    Sockets listening on any address, or on loopback, are probed through
+    localhost.
+    """
+    packed = binascii.unhexlify(address)
+    packed = b''.join(packed[i:i + 4][::-1] for i in range(0, len(packed), 4))
+    if len(packed) == 4:
+        host = socket.inet_ntop(socket.AF_INET, packed)
+        if host == '0.0.0.0' or host.startswith('127.'):
+            return 'localhost'
+        return host
+    host = socket.inet_ntop(socket.AF_INET6, packed)
+    if host in ('::', '::1'):
+        return 'localhost'
+    if host.startswith('::ffff:'):
+        return _decode_address(address[-8:])
+    return '[{}]'.format(host)
+
+
+class PrometheusV2Detect(monasca_setup.detection.Plugin):
+    """Detects Prometheus exporters and configures the prometheusv2 plugin.
+
+    Known exporters listening on this host are probed once, and an instance
+    is configured for each with the metrics and labels from its profile.
+    Exporters without a profile are not configured, so that they are never
+    ingested unfiltered. Extra ports to probe can be given with the ``ports``
+    argument, for example ``ports=9999,19100``.
+    """
+
+    def _detect(self):
+        self.available = False
+        self.instances = []
+        listening = self._find_listening_ports()
+        for port in sorted(self._ports_to_probe() & set(listening)):
+            instance = self._probe_exporter(listening[port], port)
+            if instance:
+                self.instances.append(instance)
+        if not self.instances:
+            LOG.info('No Prometheus exporters were detected: prometheusv2 '
+                     'plugin will not be loaded.')
+            return
+        self.available = True
+
+    def build_config(self):
+        config = monasca_setup.agent_config.Plugins()
+        config['prometheusv2'] = {
+            'init_config': {'timeout': _PROBE_TIMEOUT},
+            'instances': self.instances}
+        return config
+
+    def _ports_to_probe(self):
+        ports = set()
+        for profile in _EXPORTER_PROFILES.values():
+            ports.update(profile['ports'])
+        extra_ports = (self.args or {}).get('ports')
+        if extra_ports:
+            ports.update(int(port) for port in extra_ports.split(','))
+        return ports
+
+    @staticmethod
+    def _find_listening_ports():
+        """Return the host to probe for each listening TCP port"""
+        listening = {}
+        for tcp_path in _PROC_NET_TCP_PATHS:
+            try:
+                with open(tcp_path) as tcp_file:
+                    # Skip the header
+                    lines = tcp_file.readlines()[1:]
+            except (IOError, OSError):
+                continue
+            for line in lines:
+                fields = line.split()
+                if len(fields) < 4 or fields[3] != _TCP_LISTEN_STATE:
+                    continue
+                address, port = fields[1].split(':')
+                port = int(port, 16)
+                host = _decode_address(address)
+                # A port bound to several addresses is probed through
+                # localhost if any of them allow it
+                if listening.get(port) != 'localhost':
+                    listening[port] = host
+        return listening
+
+    @staticmethod
+    def _estimate_payload(text, whitelist=None):
+        """Return the number of samples, and how many are whitelisted"""
+        whitelist_regex = ('(?:' + ')|(?:'.join(whitelist) + ')'
+                           if whitelist else None)
+        samples = 0
+        whitelisted = 0
+        for line in text.splitlines():
+            match = _SAMPLE_NAME_REGEX.match(line)
+            if not match:
+                continue
+            samples += 1
+            if whitelist_regex and re.match(whitelist_regex, match.group(1)):
+                whitelisted += 1
+        return samples, whitelisted
+
+    @staticmethod
+    def _identify_exporter(text):
+        """Return the name of the profile matching most metrics, or None"""
+        counts = dict.fromkeys(_EXPORTER_PROFILES, 0)
+        for line in text.splitlines():
+            for name, profile in _EXPORTER_PROFILES.items():
+                if line.startswith(profile['prefix']):
+                    counts[name] += 1
+        name = max(sorted(counts), key=counts.get)
+        return name if counts[name] else None
+
+    def _probe_exporter(self, host, port):
+        """Return a prometheusv2 instance for an exporter, or None"""
+        endpoint = 'http://{}:{}/metrics'.format(host, port)
+        try:
+            response = requests.get(endpoint, timeout=_PROBE_TIMEOUT)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            LOG.debug('No Prometheus exporter at {}: {}'.format(endpoint, e))
+            return None
+        if 'text/plain' not in response.headers.get('Content-Type', ''):
+            LOG.debug('No Prometheus exporter at {}: unsupported content '
+                      'type'.format(endpoint))
+            return None
+        name = self._identify_exporter(response.text)
+        if not name:
+            samples, _ = self._estimate_payload(response.text)
+            LOG.info('Skipping unrecognised exporter at {} ({} bytes, {} '
+                     'samples): it would be ingested unfiltered'.format(
+                         endpoint, len(response.content), samples))
+            return None
+        profile = _EXPORTER_PROFILES[name]
+        samples, whitelisted = self._estimate_payload(
+            response.text, profile['whitelist'])
+        LOG.info('Found {} exporter at {} ({} bytes, {} samples, {} after '
+                 'filtering)'.format(name, endpoint, len(response.content),
+                                     samples, whitelisted))
+        instance = {'name': '{}_{}'.format(name, port),
+                    'metric_endpoint': endpoint,
+                    'whitelist': list(profile['whitelist']),
+                    'label_whitelist': list(profile['label_whitelist'])}
+        if profile.get('remove_hostname'):
+            instance['remove_hostname'] = True
+        return instance
@@ -14,6 +14,8 @@
 
 import logging
 import os
+import re
+import socket
 
 import monasca_setup.agent_config
 import monasca_setup.detection
@@ -21,6 +23,12 @@ import monasca_setup.detection
 LOG = logging.getLogger(__name__)
 
 _SCONTROL_PATH = "/usr/bin/scontrol"
+_SLURM_CONF_PATHS = ("/etc/slurm/slurm.conf", "/etc/slurm-llnl/slurm.conf")
+# The primary controller is the first SlurmctldHost, or the ControlMachine
+# in older versions of Slurm. The address in brackets is optional.
+_SLURM_CONTROLLER_REGEX = re.compile(
+    r'^\s*(?:SlurmctldHost|ControlMachine)\s*=\s*([^\s(#]+)',
+    re.IGNORECASE | re.MULTILINE)
 
 
 class SlurmDetect(monasca_setup.detection.Plugin):
@@ -36,10 +44,36 @@ class SlurmDetect(monasca_setup.detection.Plugin):
 
     def build_config(self):
         config = monasca_setup.agent_config.Plugins()
+        instance = {'name': 'slurm_stats'}
+        controller = self._find_controller()
+        if controller:
+            # Only the agent on the controller queries Slurm, and reports
+            # the metrics for every node
+            hostname = socket.gethostname().split('.')[0]
+            instance['cluster_collector'] = (
+                hostname == controller.split('.')[0])
         config['slurm'] = {
             'init_config': None,
-            'instances': [{'name': 'slurm_stats'}]}
+            'instances': [instance]}
         return config
 
+    @staticmethod
+    def _find_controller():
+        """Return the hostname of the primary Slurm controller, or None"""
+        conf_paths = _SLURM_CONF_PATHS
+        if os.environ.get('SLURM_CONF'):
+            conf_paths = (os.environ['SLURM_CONF'],)
+        for conf_path in conf_paths:
+            try:
+                with open(conf_path) as conf_file:
+                    conf = conf_file.read()
+            except (IOError, OSError):
+                continue
+            match = _SLURM_CONTROLLER_REGEX.search(conf)
+            if match:
+                return match.group(1)
+            LOG.info('No Slurm controller found in {}'.format(conf_path))
+        return None
+
     def _detect_slurm(self):
         return os.path.exists(_SCONTROL_PATH)
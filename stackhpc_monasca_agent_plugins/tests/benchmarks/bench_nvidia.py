@@ -0,0 +1,126 @@
+# Copyright (c) 2018 StackHPC Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmarks the NVML calls made by the nvidia check
+
+Run with, for example::
+
+    python -m stackhpc_monasca_agent_plugins.tests.benchmarks.bench_nvidia \\
+        --gpus 1,8,16 --latency 0.001 --output nvidia.json
+"""
+
+import monasca_agent.collector.checks as checks
+import mock
+
+from stackhpc_monasca_agent_plugins.checks import nvidia
+from stackhpc_monasca_agent_plugins.tests.benchmarks import common
+from stackhpc_monasca_agent_plugins.tests import fake_pynvml
+
+_DEFAULT_GPUS = (1, 8, 16)
+_DEFAULT_LATENCY = 0.001
+_DEFAULT_CHECKS = 10
+# Passively cooled data centre GPUs have no fan
+_DEFAULT_NOT_SUPPORTED = ('nvmlDeviceGetFanSpeed',)
+
+
+class _BenchmarkNvidia(nvidia.Nvidia):
+    """Counts the metrics posted instead of sending them to the forwarder"""
+
+    def __init__(self):
+        # Skip the agent configuration in the base class constructor
+        with mock.patch.object(checks.AgentCheck, '__init__',
+                               return_value=None):
+            super(_BenchmarkNvidia, self).__init__('nvidia', {}, {})
+        self.posted = 0
+
+    @staticmethod
+    def _set_dimensions(dimensions, instance=None):
+        return dict(dimensions or {}, hostname='benchmark')
+
+    def gauge(self, *args, **kwargs):
+        self.posted += 1
+
+
+def _run_checks(recorder, name, check, nvml, instance, count, uncached):
+    calls = sum(nvml.calls.values())
+    with recorder.stage(name, count):
+        for _ in range(count):
+            if uncached:
+                # Forget the static attributes and unsupported queries, as
+                # if NVML were initialised for every check
+                check._shutdown_nvml()
+            check.check(instance)
+    recorder.record(name, nvml_calls_per_check=float(
+        sum(nvml.calls.values()) - calls) / count)
+
+
+def _pipeline(recorder, gpus, instance, checks_count, nvml_options):
+    nvml = fake_pynvml.FakePynvml(gpu_count=gpus, **nvml_options)
+    check = _BenchmarkNvidia()
+    with mock.patch.object(nvidia, 'pynvml', nvml):
+        try:
+            _run_checks(recorder, 'first_check', check, nvml, instance, 1,
+                        False)
+            _run_checks(recorder, 'cached_check', check, nvml, instance,
+                        checks_count, False)
+            _run_checks(recorder, 'uncached_check', check, nvml, instance,
+                        checks_count, True)
+        finally:
+            check.stop()
+
+
+def run(gpus=_DEFAULT_GPUS, latency=_DEFAULT_LATENCY,
+        not_supported=_DEFAULT_NOT_SUPPORTED, checks_count=_DEFAULT_CHECKS,
+        collection_threads=None):
+    results = []
+    for gpu_count in gpus:
+        threads = collection_threads or nvidia._DEFAULT_COLLECTION_THREADS
+        params = {'gpus': gpu_count,
+                  'latency': latency,
+                  'not_supported': sorted(not_supported),
+                  'checks': checks_count,
+                  'collection_threads': threads}
+        instance = {'collection_threads': threads}
+        stages = common.run_stages(
+            _pipeline, gpu_count, instance, checks_count,
+            {'latency': latency, 'not_supported': not_supported})
+        for stage in stages.values():
+            stage['seconds_per_check'] = stage['seconds'] / stage['items']
+        results.append({'params': params, 'stages': stages})
+    return common.make_results('nvidia', results)
+
+
+def main():
+    parser = common.argument_parser(__doc__.splitlines()[0])
+    parser.add_argument('--gpus',
+                        default=','.join(str(g) for g in _DEFAULT_GPUS),
+                        help='Comma separated numbers of GPUs to simulate')
+    parser.add_argument('--latency', type=float, default=_DEFAULT_LATENCY,
+                        help='Seconds taken by each NVML call')
+    parser.add_argument('--not-supported',
+                        default=','.join(_DEFAULT_NOT_SUPPORTED),
+                        help='Comma separated NVML functions which are not '
+                        'supported by any GPU')
+    parser.add_argument('--checks', type=int, default=_DEFAULT_CHECKS,
+                        help='Checks to average over')
+    parser.add_argument('--collection-threads', type=int)
+    args = parser.parse_args()
+    not_supported = tuple(f for f in args.not_supported.split(',') if f)
+    common.finish(args, run([int(g) for g in args.gpus.split(',')],
+                            args.latency, not_supported, args.checks,
+                            args.collection_threads))
+
+
+if __name__ == '__main__':
+    main()
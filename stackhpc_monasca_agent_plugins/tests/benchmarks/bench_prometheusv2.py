@@ -0,0 +1,190 @@
+# Copyright (c) 2018 StackHPC Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmarks the stages of the prometheusv2 check
+
+Run with, for example::
+
+    python -m \\
+        stackhpc_monasca_agent_plugins.tests.benchmarks.bench_prometheusv2 \\
+        --samples 10000,100000 --output prometheusv2.json
+"""
+
+import logging
+import string
+
+from prometheus_client.parser import text_string_to_metric_families
+
+from stackhpc_monasca_agent_plugins.checks import prometheusv2
+from stackhpc_monasca_agent_plugins.common import prometheus
+from stackhpc_monasca_agent_plugins.tests.benchmarks import common
+
+_DEFAULT_SAMPLES = (10000, 100000, 1000000)
+
+# Modelled on the example_prometheus_* fixtures. Each series in a family
+# has a different value of the varying label, and the same value of the
+# other labels, like the container_label_* labels from cAdvisor. The same
+# series appear in every family, so that they can be divided.
+_PAYLOAD_STYLES = {
+    'cadvisor': {'prefix': 'container_',
+                 'varying_label': ('name', 'k8s_pod_{}'),
+                 'label': 'container_label_{}',
+                 'counter_suffix': '_total'},
+    'ceph': {'prefix': 'ceph_osd_',
+             'varying_label': ('ceph_daemon', 'osd.{}'),
+             'label': 'ceph_label_{}',
+             'counter_suffix': ''},
+    'haproxy': {'prefix': 'haproxy_backend_',
+                'varying_label': ('backend', 'service_{}_api'),
+                'label': 'haproxy_label_{}',
+                'counter_suffix': '_total'},
+}
+
+
+def _label_value(label, length):
+    return string.ascii_lowercase[label % 26] * length
+
+
+def generate_payload(families=100, series=100, labels=4, label_length=16,
+                     style='cadvisor'):
+    """Return a Prometheus text payload of families * series samples
+
+    Families alternate between counters and gauges. Each sample has the
+    given number of labels, with values of the given length.
+    """
+    payload_style = _PAYLOAD_STYLES[style]
+    varying_label, varying_value = payload_style['varying_label']
+    lines = []
+    for family in range(families):
+        metric_type = 'counter' if family % 2 == 0 else 'gauge'
+        name = '{}metric_{}'.format(payload_style['prefix'], family)
+        if metric_type == 'counter':
+            name += payload_style['counter_suffix']
+        lines.append('# HELP {} Synthetic {} {}'.format(
+            name, metric_type, family))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        constant_labels = ''.join(
+            ',{}="{}"'.format(payload_style['label'].format(label),
+                              _label_value(label, label_length))
+            for label in range(1, labels))
+        for index in range(series):
+            value = varying_value.format(index).ljust(label_length, 'x')
+            lines.append('{}{{{}="{}"{}}} {}'.format(
+                name, varying_label, value, constant_labels,
+                float((index + 1) * (family + 1))))
+    return '\n'.join(lines) + '\n'
+
+
+def derived_metrics_config(style='cadvisor'):
+    """Return derived metrics using each of the supported operations"""
+    payload_style = _PAYLOAD_STYLES[style]
+    prefix = payload_style['prefix']
+    counter_suffix = payload_style['counter_suffix'] or '_total'
+    return {
+        'benchmark_divide': {'op': 'divide',
+                             'x': prefix + 'metric_1',
+                             'y': prefix + 'metric_3'},
+        'benchmark_sum': {'op': 'sum',
+                          'series': prefix + 'metric_1',
+                          'key': payload_style['varying_label'][0]},
+        'benchmark_counter': {'op': 'counter',
+                              'series': prefix + 'metric_0' + counter_suffix},
+    }
+
+
+class _BenchmarkPrometheusV2(prometheusv2.PrometheusV2):
+    """Counts the metrics posted instead of sending them to the forwarder"""
+
+    def __init__(self):
+        # Don't call the base class constructor
+        self.log = logging.getLogger(__name__)
+        self.posted = 0
+
+    def gauge(self, *args, **kwargs):
+        self.posted += 1
+
+    def rate(self, *args, **kwargs):
+        self.posted += 1
+
+
+def _pipeline(recorder, text, instance):
+    check = _BenchmarkPrometheusV2()
+    with recorder.stage('parse'):
+        metric_families = list(text_string_to_metric_families(text))
+    with recorder.stage('store'):
+        metrics = prometheus.MetricStore(
+            whitelist=instance.get('whitelist'),
+            label_whitelist=instance.get('label_whitelist'))
+        check._parse_metrics(metrics, metric_families)
+    del metric_families
+    with recorder.stage('derive'):
+        check._compute_derived_metrics(metrics, instance)
+    with recorder.stage('emit'):
+        check._write_out_metrics(metrics, {'hostname': 'benchmark'},
+                                 instance)
+    return check.posted
+
+
+def run(samples=_DEFAULT_SAMPLES, families=100, labels=4, label_length=16,
+        style='cadvisor', whitelist=None, label_whitelist=None):
+    results = []
+    for sample_count in samples:
+        params = {'samples': sample_count,
+                  'families': families,
+                  'labels': labels,
+                  'label_length': label_length,
+                  'style': style,
+                  'whitelist': whitelist,
+                  'label_whitelist': label_whitelist}
+        text = generate_payload(families, max(sample_count // families, 1),
+                                labels, label_length, style)
+        instance = {'derived_metrics': derived_metrics_config(style),
+                    'whitelist': whitelist,
+                    'label_whitelist': label_whitelist}
+        stages = common.run_stages(_pipeline, text, instance)
+        results.append({'params': params,
+                        'payload_bytes': len(text.encode('utf-8')),
+                        'stages': stages})
+    return common.make_results('prometheusv2', results)
+
+
+def _list(value, item_type=str):
+    return [item_type(item) for item in value.split(',')] if value else None
+
+
+def main():
+    parser = common.argument_parser(__doc__.splitlines()[0])
+    parser.add_argument('--samples',
+                        default=','.join(str(s) for s in _DEFAULT_SAMPLES),
+                        help='Comma separated numbers of samples per payload')
+    parser.add_argument('--families', type=int, default=100)
+    parser.add_argument('--labels', type=int, default=4,
+                        help='Labels per sample')
+    parser.add_argument('--label-length', type=int, default=16,
+                        help='Length of each label value')
+    parser.add_argument('--style', choices=sorted(_PAYLOAD_STYLES),
+                        default='cadvisor')
+    parser.add_argument('--whitelist',
+                        help='Comma separated metric whitelist regexes')
+    parser.add_argument('--label-whitelist',
+                        help='Comma separated label whitelist')
+    args = parser.parse_args()
+    results = run(_list(args.samples, int), args.families, args.labels,
+                  args.label_length, args.style, _list(args.whitelist),
+                  _list(args.label_whitelist))
+    common.finish(args, results)
+
+
+if __name__ == '__main__':
+    main()
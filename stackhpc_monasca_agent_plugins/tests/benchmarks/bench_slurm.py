@@ -0,0 +1,253 @@
+# Copyright (c) 2018 StackHPC Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmarks parsing scontrol output in the slurm check
+
+Run with, for example::
+
+    python -m stackhpc_monasca_agent_plugins.tests.benchmarks.bench_slurm \\
+        --nodes 10000 --jobs 10000,100000 --output slurm.json
+"""
+
+import os
+import random
+
+from stackhpc_monasca_agent_plugins.checks import slurm
+from stackhpc_monasca_agent_plugins.common import instrumentation
+from stackhpc_monasca_agent_plugins.tests.benchmarks import common
+
+_DEFAULT_NODES = 10000
+_DEFAULT_JOBS = (10000, 100000)
+_DEFAULT_MAX_JOB_NODES = 1024
+
+_NODE_PREFIX = 'compute-'
+_PARTITIONS = ('compute', 'gpu', 'debug')
+_PENDING_REASONS = ('Priority', 'Resources', 'Dependency', 'JobHeldUser',
+                    'JobHeldAdmin')
+_NODE_STATES = ('IDLE', 'ALLOCATED', 'MIXED', 'DOWN*', 'DRAIN')
+
+# Modelled on the lines in example_slurm_job_list and example_slurm_node_list
+_JOB_LINE = (
+    'JobId={job_id} JobName=job_{job_id}.sh UserId={user}(2{user_id:03d}) '
+    'GroupId={user}(2{user_id:03d}) MCS_label=N/A Priority={priority} '
+    'Nice=0 Account=(null) QOS=(null) JobState={state} Reason={reason} '
+    'Dependency=(null) Requeue=1 Restarts=0 BatchFlag=1 Reboot=0 '
+    'ExitCode=0:0 RunTime=01:53:03 TimeLimit=1-00:00:00 TimeMin=N/A '
+    'SubmitTime={submit_time} EligibleTime={submit_time} '
+    'StartTime={submit_time} EndTime=2018-01-26T11:53:42 Deadline=N/A '
+    'PreemptTime=None SuspendTime=None SecsPreSuspend=0 '
+    'Partition={partition} AllocNode:Sid=login-0:161189 '
+    'ReqNodeList=(null) ExcNodeList=(null) NodeList={node_list} '
+    'BatchHost={batch_host} NumNodes={num_nodes} NumCPUs={num_cpus} '
+    'NumTasks={num_cpus} CPUs/Task=1 ReqB:S:C:T=0:0:*:* '
+    'TRES=cpu={num_cpus},node={num_nodes} Socks/Node=* '
+    'NtasksPerN:B:S:C=0:0:*:* CoreSpec=* MinCPUsNode=1 MinMemoryNode=0 '
+    'MinTmpDiskNode=0 Features=(null) Gres=(null) Reservation=(null) '
+    'OverSubscribe=NO Contiguous=0 Licenses=(null) Network=(null) '
+    'Command=./job_{job_id}.sh WorkDir=/home/{user} '
+    'StdErr=/home/{user}/slurm-{job_id}.out StdIn=/dev/null '
+    'StdOut=/home/{user}/slurm-{job_id}.out Power=')
+_NODE_LINE = (
+    'NodeName={name} Arch=x86_64 CoresPerSocket=16 CPUAlloc={cpu_alloc} '
+    'CPUErr=0 CPUTot=64 CPULoad={cpu_load} AvailableFeatures=(null) '
+    'ActiveFeatures=(null) Gres={gres} NodeAddr={name} NodeHostName={name} '
+    'Version=16.05 OS=Linux RealMemory=257000 AllocMem={alloc_mem} '
+    'FreeMem=124977 Sockets=2 Boards=1 State={state} ThreadsPerCore=2 '
+    'TmpDisk=0 Weight=1 Owner=N/A MCS_label=N/A '
+    'BootTime=2017-12-19T11:32:26 SlurmdStartTime=2017-12-19T11:57:09 '
+    'CapWatts=n/a CurrentWatts=0 LowestJoules=0 ConsumedJoules=0 '
+    'ExtSensorsJoules=n/s ExtSensorsWatts=0 ExtSensorsTemp=n/s{gres_used}')
+
+
+def generate_hostlist(rng, nodes, count, max_fragments=8):
+    """Return a hostlist expression for count of the nodes
+
+    The nodes are split into up to max_fragments ranges, such as
+    compute-[1-12,40,97-130].
+    """
+    count = min(count, nodes)
+    if count == 1:
+        return '{}{}'.format(_NODE_PREFIX, rng.randrange(nodes))
+    fragments = rng.randint(1, min(max_fragments, count))
+    sizes = [count // fragments] * fragments
+    sizes[-1] += count - sum(sizes)
+    # Spread the fragments out, with random gaps between them
+    cuts = sorted(rng.randint(0, nodes - count) for _ in sizes)
+    gaps = [cut - previous for previous, cut in zip([0] + cuts, cuts)]
+    ranges = []
+    start = 0
+    for gap, size in zip(gaps, sizes):
+        start += gap
+        if size == 1:
+            ranges.append(str(start))
+        else:
+            ranges.append('{}-{}'.format(start, start + size - 1))
+        start += size
+    return '{}[{}]'.format(_NODE_PREFIX, ','.join(ranges))
+
+
+def generate_job_list(jobs=_DEFAULT_JOBS[0], nodes=_DEFAULT_NODES,
+                      max_job_nodes=_DEFAULT_MAX_JOB_NODES, seed=0):
+    """Return lines of scontrol -o show job output
+
+    Most jobs use one node, and a few use up to max_job_nodes, as on a
+    busy cluster. 30% of the jobs are running, 65% are pending and 5% have
+    finished.
+    """
+    rng = random.Random(seed)
+    lines = []
+    for job_id in range(1000, 1000 + jobs):
+        # Job sizes follow a power law
+        num_nodes = min(int(rng.paretovariate(1.2)), max_job_nodes)
+        roll = rng.random()
+        if roll < 0.3:
+            state, reason = 'RUNNING', 'None'
+            node_list = generate_hostlist(rng, nodes, num_nodes)
+            batch_host = '{}{}'.format(_NODE_PREFIX, rng.randrange(nodes))
+        elif roll < 0.95:
+            state, reason = 'PENDING', rng.choice(_PENDING_REASONS)
+            node_list = batch_host = '(null)'
+        else:
+            state, reason = 'COMPLETED', 'None'
+            node_list = generate_hostlist(rng, nodes, num_nodes)
+            batch_host = '{}{}'.format(_NODE_PREFIX, rng.randrange(nodes))
+        user_id = rng.randrange(200)
+        lines.append(_JOB_LINE.format(
+            job_id=job_id,
+            user='user{}'.format(user_id),
+            user_id=user_id,
+            priority=4294901700 - job_id,
+            state=state,
+            reason=reason,
+            submit_time='2018-01-{:02d}T{:02d}:{:02d}:42'.format(
+                rng.randint(1, 25), rng.randrange(24), rng.randrange(60)),
+            partition=rng.choice(_PARTITIONS),
+            node_list=node_list,
+            batch_host=batch_host,
+            num_nodes=num_nodes,
+            num_cpus=num_nodes * 64))
+    return lines
+
+
+def generate_node_list(nodes=_DEFAULT_NODES, gpu_fraction=0.1, seed=0):
+    """Return lines of scontrol -o show node output"""
+    rng = random.Random(seed)
+    lines = []
+    for index in range(nodes):
+        state = rng.choice(_NODE_STATES)
+        down = state in ('DOWN*', 'DRAIN')
+        cpu_alloc = 0 if down or state == 'IDLE' else rng.choice((32, 64))
+        gpus = 4 if index < nodes * gpu_fraction else 0
+        lines.append(_NODE_LINE.format(
+            name='{}{}'.format(_NODE_PREFIX, index),
+            cpu_alloc=cpu_alloc,
+            cpu_load='N/A' if down else '{:.2f}'.format(
+                rng.uniform(0, cpu_alloc or 1)),
+            gres='gpu:tesla:{}'.format(gpus) if gpus else '(null)',
+            alloc_mem=cpu_alloc * 4000,
+            state=state,
+            gres_used=(' GresUsed=gpu:tesla:{}(IDX:0-{})'.format(
+                gpus // 2, gpus // 2 - 1) if gpus else '')))
+    return lines
+
+
+class _BenchmarkSlurm(slurm.Slurm):
+    """Parses generated output instead of running scontrol"""
+
+    def __init__(self, job_lines, node_lines):
+        # Don't call the base class constructor
+        self._job_cache = {}
+        self._instrumentation = instrumentation.CheckInstrumentation('slurm')
+        self._job_lines = job_lines
+        self._node_lines = node_lines
+
+    def _get_raw_job_data(self):
+        return self._job_lines
+
+    def _get_raw_node_data(self):
+        return self._node_lines
+
+
+def _pipeline(recorder, job_lines, node_lines):
+    check = _BenchmarkSlurm(job_lines, node_lines)
+    jobs = len(job_lines)
+    # The regular expression, and the tokenizer which could replace it
+    with recorder.stage('job_regex', jobs):
+        for line in job_lines:
+            slurm.Slurm._parse_job(line)
+    with recorder.stage('job_tokenize', jobs):
+        for line in job_lines:
+            slurm.Slurm._tokenize(line)
+    with recorder.stage('parse_jobs', jobs):
+        job_records = check._parse_jobs()
+    with recorder.stage('parse_jobs_cached', jobs):
+        check._parse_jobs()
+    with recorder.stage('get_jobs', len(job_records)):
+        check._get_jobs(job_records)
+    with recorder.stage('queue_stats', len(job_records)):
+        check._get_queue_stats(job_records)
+    with recorder.stage('get_nodes', len(node_lines)):
+        check._get_nodes()
+
+
+def run(nodes=_DEFAULT_NODES, jobs=_DEFAULT_JOBS,
+        max_job_nodes=_DEFAULT_MAX_JOB_NODES, seed=0):
+    results = []
+    node_lines = generate_node_list(nodes, seed=seed)
+    for job_count in jobs:
+        params = {'nodes': nodes,
+                  'jobs': job_count,
+                  'max_job_nodes': max_job_nodes,
+                  'seed': seed}
+        job_lines = generate_job_list(job_count, nodes, max_job_nodes, seed)
+        stages = common.run_stages(_pipeline, job_lines, node_lines)
+        results.append({'params': params, 'stages': stages})
+    return common.make_results('slurm', results)
+
+
+def write_fixtures(directory, nodes, jobs, max_job_nodes, seed):
+    """Write generated output in the form of the example_slurm_* fixtures"""
+    for name, lines in (
+            ('slurm_job_list',
+             generate_job_list(jobs, nodes, max_job_nodes, seed)),
+            ('slurm_node_list', generate_node_list(nodes, seed=seed))):
+        with open(os.path.join(directory, name), 'w') as fixture:
+            fixture.write('\n'.join(lines) + '\n')
+
+
+def main():
+    parser = common.argument_parser(__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=_DEFAULT_NODES)
+    parser.add_argument('--jobs',
+                        default=','.join(str(j) for j in _DEFAULT_JOBS),
+                        help='Comma separated numbers of jobs')
+    parser.add_argument('--max-job-nodes', type=int,
+                        default=_DEFAULT_MAX_JOB_NODES,
+                        help='The most nodes used by a single job')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--write-fixtures', metavar='DIRECTORY',
+                        help='Write the generated scontrol output for the '
+                        'largest number of jobs to this directory instead '
+                        'of running the benchmark')
+    args = parser.parse_args()
+    jobs = [int(j) for j in args.jobs.split(',')]
+    if args.write_fixtures:
+        write_fixtures(args.write_fixtures, args.nodes, max(jobs),
+                       args.max_job_nodes, args.seed)
+        return
+    common.finish(args, run(args.nodes, jobs, args.max_job_nodes, args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+# Copyright (c) 2018 StackHPC Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Helpers shared by the benchmarks
+
+Each benchmark runs a pipeline of named stages at a number of sizes, and
+records the wall time and the peak memory allocated by each stage. Results
+are written as JSON, and can be compared against an earlier run to catch
+regressions.
+"""
+
+import argparse
+import contextlib
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+# Measurements compared against a baseline. Counts of calls are included,
+# since they don't vary between runs.
+_COMPARED_KEYS = ('seconds', 'peak_bytes', 'nvml_calls_per_check')
+_FORMATTED_KEYS = ('seconds', 'peak_bytes', 'items')
+
+
+class StageRecorder(object):
+    """Records the time, or the peak memory, of each stage of a run
+
+    Memory is traced in a separate run, so that the overhead of tracemalloc
+    doesn't affect the times.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, items=None):
+        """Record a stage, which processes a number of items if given"""
+        gc.collect()
+        if self.trace_memory:
+            tracemalloc.start()
+            try:
+                yield
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            self.stages.setdefault(name, {})['peak_bytes'] = peak
+        else:
+            start = time.perf_counter()
+            yield
+            stage = self.stages.setdefault(name, {})
+            stage['seconds'] = time.perf_counter() - start
+            if items is not None:
+                stage['items'] = items
+
+    def record(self, name, **values):
+        """Record other measurements of a stage, such as a count of calls"""
+        self.stages.setdefault(name, {}).update(values)
+
+
+def run_stages(pipeline, *args, **kwargs):
+    """Run a pipeline twice, returning the time and peak memory per stage
+
+    The pipeline is called with a StageRecorder, followed by the remaining
+    arguments.
+    """
+    timed = StageRecorder()
+    pipeline(timed, *args, **kwargs)
+    traced = StageRecorder(trace_memory=True)
+    pipeline(traced, *args, **kwargs)
+    stages = {}
+    for name, result in timed.stages.items():
+        stages[name] = dict(traced.stages.get(name, {}), **result)
+    return stages
+
+
+def make_results(benchmark, results):
+    return {
+        'benchmark': benchmark,
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+def _index_results(results):
+    return {json.dumps(result['params'], sort_keys=True): result['stages']
+            for result in results['results']}
+
+
+def compare_results(baseline, current, tolerance=0.2):
+    """Return a description of each stage which has regressed
+
+    A stage has regressed if its time or peak memory has grown by more than
+    the tolerance, as a fraction of the baseline. Only runs with the same
+    parameters are compared.
+    """
+    regressions = []
+    baseline_stages = _index_results(baseline)
+    for params, stages in sorted(_index_results(current).items()):
+        for name, result in sorted(stages.items()):
+            previous = baseline_stages.get(params, {}).get(name)
+            if not previous:
+                continue
+            for key in _COMPARED_KEYS:
+                if not previous.get(key) or key not in result:
+                    continue
+                change = result[key] / previous[key] - 1
+                if change > tolerance:
+                    regressions.append(
+                        '{} {} {}: {:.4g} -> {:.4g} (+{:.0%})'.format(
+                            params, name, key, previous[key], result[key],
+                            change))
+    return regressions
+
+
+def format_results(results):
+    lines = []
+    for result in results['results']:
+        lines.append(json.dumps(result['params'], sort_keys=True))
+        for name, stage in result['stages'].items():
+            line = '  {:<18} {:>10.4f} s {:>12.1f} KiB'.format(
+                name, stage.get('seconds', 0),
+                stage.get('peak_bytes', 0) / 1024.0)
+            if stage.get('items') and stage.get('seconds'):
+                line += ' {:>12.0f} /s'.format(
+                    stage['items'] / stage['seconds'])
+            for key in sorted(set(stage) - set(_FORMATTED_KEYS)):
+                line += ' {}={:.4g}'.format(key, stage[key])
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+def argument_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--output', help='File to write the results to, '
+                        'as JSON')
+    parser.add_argument('--baseline', help='Results from an earlier run to '
+                        'compare against. Exits non-zero on a regression.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Fraction by which a stage may grow before '
+                        'it is reported as a regression')
+    return parser
+
+
+def finish(args, results):
+    """Report the results, and compare them against any baseline"""
+    print(format_results(results))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_results(baseline, results, args.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression)
+        if regressions:
+            sys.exit(1)
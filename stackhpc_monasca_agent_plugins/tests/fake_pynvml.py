@@ -0,0 +1,371 @@
+# Copyright (c) 2018 StackHPC Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""An in-process stand-in for the py3nvml module
+
+Simulates a number of GPUs so that the nvidia check can be tested, or
+benchmarked, without GPUs or the NVIDIA driver. Every call is counted, so
+that tests can check how many NVML calls a check makes. Calls can be made
+to take time, as they do on busy GPUs, and queries can be made unsupported
+on every GPU, as they are on some models.
+"""
+
+import collections
+import threading
+import time
+import types
+
+from py3nvml import py3nvml as pynvml
+
+
+class FakeGpu(pynvml.c_nvmlDevice_t):
+    """A GPU, which is its own device handle
+
+    Like the handles from the real bindings, this is a ctypes pointer, so
+    can't be hashed.
+    """
+
+    _type_ = pynvml.struct_c_nvmlDevice_t
+
+    def __init__(self, index):
+        self._device = pynvml.struct_c_nvmlDevice_t()
+        super(FakeGpu, self).__init__(self._device)
+        self.index = index
+        self.uuid = 'GPU-00000000-0000-0000-0000-{:012d}'.format(index)
+        self.name = 'Tesla V100-SXM2-16GB'
+        self.serial = '032371800{:04d}'.format(index)
+        self.vbios_version = '88.00.4F.00.09'
+        self.info_rom_image_version = 'G503.0201.00.03'
+        self.power_state = 0
+        self.fan_speed = 0
+        self.memory_total = 16 * 1024 ** 3
+        self.memory_used = 1024 ** 3
+        self.bar1_total = 16 * 1024 ** 3
+        self.bar1_used = 2 * 1024 ** 2
+        self.utilisation_gpu = 50
+        self.utilisation_memory = 25
+        self.temperature = 40
+        self.temperature_thresholds = {
+            pynvml.NVML_TEMPERATURE_THRESHOLD_SHUTDOWN: 90,
+            pynvml.NVML_TEMPERATURE_THRESHOLD_SLOWDOWN: 87,
+        }
+        self.power_usage = 60000
+        self.power_limit = 300000
+        self.clocks = {
+            pynvml.NVML_CLOCK_GRAPHICS: 1312,
+            pynvml.NVML_CLOCK_SM: 1312,
+            pynvml.NVML_CLOCK_MEM: 877,
+            pynvml.NVML_CLOCK_VIDEO: 1177,
+        }
+        self.max_clocks = {
+            pynvml.NVML_CLOCK_GRAPHICS: 1530,
+            pynvml.NVML_CLOCK_SM: 1530,
+            pynvml.NVML_CLOCK_MEM: 877,
+            pynvml.NVML_CLOCK_VIDEO: 1372,
+        }
+        # Samples buffered by the driver as (timestamp, value), keyed by
+        # sample type
+        self.samples = {}
+        # NvLink utilisation counters as (rx, tx), one for each link
+        self.nvlinks = []
+        # PCIe throughput in KB/s, keyed by NVML_PCIE_UTIL_TX/RX_BYTES
+        self.pcie_throughput = {
+            pynvml.NVML_PCIE_UTIL_TX_BYTES: 1000,
+            pynvml.NVML_PCIE_UTIL_RX_BYTES: 2000,
+        }
+        self.mig_mode = 0
+        # MIG devices, with None for empty slots
+        self.mig_devices = []
+        self.gpu_instance_id = None
+        self.compute_instance_id = None
+        self.supported_event_types = sum((
+            pynvml.nvmlEventTypeXidCriticalError,
+            pynvml.nvmlEventTypeSingleBitEccError,
+            pynvml.nvmlEventTypeDoubleBitEccError))
+        self.supported_throttle_reasons = 0x1ff
+        self.throttle_reasons = pynvml.nvmlClocksThrottleReasonNone
+        # Compute processes as (pid, used memory in bytes)
+        self.processes = []
+        # Accounting stats of processes as (GPU utilisation, memory
+        # utilisation, maximum used memory), keyed by PID
+        self.accounting_stats = {}
+        # Names of NVML functions which are not supported by this GPU
+        self.not_supported = set()
+        # A lost GPU raises an error from every call until NVML is
+        # initialised again
+        self.lost = False
+
+
+class FakeMigDevice(FakeGpu):
+    _type_ = pynvml.struct_c_nvmlDevice_t
+
+    def __init__(self, parent, index):
+        super(FakeMigDevice, self).__init__(index)
+        self.uuid = 'MIG-{}/{}'.format(parent.uuid, index)
+        self.gpu_instance_id = index + 1
+        self.compute_instance_id = 0
+        self.memory_total = parent.memory_total // 8
+        # NVML does not report the utilisation of MIG devices
+        self.not_supported.add('nvmlDeviceGetUtilizationRates')
+
+
+class FakeEventSet(object):
+    def __init__(self):
+        # Event types registered for each GPU
+        self.registered = {}
+        self.events = collections.deque()
+        self.freed = False
+
+
+class FakePynvml(object):
+    NVMLError = pynvml.NVMLError
+
+    def __init__(self, gpu_count=1, driver_version='418.87.01', latency=0,
+                 latencies=None, not_supported=()):
+        """Simulate gpu_count GPUs
+
+        Each call sleeps for the latency in seconds, or for its entry in the
+        latencies keyed by function name. The functions named in
+        not_supported raise NVML_ERROR_NOT_SUPPORTED for every GPU.
+        """
+        # Share the constants with the real module
+        for name in dir(pynvml):
+            if name.startswith(('NVML_', 'nvmlClocks', 'nvmlEventType')):
+                setattr(self, name, getattr(pynvml, name))
+        # Constants missing from older bindings
+        self.NVML_DEVICE_MIG_ENABLE = 1
+        self.NVML_NVLINK_MAX_LINKS = 12
+        self.calls = collections.Counter()
+        # The check calls NVML from several threads
+        self._calls_lock = threading.Lock()
+        self.latency = latency
+        self.latencies = dict(latencies or {})
+        self.initialised = False
+        self.driver_version = driver_version
+        self.gpus = [FakeGpu(i) for i in range(gpu_count)]
+        for gpu in self.gpus:
+            gpu.not_supported.update(not_supported)
+        self.event_sets = []
+
+    def _count(self, name):
+        with self._calls_lock:
+            self.calls[name] += 1
+        latency = self.latencies.get(name, self.latency)
+        if latency:
+            time.sleep(latency)
+
+    def _call(self, name, gpu=None):
+        self._count(name)
+        if not self.initialised:
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_UNINITIALIZED)
+        if gpu is not None:
+            if gpu.lost:
+                raise pynvml.NVMLError(pynvml.NVML_ERROR_GPU_IS_LOST)
+            if name in gpu.not_supported:
+                raise pynvml.NVMLError(pynvml.NVML_ERROR_NOT_SUPPORTED)
+
+    def nvmlInit(self):
+        self._count('nvmlInit')
+        self.initialised = True
+        for gpu in self.gpus:
+            gpu.lost = False
+
+    def nvmlShutdown(self):
+        self._call('nvmlShutdown')
+        self.initialised = False
+
+    def nvmlSystemGetDriverVersion(self):
+        self._call('nvmlSystemGetDriverVersion')
+        return self.driver_version
+
+    def nvmlDeviceGetCount(self):
+        self._call('nvmlDeviceGetCount')
+        return len(self.gpus)
+
+    def nvmlDeviceGetHandleByIndex(self, index):
+        self._call('nvmlDeviceGetHandleByIndex')
+        if index >= len(self.gpus):
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_INVALID_ARGUMENT)
+        return self.gpus[index]
+
+    def nvmlDeviceGetUUID(self, gpu):
+        self._call('nvmlDeviceGetUUID', gpu)
+        return gpu.uuid
+
+    def nvmlDeviceGetName(self, gpu):
+        self._call('nvmlDeviceGetName', gpu)
+        return gpu.name
+
+    def nvmlDeviceGetSerial(self, gpu):
+        self._call('nvmlDeviceGetSerial', gpu)
+        return gpu.serial
+
+    def nvmlDeviceGetVbiosVersion(self, gpu):
+        self._call('nvmlDeviceGetVbiosVersion', gpu)
+        return gpu.vbios_version
+
+    def nvmlDeviceGetInforomImageVersion(self, gpu):
+        self._call('nvmlDeviceGetInforomImageVersion', gpu)
+        return gpu.info_rom_image_version
+
+    def nvmlDeviceGetPowerState(self, gpu):
+        self._call('nvmlDeviceGetPowerState', gpu)
+        return gpu.power_state
+
+    def nvmlDeviceGetFanSpeed(self, gpu):
+        self._call('nvmlDeviceGetFanSpeed', gpu)
+        return gpu.fan_speed
+
+    def nvmlDeviceGetMemoryInfo(self, gpu):
+        self._call('nvmlDeviceGetMemoryInfo', gpu)
+        return types.SimpleNamespace(
+            total=gpu.memory_total, used=gpu.memory_used,
+            free=gpu.memory_total - gpu.memory_used)
+
+    def nvmlDeviceGetBAR1MemoryInfo(self, gpu):
+        self._call('nvmlDeviceGetBAR1MemoryInfo', gpu)
+        return types.SimpleNamespace(
+            bar1Total=gpu.bar1_total, bar1Used=gpu.bar1_used,
+            bar1Free=gpu.bar1_total - gpu.bar1_used)
+
+    def nvmlDeviceGetUtilizationRates(self, gpu):
+        self._call('nvmlDeviceGetUtilizationRates', gpu)
+        return types.SimpleNamespace(gpu=gpu.utilisation_gpu,
+                                     memory=gpu.utilisation_memory)
+
+    def nvmlDeviceGetTemperature(self, gpu, sensor):
+        self._call('nvmlDeviceGetTemperature', gpu)
+        return gpu.temperature
+
+    def nvmlDeviceGetTemperatureThreshold(self, gpu, threshold):
+        self._call('nvmlDeviceGetTemperatureThreshold', gpu)
+        return gpu.temperature_thresholds[threshold]
+
+    def nvmlDeviceGetPowerUsage(self, gpu):
+        self._call('nvmlDeviceGetPowerUsage', gpu)
+        return gpu.power_usage
+
+    def nvmlDeviceGetPowerManagementLimit(self, gpu):
+        self._call('nvmlDeviceGetPowerManagementLimit', gpu)
+        return gpu.power_limit
+
+    def nvmlDeviceGetClockInfo(self, gpu, clock):
+        self._call('nvmlDeviceGetClockInfo', gpu)
+        return gpu.clocks[clock]
+
+    def nvmlDeviceGetMaxClockInfo(self, gpu, clock):
+        self._call('nvmlDeviceGetMaxClockInfo', gpu)
+        return gpu.max_clocks[clock]
+
+    def nvmlDeviceGetSamples(self, gpu, sample_type, last_seen):
+        self._call('nvmlDeviceGetSamples', gpu)
+        samples = [types.SimpleNamespace(
+            timeStamp=timestamp,
+            sampleValue=types.SimpleNamespace(uiVal=value))
+            for timestamp, value in gpu.samples.get(sample_type, [])
+            if timestamp > last_seen]
+        if not samples:
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_NOT_FOUND)
+        return pynvml.NVML_VALUE_TYPE_UNSIGNED_INT, samples
+
+    def nvmlDeviceGetComputeRunningProcesses(self, gpu):
+        self._call('nvmlDeviceGetComputeRunningProcesses', gpu)
+        return [types.SimpleNamespace(pid=pid, usedGpuMemory=used_memory)
+                for pid, used_memory in gpu.processes]
+
+    def nvmlDeviceGetAccountingStats(self, gpu, pid):
+        self._call('nvmlDeviceGetAccountingStats', gpu)
+        if pid not in gpu.accounting_stats:
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_NOT_FOUND)
+        gpu_util, memory_util, max_memory = gpu.accounting_stats[pid]
+        return types.SimpleNamespace(
+            gpuUtilization=gpu_util, memoryUtilization=memory_util,
+            maxMemoryUsage=max_memory, time=0, startTime=0, isRunning=1)
+
+    def nvmlDeviceGetPcieThroughput(self, gpu, counter):
+        self._call('nvmlDeviceGetPcieThroughput', gpu)
+        return gpu.pcie_throughput[counter]
+
+    def nvmlDeviceGetNvLinkState(self, gpu, link):
+        self._call('nvmlDeviceGetNvLinkState', gpu)
+        if link >= len(gpu.nvlinks):
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_INVALID_ARGUMENT)
+        if gpu.nvlinks[link] is None:
+            return pynvml.NVML_FEATURE_DISABLED
+        return pynvml.NVML_FEATURE_ENABLED
+
+    def nvmlDeviceGetNvLinkUtilizationCounter(self, gpu, link, counter):
+        self._call('nvmlDeviceGetNvLinkUtilizationCounter', gpu)
+        return gpu.nvlinks[link]
+
+    def nvmlDeviceGetMigMode(self, gpu):
+        self._call('nvmlDeviceGetMigMode', gpu)
+        return gpu.mig_mode, gpu.mig_mode
+
+    def nvmlDeviceGetMaxMigDeviceCount(self, gpu):
+        self._call('nvmlDeviceGetMaxMigDeviceCount', gpu)
+        return 7
+
+    def nvmlDeviceGetMigDeviceHandleByIndex(self, gpu, index):
+        self._call('nvmlDeviceGetMigDeviceHandleByIndex', gpu)
+        if index >= len(gpu.mig_devices) or gpu.mig_devices[index] is None:
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_NOT_FOUND)
+        return gpu.mig_devices[index]
+
+    def nvmlDeviceGetGpuInstanceId(self, gpu):
+        self._call('nvmlDeviceGetGpuInstanceId', gpu)
+        return gpu.gpu_instance_id
+
+    def nvmlDeviceGetComputeInstanceId(self, gpu):
+        self._call('nvmlDeviceGetComputeInstanceId', gpu)
+        return gpu.compute_instance_id
+
+    def nvmlDeviceGetSupportedClocksThrottleReasons(self, gpu):
+        self._call('nvmlDeviceGetSupportedClocksThrottleReasons', gpu)
+        return gpu.supported_throttle_reasons
+
+    def nvmlDeviceGetCurrentClocksThrottleReasons(self, gpu):
+        self._call('nvmlDeviceGetCurrentClocksThrottleReasons', gpu)
+        return gpu.throttle_reasons
+
+    def nvmlEventSetCreate(self):
+        self._call('nvmlEventSetCreate')
+        event_set = FakeEventSet()
+        self.event_sets.append(event_set)
+        return event_set
+
+    def nvmlEventSetFree(self, event_set):
+        self._call('nvmlEventSetFree')
+        event_set.freed = True
+
+    def nvmlDeviceGetSupportedEventTypes(self, gpu):
+        self._call('nvmlDeviceGetSupportedEventTypes', gpu)
+        return gpu.supported_event_types
+
+    def nvmlDeviceRegisterEvents(self, gpu, event_types, event_set):
+        self._call('nvmlDeviceRegisterEvents', gpu)
+        event_set.registered[gpu.index] = event_types
+
+    def nvmlEventSetWait(self, event_set, timeout_ms):
+        self._call('nvmlEventSetWait')
+        if not event_set.events:
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_TIMEOUT)
+        return event_set.events.popleft()
+
+    def send_event(self, gpu, event_type, event_data=0):
+        """Deliver an event to the event sets registered for it"""
+        for event_set in self.event_sets:
+            if event_set.registered.get(gpu.index, 0) & event_type:
+                event_set.events.append(types.SimpleNamespace(
+                    device=gpu, eventType=event_type, eventData=event_data))
@@ -0,0 +1,73 @@
+# Copyright (c) 2018 StackHPC Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+import unittest
+
+import mock
+from py3nvml import py3nvml as pynvml
+
+import stackhpc_monasca_agent_plugins.checks.nvidia as nvidia
+import stackhpc_monasca_agent_plugins.tests.benchmarks.bench_nvidia \
+    as bench_nvidia
+from stackhpc_monasca_agent_plugins.tests import fake_pynvml
+
+
+class TestFakePynvml(unittest.TestCase):
+    def test_latency(self):
+        nvml = fake_pynvml.FakePynvml(
+            latency=0.01, latencies={'nvmlDeviceGetCount': 0})
+        start = time.time()
+        nvml.nvmlInit()
+        nvml.nvmlDeviceGetCount()
+        self.assertGreaterEqual(time.time() - start, 0.01)
+        self.assertEqual(1, nvml.calls['nvmlInit'])
+
+    def test_not_supported(self):
+        nvml = fake_pynvml.FakePynvml(
+            gpu_count=2, not_supported=('nvmlDeviceGetFanSpeed',))
+        nvml.nvmlInit()
+        for gpu in nvml.gpus:
+            with self.assertRaises(pynvml.NVMLError) as cm:
+                nvml.nvmlDeviceGetFanSpeed(gpu)
+            self.assertEqual(pynvml.NVML_ERROR_NOT_SUPPORTED,
+                             cm.exception.value)
+            self.assertEqual(40, nvml.nvmlDeviceGetTemperature(
+                gpu, pynvml.NVML_TEMPERATURE_GPU))
+
+
+class TestBenchmarkNvidia(unittest.TestCase):
+    def test_run(self):
+        results = bench_nvidia.run(gpus=(2,), latency=0, checks_count=2)
+        self.assertEqual('nvidia', results['benchmark'])
+        result, = results['results']
+        stages = result['stages']
+        self.assertEqual(['first_check', 'cached_check', 'uncached_check'],
+                         list(stages))
+        # Caching saves NVML calls on every check after the first
+        self.assertLess(stages['cached_check']['nvml_calls_per_check'],
+                        stages['first_check']['nvml_calls_per_check'])
+        self.assertLess(stages['cached_check']['nvml_calls_per_check'],
+                        stages['uncached_check']['nvml_calls_per_check'])
+        for stage in stages.values():
+            self.assertIn('seconds_per_check', stage)
+            self.assertIn('peak_bytes', stage)
+
+    def test_checks_post_metrics(self):
+        check = bench_nvidia._BenchmarkNvidia()
+        nvml = fake_pynvml.FakePynvml(gpu_count=2)
+        with mock.patch.object(nvidia, 'pynvml', nvml):
+            check.check({})
+            check.stop()
+        self.assertGreater(check.posted, 0)
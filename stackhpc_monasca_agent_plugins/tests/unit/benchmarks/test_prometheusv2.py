@@ -0,0 +1,87 @@
+# Copyright (c) 2018 StackHPC Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+
+from prometheus_client.parser import text_string_to_metric_families
+
+from stackhpc_monasca_agent_plugins.common import prometheus
+import stackhpc_monasca_agent_plugins.tests.benchmarks.bench_prometheusv2 \
+    as bench_prometheusv2
+import stackhpc_monasca_agent_plugins.tests.benchmarks.common as common
+
+
+class TestGeneratePayload(unittest.TestCase):
+    def test_generate_payload(self):
+        text = bench_prometheusv2.generate_payload(
+            families=4, series=3, labels=5, label_length=10, style='ceph')
+        families = list(text_string_to_metric_families(text))
+        self.assertEqual(['counter', 'gauge', 'counter', 'gauge'],
+                         [family.type for family in families])
+        samples = [sample for family in families
+                   for sample in family.samples]
+        self.assertEqual(12, len(samples))
+        self.assertEqual('ceph_osd_metric_0_total', samples[0].name)
+        self.assertEqual({'ceph_daemon': 'osd.0xxxxx',
+                          'ceph_label_1': 'b' * 10,
+                          'ceph_label_2': 'c' * 10,
+                          'ceph_label_3': 'd' * 10,
+                          'ceph_label_4': 'e' * 10},
+                         samples[0].labels)
+
+    def test_run(self):
+        results = bench_prometheusv2.run(samples=(40,), families=4)
+        self.assertEqual('prometheusv2', results['benchmark'])
+        result, = results['results']
+        self.assertEqual(40, result['params']['samples'])
+        self.assertEqual(['parse', 'store', 'derive', 'emit'],
+                         list(result['stages']))
+        for stage in result['stages'].values():
+            self.assertEqual({'seconds', 'peak_bytes'}, set(stage))
+
+    def test_derived_metrics(self):
+        text = bench_prometheusv2.generate_payload(families=4, series=3)
+        check = bench_prometheusv2._BenchmarkPrometheusV2()
+        metrics = prometheus.MetricStore()
+        check._parse_metrics(metrics, text_string_to_metric_families(text))
+        check._compute_derived_metrics(
+            metrics, {'derived_metrics':
+                      bench_prometheusv2.derived_metrics_config()})
+        # Each operation produces results from the generated series
+        self.assertEqual(3, len(metrics.get_samples('benchmark_divide')))
+        self.assertEqual(1, len(metrics.get_samples('benchmark_sum')))
+        self.assertEqual(3, len(metrics.get_samples('benchmark_counter')))
+
+
+class TestCompareResults(unittest.TestCase):
+    def _results(self, seconds, peak_bytes):
+        return common.make_results('test', [
+            {'params': {'samples': 10},
+             'stages': {'parse': {'seconds': seconds,
+                                  'peak_bytes': peak_bytes}}}])
+
+    def test_compare_results(self):
+        baseline = self._results(1.0, 1000)
+        self.assertEqual(
+            [], common.compare_results(baseline, self._results(1.1, 1100)))
+        regressions = common.compare_results(
+            baseline, self._results(1.5, 1100))
+        self.assertEqual(1, len(regressions))
+        self.assertIn('parse seconds', regressions[0])
+
+    def test_compare_results_different_params(self):
+        baseline = self._results(1.0, 1000)
+        current = self._results(2.0, 2000)
+        current['results'][0]['params']['samples'] = 20
+        self.assertEqual([], common.compare_results(baseline, current))
@@ -0,0 +1,77 @@
+# Copyright (c) 2018 StackHPC Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from stackhpc_monasca_agent_plugins.checks import slurm
+import stackhpc_monasca_agent_plugins.tests.benchmarks.bench_slurm \
+    as bench_slurm
+
+
+class TestGenerateScontrolOutput(unittest.TestCase):
+    def test_generate_hostlist(self):
+        rng = random.Random(0)
+        for count in (1, 2, 7, 100, 1024, 5000):
+            hostlist = bench_slurm.generate_hostlist(rng, 1000, count)
+            node_names = slurm.Slurm._extract_node_names(hostlist)
+            self.assertEqual(min(count, 1000), len(node_names))
+            for name in node_names:
+                self.assertLess(int(name[len('compute-'):]), 1000)
+
+    def test_generate_job_list(self):
+        lines = bench_slurm.generate_job_list(jobs=200, nodes=100)
+        self.assertEqual(200, len(lines))
+        records = [slurm.Slurm._parse_job(line) for line in lines]
+        states = {record['job_state'] for record in records if record}
+        self.assertEqual({'RUNNING', 'PENDING'}, states)
+        # Finished jobs aren't reported
+        self.assertIn(None, records)
+        for record in records:
+            if record and record['job_state'] == 'PENDING':
+                self.assertIn(record['partition'], bench_slurm._PARTITIONS)
+        # The same seed generates the same output
+        self.assertEqual(lines,
+                         bench_slurm.generate_job_list(jobs=200, nodes=100))
+
+    def test_generate_node_list(self):
+        lines = bench_slurm.generate_node_list(nodes=50)
+        check = bench_slurm._BenchmarkSlurm([], lines)
+        nodes = check._get_nodes()
+        self.assertEqual(50, len(nodes))
+        self.assertEqual(4, nodes['compute-0']['gpus_total'])
+        self.assertEqual(2, nodes['compute-0']['gpus_allocated'])
+        self.assertEqual(0, nodes['compute-49']['gpus_total'])
+
+    def test_write_fixtures(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        bench_slurm.write_fixtures(directory, 10, 20, 4, 0)
+        with open(os.path.join(directory, 'slurm_job_list')) as job_list:
+            self.assertEqual(20, len(job_list.read().splitlines()))
+        with open(os.path.join(directory, 'slurm_node_list')) as node_list:
+            self.assertEqual(10, len(node_list.read().splitlines()))
+
+    def test_run(self):
+        results = bench_slurm.run(nodes=20, jobs=(30,))
+        self.assertEqual('slurm', results['benchmark'])
+        result, = results['results']
+        self.assertEqual(30, result['stages']['parse_jobs']['items'])
+        self.assertEqual(20, result['stages']['get_nodes']['items'])
+        for stage in result['stages'].values():
+            self.assertIn('seconds', stage)
+            self.assertIn('peak_bytes', stage)
@@ -0,0 +1,348 @@
+# Copyright (c) 2018 StackHPC Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+import stackhpc_monasca_agent_plugins.checks.ib_network as ib_network
+
+
+class MockIBNetworkPlugin(ib_network.IBNetwork):
+    def __init__(self):
+        # Don't call the base class constructor
+        self._previous = {}
+        self._counter_files = {}
+        self._samplers = {}
+
+    @staticmethod
+    def _set_dimensions(dimensions, instance=None):
+        new_dimensions = {'hostname': 'dummy_hostname'}
+        new_dimensions.update(dimensions)
+        return new_dimensions
+
+
+class TestIBNetwork(unittest.TestCase):
+    def setUp(self):
+        self.sysfs = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.sysfs)
+        self.instance = {'name': 'ib_network_stats',
+                         'ib_device_path': self.sysfs}
+        self.ib_network = MockIBNetworkPlugin()
+        self.addCleanup(self.ib_network.stop)
+
+    def _write_counters(self, hca, port, directory, counters):
+        path = os.path.join(self.sysfs, hca, 'ports', str(port), directory)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name, value in counters.items():
+            with open(os.path.join(path, name), 'w') as counter_file:
+                counter_file.write('{}\n'.format(value))
+
+    def _check(self, timestamp):
+        with mock.patch.object(ib_network.time, 'time',
+                               return_value=timestamp):
+            with mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                            autospec=True) as mock_gauge:
+                self.ib_network.check(self.instance)
+        return {(c[0][1], c[1]['dimensions']['hca'],
+                 c[1]['dimensions']['port']): c[0][2]
+                for c in mock_gauge.call_args_list}
+
+    def test_find_counters(self):
+        self._write_counters('mlx5_0', 1, 'counters', {
+            'port_xmit_data': 100, 'port_rcv_data': 200,
+            'symbol_error': 3})
+        self._write_counters('mlx5_0', 1, 'counters_ext', {
+            'port_xmit_data_64': 2 ** 40})
+        self._write_counters('mlx5_0', 1, 'hw_counters', {
+            'out_of_buffer': 7, 'lifespan': 10})
+        port_path = os.path.join(self.sysfs, 'mlx5_0', 'ports', '1')
+        counters = ib_network._CounterFiles._find_counters(port_path)
+        self.assertEqual({
+            'port_xmit_data': (
+                os.path.join(port_path, 'counters_ext', 'port_xmit_data_64'),
+                None),
+            'port_rcv_data': (
+                os.path.join(port_path, 'counters', 'port_rcv_data'), 32),
+            'symbol_error': (
+                os.path.join(port_path, 'counters', 'symbol_error'), None),
+            'hw_out_of_buffer': (
+                os.path.join(port_path, 'hw_counters', 'out_of_buffer'),
+                None),
+        }, counters)
+
+    def test_read_counters(self):
+        for hca, port in (('mlx5_0', 1), ('mlx5_1', 1), ('mlx5_1', 2)):
+            self._write_counters(hca, port, 'counters', {
+                'port_rcv_data': port})
+        counter_files = ib_network._CounterFiles(self.sysfs)
+        self.addCleanup(counter_files.close)
+        counter_files.refresh()
+        self.assertEqual({
+            ('mlx5_0', '1'): {'port_rcv_data': (1, 32)},
+            ('mlx5_1', '1'): {'port_rcv_data': (1, 32)},
+            ('mlx5_1', '2'): {'port_rcv_data': (2, 32)},
+        }, counter_files.read())
+
+    def test_check_port_filter(self):
+        for hca, port in (('mlx5_0', 1), ('mlx5_1', 1), ('mlx5_1', 2)):
+            self._write_counters(hca, port, 'counters', {'symbol_error': 0})
+        self.instance.update({'hca': 'mlx5_1', 'port': '2'})
+        self._check(100)
+        self.assertEqual({
+            ('ib_network.symbol_error_per_second', 'mlx5_1', '2'): 0.0,
+        }, self._check(110))
+
+    def test_read_counters_missing(self):
+        counter_files = ib_network._CounterFiles(
+            os.path.join(self.sysfs, 'missing'))
+        counter_files.refresh()
+        self.assertEqual({}, counter_files.read())
+
+    def test_unreadable_counter_skipped(self):
+        self._write_counters('mlx5_0', 1, 'counters', {
+            'symbol_error': 0, 'unsupported': 'N/A'})
+        counter_files = ib_network._CounterFiles(self.sysfs)
+        self.addCleanup(counter_files.close)
+        counter_files.refresh()
+        self.assertEqual({('mlx5_0', '1'): {'symbol_error': (0, None)}},
+                         counter_files.read())
+        self.assertFalse(counter_files.stale)
+
+    def test_files_opened_once(self):
+        self._write_counters('mlx5_0', 1, 'counters', {
+            'symbol_error': 0, 'port_rcv_data': 0})
+        with mock.patch.object(ib_network.os, 'open',
+                               wraps=os.open) as mock_open:
+            for timestamp in (100, 110, 120):
+                self._check(timestamp)
+        self.assertEqual(2, mock_open.call_count)
+
+    def test_hot_plug(self):
+        self._write_counters('mlx5_0', 1, 'counters', {'symbol_error': 0})
+        self._check(100)
+        self._write_counters('mlx5_1', 1, 'counters', {'symbol_error': 0})
+        self._check(110)
+        self._write_counters('mlx5_1', 1, 'counters', {'symbol_error': 1})
+        self.assertEqual({
+            ('ib_network.symbol_error_per_second', 'mlx5_0', '1'): 0.0,
+            ('ib_network.symbol_error_per_second', 'mlx5_1', '1'): 0.1,
+        }, self._check(120))
+
+    def test_read_error_rediscovers(self):
+        self._write_counters('mlx5_0', 1, 'counters', {'symbol_error': 0})
+        self._check(100)
+        counter_files = self.ib_network._counter_files[self.sysfs]
+        with mock.patch.object(ib_network.os, 'pread',
+                               side_effect=OSError(19, 'No such device')):
+            self._check(110)
+        self.assertTrue(counter_files.stale)
+        with mock.patch.object(ib_network.os, 'open',
+                               wraps=os.open) as mock_open:
+            self._check(120)
+        self.assertEqual(1, mock_open.call_count)
+
+    def test_stop_closes_files(self):
+        self._write_counters('mlx5_0', 1, 'counters', {'symbol_error': 0})
+        self._check(100)
+        with mock.patch.object(ib_network.os, 'close',
+                               wraps=os.close) as mock_close:
+            self.ib_network.stop()
+        self.assertEqual(1, mock_close.call_count)
+        self.assertEqual({}, self.ib_network._counter_files)
+
+    def test_counter_delta(self):
+        delta = ib_network.IBNetwork._counter_delta
+        self.assertEqual(10, delta(100, 110))
+        # The counter was reset
+        self.assertIsNone(delta(2 ** 32 - 10, 10))
+        self.assertIsNone(delta(100, 10))
+
+    def test_rate_32_bit_counter_reset(self):
+        # A 32 bit counter saturates rather than wrapping, so has been reset
+        self.assertIsNone(ib_network.IBNetwork._rate(
+            'port_xmit_data', (0, 1000), (30, 10), 32))
+
+    def test_check_rates(self):
+        self._write_counters('mlx5_0', 1, 'counters', {
+            'port_xmit_data': 1000, 'port_rcv_packets': 50})
+        self._write_counters('mlx5_0', 1, 'hw_counters', {
+            'out_of_sequence': 0})
+        # The first check only records the counters
+        self.assertEqual({}, self._check(100))
+        self._write_counters('mlx5_0', 1, 'counters', {
+            'port_xmit_data': 3500, 'port_rcv_packets': 150})
+        self._write_counters('mlx5_0', 1, 'hw_counters', {
+            'out_of_sequence': 5})
+        self.assertEqual({
+            ('ib_network.port_xmit_bytes_per_second', 'mlx5_0', '1'): 1000.0,
+            ('ib_network.port_rcv_packets_per_second', 'mlx5_0', '1'): 10.0,
+            ('ib_network.hw_out_of_sequence_per_second', 'mlx5_0', '1'): 0.5,
+        }, self._check(110))
+
+    def test_check_extended_counters_preferred(self):
+        self._write_counters('mlx4_0', 1, 'counters', {
+            'port_rcv_data': 2 ** 32 - 1})
+        self._write_counters('mlx4_0', 1, 'counters_ext', {
+            'port_rcv_data_64': 2 ** 33})
+        self._check(100)
+        # The legacy counter is saturated, but the extended one is not
+        self._write_counters('mlx4_0', 1, 'counters_ext', {
+            'port_rcv_data_64': 2 ** 33 + 100})
+        self.assertEqual({
+            ('ib_network.port_rcv_bytes_per_second', 'mlx4_0', '1'): 40.0,
+        }, self._check(110))
+
+    def test_check_32_bit_reset(self):
+        self._write_counters('mlx4_0', 1, 'counters', {
+            'port_xmit_packets': 2 ** 32 - 50})
+        self._check(100)
+        # The counter does not wrap, so was reset
+        self._write_counters('mlx4_0', 1, 'counters', {
+            'port_xmit_packets': 50})
+        self.assertEqual({}, self._check(110))
+        self._write_counters('mlx4_0', 1, 'counters', {
+            'port_xmit_packets': 150})
+        self.assertEqual({
+            ('ib_network.port_xmit_packets_per_second', 'mlx4_0', '1'): 10.0,
+        }, self._check(120))
+
+    def test_check_saturated(self):
+        self._write_counters('mlx4_0', 1, 'counters', {
+            'port_xmit_packets': 2 ** 32 - 50})
+        self._check(100)
+        self._write_counters('mlx4_0', 1, 'counters', {
+            'port_xmit_packets': 2 ** 32 - 1})
+        self.assertEqual({}, self._check(110))
+
+    def test_check_reset(self):
+        self._write_counters('mlx5_0', 1, 'counters', {
+            'symbol_error': 10})
+        self._check(100)
+        self._write_counters('mlx5_0', 1, 'counters', {
+            'symbol_error': 0})
+        self.assertEqual({}, self._check(110))
+        self._write_counters('mlx5_0', 1, 'counters', {
+            'symbol_error': 2})
+        self.assertEqual({
+            ('ib_network.symbol_error_per_second', 'mlx5_0', '1'): 0.2,
+        }, self._check(120))
+
+    def test_check_port_removed(self):
+        self._write_counters('mlx5_0', 1, 'counters', {'symbol_error': 0})
+        self._write_counters('mlx5_1', 1, 'counters', {'symbol_error': 0})
+        self._check(100)
+        shutil.rmtree(os.path.join(self.sysfs, 'mlx5_1'))
+        self._check(110)
+        self.assertEqual([('mlx5_0', '1', 'symbol_error')],
+                         list(self.ib_network._previous))
+
+
+class TestIBNetworkSampler(unittest.TestCase):
+    def setUp(self):
+        self.sysfs = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.sysfs)
+        self.counters_path = os.path.join(self.sysfs, 'mlx5_0', 'ports', '1',
+                                          'counters')
+        os.makedirs(self.counters_path)
+        self._write_counters({'port_xmit_wait': 0, 'symbol_error': 0,
+                              'port_xmit_data': 0})
+        self.counter_files = ib_network._CounterFiles(self.sysfs)
+        self.addCleanup(self.counter_files.close)
+        self.counter_files.refresh()
+
+    def _write_counters(self, counters):
+        for name, value in counters.items():
+            with open(os.path.join(self.counters_path, name),
+                      'w') as counter_file:
+                counter_file.write('{}\n'.format(value))
+
+    def _sample(self, sampler, timestamp, counters):
+        self._write_counters(counters)
+        with mock.patch.object(ib_network.time, 'time',
+                               return_value=timestamp):
+            sampler.sample()
+
+    def test_summary(self):
+        sampler = ib_network._Sampler(self.counter_files, 0.1,
+                                      ['port_xmit_wait', 'port_xmit_data'])
+        self._sample(sampler, 10.0, {})
+        for timestamp, wait in ((10.1, 0), (10.2, 50), (10.3, 100),
+                                (10.4, 100), (10.5, 110)):
+            self._sample(sampler, timestamp, {'port_xmit_wait': wait,
+                                              'symbol_error': 5})
+        summary = sampler.pop_summary('mlx5_0', '1')
+        self.assertEqual(
+            ['port_xmit_bytes_bursts', 'port_xmit_bytes_per_second_mean',
+             'port_xmit_bytes_per_second_peak', 'port_xmit_wait_bursts',
+             'port_xmit_wait_per_second_mean',
+             'port_xmit_wait_per_second_peak'],
+            sorted(summary))
+        self.assertAlmostEqual(500.0,
+                               summary['port_xmit_wait_per_second_peak'])
+        self.assertAlmostEqual(220.0,
+                               summary['port_xmit_wait_per_second_mean'])
+        # Two separate bursts of congestion
+        self.assertEqual(2, summary['port_xmit_wait_bursts'])
+        self.assertEqual(0, summary['port_xmit_bytes_bursts'])
+        # The samples are only summarised once
+        self.assertEqual({}, sampler.pop_summary('mlx5_0', '1'))
+
+    def test_burst_rate(self):
+        sampler = ib_network._Sampler(self.counter_files, 0.1,
+                                      ['port_xmit_wait'], burst_rate=100)
+        self._sample(sampler, 10.0, {})
+        for timestamp, wait in ((11, 50), (12, 250), (13, 300)):
+            self._sample(sampler, timestamp, {'port_xmit_wait': wait})
+        summary = sampler.pop_summary('mlx5_0', '1')
+        self.assertEqual(1, summary['port_xmit_wait_bursts'])
+
+    def test_window(self):
+        sampler = ib_network._Sampler(self.counter_files, 0.1,
+                                      ['symbol_error'], window=2)
+        self._sample(sampler, 10, {})
+        for timestamp, errors in ((11, 10), (12, 10), (13, 11)):
+            self._sample(sampler, timestamp, {'symbol_error': errors})
+        summary = sampler.pop_summary('mlx5_0', '1')
+        # The first rate has dropped out of the window
+        self.assertEqual(1.0, summary['symbol_error_per_second_peak'])
+        self.assertEqual(0.5, summary['symbol_error_per_second_mean'])
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    def test_check_sampler_thread(self, mock_gauge):
+        ib = MockIBNetworkPlugin()
+        self.addCleanup(ib.stop)
+        instance = {'ib_device_path': self.sysfs, 'sample_interval': 0.01,
+                    'sample_counters': ['symbol_error']}
+        ib.check(instance)
+        sampler = ib._samplers[self.sysfs]
+        self.assertTrue(sampler._thread.is_alive())
+        for _ in range(100):
+            if sampler._buffers.get(('mlx5_0', '1')):
+                break
+            threading.Event().wait(0.01)
+        ib.check(instance)
+        mock_gauge.assert_any_call(
+            mock.ANY, 'ib_network.symbol_error_per_second_peak', 0.0,
+            device_name='mlx5_0',
+            dimensions={'hostname': 'dummy_hostname', 'hca': 'mlx5_0',
+                        'port': '1'})
+        ib.stop()
+        self.assertFalse(sampler._thread.is_alive())
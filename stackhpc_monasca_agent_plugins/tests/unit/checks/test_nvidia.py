@@ -12,17 +12,42 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 import mock
 from py3nvml import py3nvml as pynvml
 import stackhpc_monasca_agent_plugins.checks.nvidia as nvidia
+from stackhpc_monasca_agent_plugins.common import instrumentation
+from stackhpc_monasca_agent_plugins.tests import fake_pynvml
 
 
 class MockNvidiaPlugin(nvidia.Nvidia):
     def __init__(self):
         # Don't call the base class constructor
-        pass
+        self._nvml_initialised = False
+        self._driver_version = None
+        self._gpu_handles = []
+        self._gpu_handles_by_uuid = {}
+        self._static_gpu_info = []
+        self._executor = None
+        self._executor_threads = None
+        self._gpu_futures = {}
+        self._sampler = None
+        self._driver_sample_times = {}
+        self._process_resolver = nvidia._ProcessResolver()
+        self._nvlink_rates = nvidia._CounterRates()
+        self._event_set = None
+        self._event_types = {}
+        self._throttle_counts = collections.defaultdict(collections.Counter)
+        self._dcgm_exporter_session = None
+        self._instrumentation = instrumentation.CheckInstrumentation('nvidia')
+        self._unsupported_queries = nvidia._UnsupportedQueries()
 
     @staticmethod
     def _set_dimensions(dimensions, instance=None):
@@ -49,3 +74,1061 @@ class TestNvidiaNetwork(unittest.TestCase):
         actual = self.nvidia._get_driver_version()
         expected = {}
         self.assertDictEqual(actual, expected)
+
+
+class TestNvidiaSession(unittest.TestCase):
+    def setUp(self):
+        self.nvml = fake_pynvml.FakePynvml(gpu_count=2)
+        patcher = mock.patch.object(nvidia, 'pynvml', self.nvml)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.nvidia = MockNvidiaPlugin()
+        self.addCleanup(self.nvidia.stop)
+
+    def test_nvml_initialised_once(self):
+        first = self.nvidia._get_gpu_info()
+        second = self.nvidia._get_gpu_info()
+        self.assertEqual(first, second)
+        self.assertEqual(2, len(second))
+        self.assertEqual(1, self.nvml.calls['nvmlInit'])
+        self.assertEqual(0, self.nvml.calls['nvmlShutdown'])
+        self.assertEqual(2, self.nvml.calls['nvmlDeviceGetHandleByIndex'])
+
+    def test_handles_cached(self):
+        self.nvidia._get_gpu_info()
+        self.assertEqual(self.nvml.gpus, self.nvidia._gpu_handles)
+        self.assertEqual({gpu.uuid: gpu for gpu in self.nvml.gpus},
+                         self.nvidia._gpu_handles_by_uuid)
+
+    def test_reinit_uninitialised(self):
+        self.nvidia._get_gpu_info()
+        # For example, another process shut down NVML
+        self.nvml.initialised = False
+        self.assertEqual(2, len(self.nvidia._get_gpu_info()))
+        self.assertEqual(2, self.nvml.calls['nvmlInit'])
+
+    def test_reinit_gpu_lost(self):
+        self.nvidia._get_gpu_info()
+        self.nvml.gpus[1].lost = True
+        self.assertEqual(2, len(self.nvidia._get_gpu_info()))
+        self.assertEqual(2, self.nvml.calls['nvmlInit'])
+        self.assertEqual(1, self.nvml.calls['nvmlShutdown'])
+
+    def test_reinit_driver_reloaded(self):
+        self.nvidia._get_gpu_info()
+        self.nvml.driver_version = '440.33.01'
+        gpu_info = self.nvidia._get_gpu_info()
+        self.assertEqual(2, self.nvml.calls['nvmlInit'])
+        self.assertEqual('440.33.01',
+                         gpu_info[0]['dimensions']['driver_version'])
+
+    def test_reinit_gpu_removed(self):
+        self.nvidia._get_gpu_info()
+        del self.nvml.gpus[1]
+        self.assertEqual(1, len(self.nvidia._get_gpu_info()))
+        self.assertEqual(2, self.nvml.calls['nvmlInit'])
+
+    def test_unrecoverable_error(self):
+        self.nvml.nvmlDeviceGetFanSpeed = mock.Mock(
+            side_effect=pynvml.NVMLError(pynvml.NVML_ERROR_NO_PERMISSION))
+        self.assertEqual([], self.nvidia._get_gpu_info())
+        self.assertEqual(1, self.nvml.calls['nvmlInit'])
+
+    def test_stop(self):
+        self.nvidia._get_gpu_info()
+        self.nvidia.stop()
+        self.assertEqual(1, self.nvml.calls['nvmlShutdown'])
+        self.assertFalse(self.nvml.initialised)
+        self.assertEqual([], self.nvidia._gpu_handles)
+
+
+class TestNvidiaStaticInfo(unittest.TestCase):
+    # NVML calls made for each GPU on every check
+    _DYNAMIC_CALLS = {
+        'nvmlDeviceGetPowerState': 1,
+        'nvmlDeviceGetFanSpeed': 1,
+        'nvmlDeviceGetMemoryInfo': 1,
+        'nvmlDeviceGetBAR1MemoryInfo': 1,
+        'nvmlDeviceGetUtilizationRates': 1,
+        'nvmlDeviceGetTemperature': 1,
+        'nvmlDeviceGetPowerUsage': 1,
+        'nvmlDeviceGetPowerManagementLimit': 1,
+        'nvmlDeviceGetClockInfo': 4,
+        'nvmlDeviceGetMigMode': 1,
+        'nvmlDeviceGetCurrentClocksThrottleReasons': 1,
+    }
+
+    def setUp(self):
+        self.nvml = fake_pynvml.FakePynvml(gpu_count=2)
+        patcher = mock.patch.object(nvidia, 'pynvml', self.nvml)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.nvidia = MockNvidiaPlugin()
+
+    def test_static_info(self):
+        gpu_info = self.nvidia._get_gpu_info()[1]
+        gpu = self.nvml.gpus[1]
+        self.assertEqual('{}_{}'.format(gpu.name, gpu.serial),
+                         gpu_info['name'])
+        expected_dimensions = {
+            'driver_version': '418.87.01',
+            'uuid': gpu.uuid,
+            'info_rom_image_version': gpu.info_rom_image_version,
+            'vbios_version': gpu.vbios_version,
+            'power_state': 'P0',
+        }
+        self.assertEqual(expected_dimensions, gpu_info['dimensions'])
+        self.assertEqual(90, gpu_info['measurements'][
+            'temperature_shutdown_deg_c'])
+        self.assertEqual(1530, gpu_info['measurements'][
+            'clock_max_freq_gpu_mhz'])
+        self.assertEqual(40, gpu_info['measurements']['temperature_deg_c'])
+
+    def test_static_info_cached(self):
+        self.nvidia._get_gpu_info()
+        self.nvml.calls.clear()
+        self.nvidia._get_gpu_info()
+        expected = {name: count * 2
+                    for name, count in self._DYNAMIC_CALLS.items()}
+        # Checks whether NVML needs to be initialised again
+        expected['nvmlSystemGetDriverVersion'] = 1
+        expected['nvmlDeviceGetCount'] = 1
+        self.assertEqual(expected, dict(self.nvml.calls))
+
+    def test_dynamic_info_updated(self):
+        self.nvidia._get_gpu_info()
+        self.nvml.gpus[0].temperature = 80
+        self.nvml.gpus[0].power_state = 2
+        gpu_info = self.nvidia._get_gpu_info()[0]
+        self.assertEqual(80, gpu_info['measurements']['temperature_deg_c'])
+        self.assertEqual('P2', gpu_info['dimensions']['power_state'])
+        # The cached attributes are not modified
+        self.assertNotIn('power_state',
+                         self.nvidia._static_gpu_info[0]['dimensions'])
+
+    def test_gpus(self):
+        gpu_info = self.nvidia._get_gpu_info({'gpus': [1]})
+        self.assertEqual([self.nvml.gpus[1].uuid],
+                         [gpu['dimensions']['uuid'] for gpu in gpu_info])
+        self.assertEqual(1, self.nvml.calls['nvmlDeviceGetPowerState'])
+
+    def test_stable_dimensions(self):
+        self.nvml.gpus[0].power_state = 2
+        gpu_info = self.nvidia._get_gpu_info({'stable_dimensions': True})[0]
+        self.assertNotIn('power_state', gpu_info['dimensions'])
+        self.assertEqual(2, gpu_info['measurements']['power_state'])
+        self.nvml.gpus[0].power_state = 8
+        next_info = self.nvidia._get_gpu_info({'stable_dimensions': True})[0]
+        self.assertEqual(gpu_info['dimensions'], next_info['dimensions'])
+        self.assertEqual(8, next_info['measurements']['power_state'])
+
+    def test_static_info_refreshed_on_driver_change(self):
+        self.nvidia._get_gpu_info()
+        self.nvml.driver_version = '440.33.01'
+        self.nvml.gpus[0].vbios_version = '88.00.80.00.01'
+        self.nvml.calls.clear()
+        gpu_info = self.nvidia._get_gpu_info()[0]
+        self.assertEqual('88.00.80.00.01',
+                         gpu_info['dimensions']['vbios_version'])
+        self.assertEqual(2, self.nvml.calls['nvmlDeviceGetVbiosVersion'])
+
+
+class TestNvidiaParallelCollection(unittest.TestCase):
+    def setUp(self):
+        self.nvml = fake_pynvml.FakePynvml(gpu_count=4)
+        patcher = mock.patch.object(nvidia, 'pynvml', self.nvml)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.nvidia = MockNvidiaPlugin()
+        self.addCleanup(self.nvidia.stop)
+        self.instance = {'collection_threads': 4, 'gpu_timeout': 0.2}
+
+    def _hang_gpu(self, index):
+        """Make a GPU block in an NVML call until released"""
+        release = threading.Event()
+        self.addCleanup(release.set)
+        get_fan_speed = self.nvml.nvmlDeviceGetFanSpeed
+
+        def hanging_get_fan_speed(gpu):
+            if gpu.index == index:
+                release.wait()
+            return get_fan_speed(gpu)
+        self.nvml.nvmlDeviceGetFanSpeed = hanging_get_fan_speed
+        return release
+
+    def test_gpus_collected_concurrently(self):
+        barrier = threading.Barrier(4, timeout=1)
+        get_fan_speed = self.nvml.nvmlDeviceGetFanSpeed
+
+        def get_fan_speed_together(gpu):
+            # Only returns if all GPUs are being queried at the same time
+            barrier.wait()
+            return get_fan_speed(gpu)
+        self.nvml.nvmlDeviceGetFanSpeed = get_fan_speed_together
+        gpu_info = self.nvidia._get_gpu_info(self.instance)
+        self.assertEqual(4, len(gpu_info))
+        # Results are in the same order as the GPUs
+        self.assertEqual([gpu.uuid for gpu in self.nvml.gpus],
+                         [info['dimensions']['uuid'] for info in gpu_info])
+
+    def test_hung_gpu_dropped(self):
+        release = self._hang_gpu(2)
+        gpu_info = self.nvidia._get_gpu_info(self.instance)
+        uuids = [info['dimensions']['uuid'] for info in gpu_info]
+        self.assertEqual([self.nvml.gpus[i].uuid for i in (0, 1, 3)], uuids)
+
+        # The hung GPU is not queried again until it responds
+        self.nvml.calls.clear()
+        self.assertEqual(3, len(self.nvidia._get_gpu_info(self.instance)))
+        self.assertEqual(3, self.nvml.calls['nvmlDeviceGetPowerState'])
+
+        release.set()
+        self.nvidia._gpu_futures[2].result(timeout=1)
+        self.assertEqual(4, len(self.nvidia._get_gpu_info(self.instance)))
+
+    def test_failed_gpu_dropped(self):
+        self.nvml.gpus[1].not_supported.add('nvmlDeviceGetMemoryInfo')
+        get_utilisation = self.nvml.nvmlDeviceGetUtilizationRates
+
+        def failing_get_utilisation(gpu):
+            if gpu.index == 3:
+                raise pynvml.NVMLError(pynvml.NVML_ERROR_UNKNOWN)
+            return get_utilisation(gpu)
+        self.nvml.nvmlDeviceGetUtilizationRates = failing_get_utilisation
+        gpu_info = self.nvidia._get_gpu_info(self.instance)
+        self.assertEqual(3, len(gpu_info))
+        # Unsupported measurements don't cause the GPU to be dropped
+        self.assertNotIn('memory_fb_used_bytes', gpu_info[1]['measurements'])
+
+    def test_optional_query_failed(self):
+        self.instance['pcie_throughput'] = True
+        get_throughput = self.nvml.nvmlDeviceGetPcieThroughput
+
+        def failing_get_throughput(gpu, counter):
+            if gpu.index == 1:
+                raise pynvml.NVMLError(pynvml.NVML_ERROR_UNKNOWN)
+            return get_throughput(gpu, counter)
+        self.nvml.nvmlDeviceGetPcieThroughput = failing_get_throughput
+        gpu_info = self.nvidia._get_gpu_info(self.instance)
+        # Only the optional measurements of the GPU are lost
+        self.assertEqual(4, len(gpu_info))
+        self.assertNotIn('pcie_tx_bytes_per_second',
+                         gpu_info[1]['measurements'])
+        self.assertIn('power_watts', gpu_info[1]['measurements'])
+        self.assertIn('pcie_tx_bytes_per_second',
+                      gpu_info[0]['measurements'])
+
+    def test_timeout_from_query_start(self):
+        # One thread is hung, and the other queries the remaining GPUs one
+        # after the other, taking longer than the timeout in total
+        self.instance['collection_threads'] = 2
+        self._hang_gpu(0)
+        get_fan_speed = self.nvml.nvmlDeviceGetFanSpeed
+
+        def slow_get_fan_speed(gpu):
+            if gpu.index:
+                time.sleep(0.1)
+            return get_fan_speed(gpu)
+        self.nvml.nvmlDeviceGetFanSpeed = slow_get_fan_speed
+        gpu_info = self.nvidia._get_gpu_info(self.instance)
+        self.assertEqual([self.nvml.gpus[i].uuid for i in (1, 2, 3)],
+                         [info['dimensions']['uuid'] for info in gpu_info])
+
+    def test_all_threads_hung(self):
+        self.instance['collection_threads'] = 1
+        release = self._hang_gpu(0)
+        start = time.time()
+        self.assertEqual([], self.nvidia._get_gpu_info(self.instance))
+        # The queued GPUs are given up on rather than waited for
+        self.assertLess(time.time() - start, 1)
+        self.assertTrue(all(self.nvidia._gpu_futures[i].cancelled()
+                            for i in (1, 2, 3)))
+        release.set()
+        self.nvidia._gpu_futures[0].result(timeout=1)
+        self.assertEqual(4, len(self.nvidia._get_gpu_info(self.instance)))
+
+    def test_hung_gpu_reinitialised(self):
+        get_fan_speed = self.nvml.nvmlDeviceGetFanSpeed
+        self._hang_gpu(2)
+        self.assertEqual(3, len(self.nvidia._get_gpu_info(self.instance)))
+        hung = self.nvidia._gpu_futures[2]
+        # The hung call is on a handle from before NVML is re-initialised,
+        # so it doesn't stop the new handle being queried
+        self.nvml.nvmlDeviceGetFanSpeed = get_fan_speed
+        self.nvml.driver_version = '440.33.01'
+        self.assertEqual(4, len(self.nvidia._get_gpu_info(self.instance)))
+        self.assertFalse(hung.done())
+        self.assertIsNot(hung, self.nvidia._gpu_futures[2])
+
+    def test_daemon_threads(self):
+        self.nvidia._get_gpu_info(self.instance)
+        threads = [thread for thread in threading.enumerate()
+                   if thread.name.startswith('nvidia-collector')]
+        self.assertTrue(threads)
+        # A hung NVML call can't stop the agent exiting
+        self.assertTrue(all(thread.daemon for thread in threads))
+
+
+class TestNvidiaUnsupportedQueries(unittest.TestCase):
+    def setUp(self):
+        self.nvml = fake_pynvml.FakePynvml(gpu_count=2)
+        patcher = mock.patch.object(nvidia, 'pynvml', self.nvml)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.nvidia = MockNvidiaPlugin()
+        self.addCleanup(self.nvidia.stop)
+        # For example, a passively cooled GPU
+        self.nvml.gpus[1].not_supported.add('nvmlDeviceGetFanSpeed')
+
+    def test_unsupported_query_skipped(self):
+        gpu_info = self.nvidia._get_gpu_info()
+        self.assertIn('fan_speed_percent', gpu_info[0]['measurements'])
+        self.assertNotIn('fan_speed_percent', gpu_info[1]['measurements'])
+        self.assertEqual(2, self.nvml.calls['nvmlDeviceGetFanSpeed'])
+        self.assertEqual(0, self.nvidia._unsupported_queries.pop_skipped())
+
+        gpu_info = self.nvidia._get_gpu_info()
+        self.assertNotIn('fan_speed_percent', gpu_info[1]['measurements'])
+        # Only the GPU which supports the query is asked again
+        self.assertEqual(3, self.nvml.calls['nvmlDeviceGetFanSpeed'])
+        self.assertEqual(1, self.nvidia._unsupported_queries.pop_skipped())
+        self.assertEqual({(nvidia._device_key(self.nvml.gpus[1]),
+                           '_get_fan_speed_percent')},
+                         self.nvidia._unsupported_queries.queries)
+
+    def test_unsupported_query_device_handle(self):
+        # The handles of the NVML bindings are ctypes pointers, which
+        # can't be hashed
+        gpu = pynvml.c_nvmlDevice_t(pynvml.struct_c_nvmlDevice_t())
+        self.assertRaises(TypeError, hash, gpu)
+        unsupported = nvidia._UnsupportedQueries()
+        error = pynvml.NVMLError(pynvml.NVML_ERROR_NOT_SUPPORTED)
+        with mock.patch.object(self.nvml, 'nvmlDeviceGetFanSpeed',
+                               side_effect=error) as mock_fan_speed:
+            for _ in range(2):
+                self.assertEqual({}, nvidia.Nvidia._get_fan_speed_percent(
+                    gpu, unsupported=unsupported))
+        self.assertEqual(1, mock_fan_speed.call_count)
+        self.assertEqual(1, unsupported.pop_skipped())
+
+    def test_unsupported_queries_cleared_on_reinit(self):
+        self.nvidia._get_gpu_info()
+        self.nvml.driver_version = '440.33.01'
+        self.nvml.gpus[1].not_supported.clear()
+        gpu_info = self.nvidia._get_gpu_info()
+        self.assertIn('fan_speed_percent', gpu_info[1]['measurements'])
+        self.assertEqual(set(), self.nvidia._unsupported_queries.queries)
+
+    def test_unsupported_query_expires(self):
+        self.nvidia._unsupported_queries.ttl = 0.05
+        self.nvidia._get_gpu_info()
+        self.assertEqual(1, len(self.nvidia._unsupported_queries.queries))
+        # For example, a setting of the GPU was changed
+        self.nvml.gpus[1].not_supported.clear()
+        time.sleep(0.06)
+        self.assertEqual(set(), self.nvidia._unsupported_queries.queries)
+        gpu_info = self.nvidia._get_gpu_info()
+        self.assertIn('fan_speed_percent', gpu_info[1]['measurements'])
+        self.assertEqual(0, self.nvidia._unsupported_queries.pop_skipped())
+
+    def test_unsupported_queries_per_check(self):
+        self.nvidia._get_gpu_info()
+        other = MockNvidiaPlugin()
+        self.addCleanup(other.stop)
+        self.assertEqual(1, len(self.nvidia._unsupported_queries.queries))
+        self.assertEqual(set(), other._unsupported_queries.queries)
+
+    def test_sampler_skips_not_counted(self):
+        self.nvml.gpus[1].not_supported.add('nvmlDeviceGetPowerUsage')
+        self.nvidia._get_gpu_info()
+        self.nvidia._unsupported_queries.pop_skipped()
+        sampler = nvidia._GpuSampler(interval=60)
+        sampler.set_gpus(self.nvidia._gpu_handles_by_uuid.items())
+        sampler.sample()
+        sampler.sample()
+        self.assertEqual(0, self.nvidia._unsupported_queries.pop_skipped())
+        self.assertEqual(1, sampler._unsupported.pop_skipped())
+
+    def test_accounting_not_remembered(self):
+        gpu = self.nvml.gpus[0]
+        gpu.processes = [(1234, 1024 ** 3)]
+        gpu.not_supported.add('nvmlDeviceGetAccountingStats')
+        self.nvidia._get_gpu_info({'process_metrics': True})
+        # Accounting mode is enabled
+        gpu.not_supported.clear()
+        gpu.accounting_stats = {1234: (80, 20, 2 * 1024 ** 3)}
+        gpu_info = self.nvidia._get_gpu_info({'process_metrics': True})
+        self.assertEqual(80, gpu_info[0]['processes'][0][
+            'utilisation_gpu_percent'])
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    def test_check_collector_metrics(self, mock_gauge):
+        self.nvidia.check({})
+        self.nvidia.check({})
+        calls = [
+            mock.call(mock.ANY, 'nvidia.collector.unsupported_queries', 1,
+                      dimensions={'hostname': 'dummy_hostname'}),
+            mock.call(mock.ANY, 'nvidia.collector.skipped_queries', 1,
+                      dimensions={'hostname': 'dummy_hostname'}),
+        ]
+        mock_gauge.assert_has_calls(calls)
+        self.assertEqual(
+            {'check_seconds', 'nvml_init_seconds', 'gpu_queries_seconds',
+             'events_seconds', 'emit_seconds'},
+            set(self.nvidia._instrumentation.last_run))
+        posted = [c[0][1] for c in mock_gauge.call_args_list]
+        self.assertIn('nvidia.collector.gpu_queries_seconds', posted)
+
+
+class TestNvidiaSampling(unittest.TestCase):
+    def setUp(self):
+        self.nvml = fake_pynvml.FakePynvml(gpu_count=2)
+        patcher = mock.patch.object(nvidia, 'pynvml', self.nvml)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.nvidia = MockNvidiaPlugin()
+        self.addCleanup(self.nvidia.stop)
+
+    def test_summarise(self):
+        expected = {
+            'power_watts_min': 1,
+            'power_watts_mean': 50.5,
+            'power_watts_max': 100,
+            'power_watts_p95': 95,
+        }
+        values = list(range(100, 0, -1))
+        self.assertEqual(expected, nvidia._summarise('power_watts', values))
+        self.assertEqual({}, nvidia._summarise('power_watts', []))
+
+    def test_sampler(self):
+        self.nvidia._get_gpu_info()
+        sampler = nvidia._GpuSampler(interval=0.01, window=3)
+        sampler.set_gpus(self.nvidia._gpu_handles_by_uuid.items())
+        gpu = self.nvml.gpus[0]
+        for utilisation in (90, 10, 20, 30):
+            gpu.utilisation_gpu = utilisation
+            sampler.sample()
+        summary = sampler.pop_summary(gpu.uuid)
+        # The first sample has dropped out of the window
+        self.assertEqual(10, summary['utilisation_gpu_percent_min'])
+        self.assertEqual(20.0, summary['utilisation_gpu_percent_mean'])
+        self.assertEqual(30, summary['utilisation_gpu_percent_max'])
+        self.assertEqual(30, summary['utilisation_gpu_percent_p95'])
+        self.assertEqual(60.0, summary['power_watts_max'])
+        self.assertEqual(40, summary['temperature_deg_c_mean'])
+        # Samples are only summarised once
+        self.assertEqual({}, sampler.pop_summary(gpu.uuid))
+
+    def test_sampler_gpu_failure(self):
+        self.nvidia._get_gpu_info()
+        sampler = nvidia._GpuSampler(interval=0.01)
+        sampler.set_gpus(self.nvidia._gpu_handles_by_uuid.items())
+        self.nvml.gpus[1].lost = True
+        sampler.sample()
+        self.assertIn('temperature_deg_c_max',
+                      sampler.pop_summary(self.nvml.gpus[0].uuid))
+        self.assertEqual({}, sampler.pop_summary(self.nvml.gpus[1].uuid))
+
+    def test_sampler_thread_error(self):
+        sampler = nvidia._GpuSampler(interval=0.01)
+        self.addCleanup(sampler.stop)
+        with mock.patch.object(sampler, 'sample',
+                               side_effect=[TypeError] + [None] * 1000):
+            sampler.start()
+            for _ in range(100):
+                if sampler.sample.call_count > 1:
+                    break
+                threading.Event().wait(0.01)
+            # The thread keeps sampling after an unexpected error
+            self.assertGreater(sampler.sample.call_count, 1)
+            self.assertTrue(sampler._thread.is_alive())
+            sampler.stop()
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    def test_sampler_thread(self, mock_gauge):
+        instance = {'sample_interval': 0.01}
+        self.nvidia.check(instance)
+        sampler = self.nvidia._sampler
+        self.assertTrue(sampler._thread.is_alive())
+        for _ in range(100):
+            if self.nvml.calls['nvmlDeviceGetTemperature'] > 10:
+                break
+            threading.Event().wait(0.01)
+        summary = sampler.pop_summary(self.nvml.gpus[1].uuid)
+        self.assertEqual(40, summary['temperature_deg_c_max'])
+        self.nvidia.stop()
+        self.assertFalse(sampler._thread.is_alive())
+
+    def test_driver_samples(self):
+        gpu = self.nvml.gpus[0]
+        gpu.samples[self.nvml.NVML_GPU_UTILIZATION_SAMPLES] = [
+            (1000, 10), (2000, 100), (3000, 40)]
+        gpu.samples[self.nvml.NVML_TOTAL_POWER_SAMPLES] = [
+            (1000, 50000), (2000, 150000)]
+        self.nvidia._get_gpu_info()
+        summary = self.nvidia._get_driver_sample_summary(gpu.uuid)
+        self.assertEqual(10, summary['utilisation_gpu_percent_min'])
+        self.assertEqual(50.0, summary['utilisation_gpu_percent_mean'])
+        self.assertEqual(100, summary['utilisation_gpu_percent_max'])
+        self.assertEqual(150.0, summary['power_watts_max'])
+
+        # Only samples newer than those already seen are summarised
+        gpu.samples[self.nvml.NVML_GPU_UTILIZATION_SAMPLES].append(
+            (4000, 70))
+        summary = self.nvidia._get_driver_sample_summary(gpu.uuid)
+        self.assertEqual({'utilisation_gpu_percent_min': 70,
+                          'utilisation_gpu_percent_mean': 70.0,
+                          'utilisation_gpu_percent_max': 70,
+                          'utilisation_gpu_percent_p95': 70}, summary)
+
+    def test_driver_samples_not_supported(self):
+        gpu = self.nvml.gpus[1]
+        gpu.not_supported.add('nvmlDeviceGetSamples')
+        self.nvidia._get_gpu_info()
+        self.assertEqual({},
+                         self.nvidia._get_driver_sample_summary(gpu.uuid))
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    def test_check_driver_samples(self, mock_gauge):
+        gpu = self.nvml.gpus[0]
+        gpu.samples[self.nvml.NVML_GPU_UTILIZATION_SAMPLES] = [
+            (1000, 10), (2000, 30)]
+        self.nvidia.check({'use_driver_samples': True})
+        mock_gauge.assert_any_call(
+            mock.ANY, 'nvidia.utilisation_gpu_percent_mean', 20.0,
+            device_name='{}_{}'.format(gpu.name, gpu.serial),
+            dimensions=mock.ANY, value_meta=None)
+
+
+class TestNvidiaProcesses(unittest.TestCase):
+    def setUp(self):
+        self.nvml = fake_pynvml.FakePynvml(gpu_count=2)
+        patcher = mock.patch.object(nvidia, 'pynvml', self.nvml)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.proc_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.proc_root)
+        self.nvidia = MockNvidiaPlugin()
+        self.nvidia._process_resolver = nvidia._ProcessResolver(
+            self.proc_root)
+
+    def _add_process(self, pid, cgroup):
+        os.mkdir(os.path.join(self.proc_root, str(pid)))
+        with open(os.path.join(self.proc_root, str(pid), 'cgroup'),
+                  'w') as cgroup_file:
+            cgroup_file.write(cgroup)
+
+    def test_resolve_slurm_job_cgroup_v1(self):
+        self._add_process(1234, (
+            '11:devices:/slurm/uid_1000/job_42/step_0/task_0\n'
+            '7:memory:/slurm/uid_1000/job_42/step_0/task_0\n'
+            '2:cpu,cpuacct:/\n'))
+        self.assertEqual(
+            {'cgroup': '/slurm/uid_1000/job_42/step_0/task_0',
+             'slurm_job_id': '42'},
+            self.nvidia._process_resolver.resolve(1234))
+
+    def test_resolve_container_cgroup_v2(self):
+        container_id = 'abc123' * 10 + 'abcd'
+        cgroup = '/system.slice/docker-{}.scope'.format(container_id)
+        self._add_process(1234, '0::{}\n'.format(cgroup))
+        self.assertEqual({'cgroup': cgroup, 'container_id': container_id},
+                         self.nvidia._process_resolver.resolve(1234))
+
+    def test_resolve_other_cgroup(self):
+        self._add_process(1234, '0::/user.slice/user-1000.slice\n')
+        self.assertEqual({'cgroup': '/user.slice/user-1000.slice'},
+                         self.nvidia._process_resolver.resolve(1234))
+
+    def test_resolve_missing_process(self):
+        self.assertEqual({}, self.nvidia._process_resolver.resolve(1234))
+
+    def test_resolve_cached(self):
+        resolver = self.nvidia._process_resolver
+        self._add_process(1234, '0::/slurm/uid_1000/job_42/step_0\n')
+        with mock.patch.object(resolver, '_read_cgroup',
+                               wraps=resolver._read_cgroup) as mock_read:
+            resolver.resolve(1234)
+            resolver.resolve(1234)
+            self.assertEqual(1, mock_read.call_count)
+            # PIDs which are no longer using a GPU are forgotten
+            resolver.prune([])
+            resolver.resolve(1234)
+            self.assertEqual(2, mock_read.call_count)
+
+    def test_process_info(self):
+        gpu = self.nvml.gpus[0]
+        gpu.processes = [(1234, 1024 ** 3), (5678, None)]
+        gpu.accounting_stats = {1234: (80, 20, 2 * 1024 ** 3)}
+        self.nvidia._get_gpu_info()
+        expected = [
+            {'pid': 1234,
+             'memory_used_bytes': 1024 ** 3,
+             'utilisation_gpu_percent': 80,
+             'utilisation_memory_percent': 20,
+             'memory_max_used_bytes': 2 * 1024 ** 3},
+            {'pid': 5678},
+        ]
+        self.assertEqual(expected, nvidia.Nvidia._get_process_info(gpu))
+
+    def test_process_info_accounting_disabled(self):
+        gpu = self.nvml.gpus[0]
+        gpu.processes = [(1234, 1024 ** 3)]
+        gpu.not_supported.add('nvmlDeviceGetAccountingStats')
+        self.nvidia._get_gpu_info()
+        expected = [{'pid': 1234, 'memory_used_bytes': 1024 ** 3}]
+        self.assertEqual(expected, nvidia.Nvidia._get_process_info(gpu))
+
+    def test_processes_not_collected_by_default(self):
+        self.nvml.gpus[0].processes = [(1234, 1024 ** 3)]
+        gpu_info = self.nvidia._get_gpu_info()
+        self.assertNotIn('processes', gpu_info[0])
+        self.assertEqual(
+            0, self.nvml.calls['nvmlDeviceGetComputeRunningProcesses'])
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    def test_check_process_metrics(self, mock_gauge):
+        gpu = self.nvml.gpus[1]
+        gpu.processes = [(1234, 1024 ** 3)]
+        self._add_process(1234, '0::/slurm/uid_1000/job_42/step_0\n')
+        self.nvidia.check({'process_metrics': True})
+        mock_gauge.assert_any_call(
+            mock.ANY, 'nvidia.process.memory_used_bytes', 1024 ** 3,
+            device_name='{}_{}'.format(gpu.name, gpu.serial),
+            dimensions={
+                'driver_version': '418.87.01',
+                'uuid': gpu.uuid,
+                'info_rom_image_version': gpu.info_rom_image_version,
+                'vbios_version': gpu.vbios_version,
+                'power_state': 'P0',
+                'slurm_job_id': '42',
+            },
+            value_meta={'pids': '1234',
+                        'cgroups': '/slurm/uid_1000/job_42/step_0'})
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    def test_check_process_metrics_grouped(self, mock_gauge):
+        gpu = self.nvml.gpus[0]
+        gpu.processes = [(5678, 2 * 1024 ** 3), (1234, 1024 ** 3),
+                         (4321, 1024 ** 2), (8765, 1024)]
+        self._add_process(1234, '0::/slurm/uid_1000/job_42/step_0\n')
+        self._add_process(5678, '0::/slurm/uid_1000/job_42/step_1\n')
+        self._add_process(4321, '0::/user.slice/user-1000.slice\n')
+        self.nvidia.check({'process_metrics': True})
+        calls = [(call[0][2], call[1]['dimensions'], call[1]['value_meta'])
+                 for call in mock_gauge.call_args_list
+                 if call[0][1] == 'nvidia.process.memory_used_bytes']
+        self.assertEqual(2, len(calls))
+        job_value, job_dims, job_meta = calls[0]
+        self.assertEqual(3 * 1024 ** 3, job_value)
+        self.assertEqual('42', job_dims['slurm_job_id'])
+        self.assertNotIn('pid', job_dims)
+        self.assertNotIn('cgroup', job_dims)
+        self.assertEqual({'pids': '1234,5678',
+                          'cgroups': '/slurm/uid_1000/job_42/step_0,'
+                                     '/slurm/uid_1000/job_42/step_1'},
+                         job_meta)
+        # Processes outside any job or container share one series
+        other_value, other_dims, other_meta = calls[1]
+        self.assertEqual(1024 ** 2 + 1024, other_value)
+        self.assertNotIn('slurm_job_id', other_dims)
+        self.assertEqual({'pids': '4321,8765',
+                          'cgroups': '/user.slice/user-1000.slice'},
+                         other_meta)
+
+    def test_join_value_meta_truncated(self):
+        pids = [str(pid) for pid in range(10000, 12000)]
+        joined = nvidia.Nvidia._join_value_meta(pids)
+        self.assertEqual(nvidia._MAX_VALUE_META_LENGTH, len(joined))
+        self.assertTrue(joined.startswith('10000,10001,'))
+        self.assertTrue(joined.endswith(',...'))
+
+
+class TestNvmlFallbackFunctions(unittest.TestCase):
+    """Functions bound from the NVML library if py3nvml is too old"""
+
+    def test_fallback_functions_available(self):
+        for name in nvidia._NVML_FALLBACK_FUNCTIONS:
+            self.assertTrue(callable(nvidia._nvml_function(name)), name)
+
+    def test_fallback_functions_missing(self):
+        nvml = fake_pynvml.FakePynvml()
+        with mock.patch.object(nvidia, 'pynvml', nvml), \
+                mock.patch.object(nvml, 'nvmlDeviceGetMigMode', None):
+            self.assertIsNone(nvidia._nvml_function('nvmlDeviceGetMigMode'))
+
+    def test_bound_function(self):
+        bound = nvidia._bind_nvml_function(
+            'nvmlDeviceGetNvLinkUtilizationCounter',
+            *nvidia._NVML_FALLBACK_FUNCTIONS[
+                'nvmlDeviceGetNvLinkUtilizationCounter'])
+        device = pynvml.c_nvmlDevice_t()
+
+        def nvml_function(handle, link, counter, rx, tx):
+            self.assertIs(device, handle)
+            self.assertEqual((2, 0), (link.value, counter.value))
+            rx._obj.value = 1000
+            tx._obj.value = 2000
+            return pynvml.NVML_SUCCESS
+
+        with mock.patch.object(pynvml, '_nvmlGetFunctionPointer',
+                               return_value=nvml_function) as mock_pointer:
+            self.assertEqual([1000, 2000], bound(device, 2, 0))
+        mock_pointer.assert_called_once_with(
+            'nvmlDeviceGetNvLinkUtilizationCounter')
+
+    def test_bound_function_device_handle(self):
+        # Handles are returned as they are, to be passed back to NVML
+        bound = nvidia._nvml_function('nvmlDeviceGetMigDeviceHandleByIndex')
+        with mock.patch.object(pynvml, '_nvmlGetFunctionPointer',
+                               return_value=lambda *args: pynvml.NVML_SUCCESS):
+            handle = bound(pynvml.c_nvmlDevice_t(), 0)
+        self.assertIsInstance(handle, pynvml.c_nvmlDevice_t)
+
+    def test_bound_function_error(self):
+        bound = nvidia._nvml_function('nvmlDeviceGetMigMode')
+        with mock.patch.object(
+                pynvml, '_nvmlGetFunctionPointer',
+                return_value=lambda *args: pynvml.NVML_ERROR_NOT_SUPPORTED):
+            self.assertRaises(pynvml.NVMLError, bound,
+                              pynvml.c_nvmlDevice_t())
+
+
+class TestNvidiaInterconnect(unittest.TestCase):
+    def setUp(self):
+        self.nvml = fake_pynvml.FakePynvml(gpu_count=2)
+        patcher = mock.patch.object(nvidia, 'pynvml', self.nvml)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.nvidia = MockNvidiaPlugin()
+
+    def test_counter_rates(self):
+        rates = nvidia._CounterRates()
+        self.assertIsNone(rates.rate('rx', 1000, 10))
+        self.assertEqual(50.0, rates.rate('rx', 1500, 20))
+        self.assertEqual(0.0, rates.rate('rx', 1500, 30))
+        # The counter was reset
+        self.assertIsNone(rates.rate('rx', 100, 40))
+        self.assertEqual(10.0, rates.rate('rx', 200, 50))
+
+    def test_nvlink_links_cached(self):
+        gpu = self.nvml.gpus[0]
+        gpu.nvlinks = [(0, 0), None, (0, 0)]
+        self.nvidia._get_gpu_info()
+        self.assertEqual([0, 2],
+                         self.nvidia._static_gpu_info[0]['nvlink_links'])
+        self.assertEqual([], self.nvidia._static_gpu_info[1]['nvlink_links'])
+        self.nvml.calls.clear()
+        self.nvidia._get_gpu_info()
+        self.assertEqual(0, self.nvml.calls['nvmlDeviceGetNvLinkState'])
+        self.assertEqual(
+            2, self.nvml.calls['nvmlDeviceGetNvLinkUtilizationCounter'])
+
+    def test_nvml_function_not_found(self):
+        # The driver is older than the bindings
+        self.nvml.gpus[0].nvlinks = [(0, 0)]
+        with mock.patch.object(
+                self.nvml, 'nvmlDeviceGetNvLinkState',
+                side_effect=pynvml.NVMLError(
+                    pynvml.NVML_ERROR_FUNCTION_NOT_FOUND)):
+            gpu_info = self.nvidia._get_gpu_info()
+        self.assertNotIn('nvlink', gpu_info[0])
+
+    def test_nvlink_bindings_missing(self):
+        self.nvml.gpus[0].nvlinks = [(0, 0)]
+        with mock.patch.object(self.nvml, 'nvmlDeviceGetNvLinkState', None):
+            gpu_info = self.nvidia._get_gpu_info()
+        self.assertNotIn('nvlink', gpu_info[0])
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    def test_check_nvlink_rates(self, mock_gauge):
+        gpu = self.nvml.gpus[0]
+        gpu.nvlinks = [(1000, 2000)]
+        with mock.patch.object(nvidia.time, 'time', return_value=100):
+            self.nvidia.check({})
+        self.assertFalse([c for c in mock_gauge.call_args_list
+                          if c[0][1].startswith('nvidia.nvlink.')])
+        gpu.nvlinks = [(3000, 2500)]
+        with mock.patch.object(nvidia.time, 'time', return_value=110):
+            self.nvidia.check({})
+        rates = {c[0][1]: (c[0][2], c[1]['dimensions']['link'])
+                 for c in mock_gauge.call_args_list
+                 if c[0][1].startswith('nvidia.nvlink.')}
+        self.assertEqual({
+            'nvidia.nvlink.rx_bytes_per_second': (200.0, '0'),
+            'nvidia.nvlink.tx_bytes_per_second': (50.0, '0'),
+        }, rates)
+
+    def test_pcie_throughput(self):
+        gpu_info = self.nvidia._get_gpu_info({'pcie_throughput': True})
+        measurements = gpu_info[0]['measurements']
+        self.assertEqual(1000 * 1024,
+                         measurements['pcie_tx_bytes_per_second'])
+        self.assertEqual(2000 * 1024,
+                         measurements['pcie_rx_bytes_per_second'])
+
+    def test_pcie_throughput_disabled(self):
+        gpu_info = self.nvidia._get_gpu_info()
+        self.assertNotIn('pcie_tx_bytes_per_second',
+                         gpu_info[0]['measurements'])
+        self.assertEqual(0, self.nvml.calls['nvmlDeviceGetPcieThroughput'])
+
+    def test_mig_info(self):
+        gpu = self.nvml.gpus[1]
+        gpu.mig_mode = 1
+        gpu.mig_devices = [fake_pynvml.FakeMigDevice(gpu, 0), None,
+                           fake_pynvml.FakeMigDevice(gpu, 2)]
+        gpu_info = self.nvidia._get_gpu_info()
+        self.assertNotIn('mig', gpu_info[0])
+        expected = [
+            {'dimensions': {'mig_uuid': gpu.mig_devices[0].uuid,
+                            'gpu_instance_id': '1',
+                            'compute_instance_id': '0'},
+             'measurements': {'memory_fb_total_bytes': 2 * 1024 ** 3,
+                              'memory_fb_used_bytes': 1024 ** 3,
+                              'memory_fb_free_bytes': 1024 ** 3}},
+            {'dimensions': {'mig_uuid': gpu.mig_devices[2].uuid,
+                            'gpu_instance_id': '3',
+                            'compute_instance_id': '0'},
+             'measurements': {'memory_fb_total_bytes': 2 * 1024 ** 3,
+                              'memory_fb_used_bytes': 1024 ** 3,
+                              'memory_fb_free_bytes': 1024 ** 3}},
+        ]
+        self.assertEqual(expected, gpu_info[1]['mig'])
+        # MIG device handles are not remembered as unsupported
+        self.assertEqual(0, len(self.nvidia._unsupported_queries.queries))
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    def test_check_mig_metrics(self, mock_gauge):
+        gpu = self.nvml.gpus[0]
+        gpu.mig_mode = 1
+        gpu.mig_devices = [fake_pynvml.FakeMigDevice(gpu, 0)]
+        gpu.mig_devices[0].not_supported.clear()
+        self.nvidia.check({})
+        mock_gauge.assert_any_call(
+            mock.ANY, 'nvidia.mig.utilisation_gpu_percent', 50,
+            device_name='{}_{}'.format(gpu.name, gpu.serial),
+            dimensions={
+                'driver_version': '418.87.01',
+                'uuid': gpu.uuid,
+                'info_rom_image_version': gpu.info_rom_image_version,
+                'vbios_version': gpu.vbios_version,
+                'power_state': 'P0',
+                'mig_uuid': gpu.mig_devices[0].uuid,
+                'gpu_instance_id': '1',
+                'compute_instance_id': '0',
+            },
+            value_meta=None)
+
+
+class TestNvidiaEvents(unittest.TestCase):
+    def setUp(self):
+        self.nvml = fake_pynvml.FakePynvml(gpu_count=2)
+        patcher = mock.patch.object(nvidia, 'pynvml', self.nvml)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.nvidia = MockNvidiaPlugin()
+
+    @staticmethod
+    def _gauges(mock_gauge, prefix):
+        return [(c[0][1], c[0][2], c[1]['dimensions']['uuid'],
+                 c[1]['value_meta'])
+                for c in mock_gauge.call_args_list
+                if c[0][1].startswith(prefix)]
+
+    def test_events_registered(self):
+        self.nvml.gpus[1].supported_event_types = (
+            self.nvml.nvmlEventTypeSingleBitEccError)
+        self.nvidia._get_gpu_info()
+        event_set = self.nvml.event_sets[0]
+        self.assertEqual({0: 11, 1: 1}, event_set.registered)
+        self.assertEqual({self.nvml.gpus[0].uuid: 11,
+                          self.nvml.gpus[1].uuid: 1},
+                         self.nvidia._event_types)
+
+    def test_event_set_freed_on_reinit(self):
+        self.nvidia._get_gpu_info()
+        self.nvml.driver_version = '440.33.01'
+        self.nvidia._get_gpu_info()
+        self.assertEqual(2, len(self.nvml.event_sets))
+        self.assertTrue(self.nvml.event_sets[0].freed)
+        self.assertFalse(self.nvml.event_sets[1].freed)
+
+    def test_event_set_not_supported(self):
+        with mock.patch.object(
+                self.nvml, 'nvmlEventSetCreate',
+                side_effect=pynvml.NVMLError(
+                    pynvml.NVML_ERROR_NOT_SUPPORTED)):
+            self.nvidia._get_gpu_info()
+        self.assertIsNone(self.nvidia._event_set)
+        self.assertEqual({}, self.nvidia._drain_events())
+
+    def test_drain_events(self):
+        self.nvidia._get_gpu_info()
+        gpu0, gpu1 = self.nvml.gpus
+        self.nvml.send_event(gpu0, self.nvml.nvmlEventTypeXidCriticalError,
+                             79)
+        self.nvml.send_event(gpu0, self.nvml.nvmlEventTypeXidCriticalError,
+                             48)
+        self.nvml.send_event(gpu1, self.nvml.nvmlEventTypeSingleBitEccError)
+        events = self.nvidia._drain_events()
+        self.assertEqual(
+            {self.nvml.nvmlEventTypeXidCriticalError: 2},
+            events[gpu0.uuid]['counts'])
+        self.assertEqual({48, 79}, events[gpu0.uuid]['xids'])
+        self.assertEqual(
+            {self.nvml.nvmlEventTypeSingleBitEccError: 1},
+            events[gpu1.uuid]['counts'])
+        # The events are only counted once
+        self.assertEqual({}, self.nvidia._drain_events())
+
+    def test_drain_events_limited(self):
+        self.nvidia._get_gpu_info()
+        gpu = self.nvml.gpus[0]
+        for _ in range(nvidia._MAX_EVENTS_PER_CHECK + 5):
+            self.nvml.send_event(gpu,
+                                 self.nvml.nvmlEventTypeSingleBitEccError)
+        events = self.nvidia._drain_events()
+        self.assertEqual(nvidia._MAX_EVENTS_PER_CHECK,
+                         sum(events[gpu.uuid]['counts'].values()))
+        events = self.nvidia._drain_events()
+        self.assertEqual(5, sum(events[gpu.uuid]['counts'].values()))
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    def test_check_event_metrics(self, mock_gauge):
+        gpu0, gpu1 = self.nvml.gpus
+        gpu1.supported_event_types = self.nvml.nvmlEventTypeXidCriticalError
+        self.nvidia.check({})
+        mock_gauge.reset_mock()
+        self.nvml.send_event(gpu0, self.nvml.nvmlEventTypeXidCriticalError,
+                             79)
+        self.nvml.send_event(gpu0, self.nvml.nvmlEventTypeDoubleBitEccError)
+        self.nvidia.check({})
+        self.assertEqual(sorted([
+            ('nvidia.xid_errors', 1, gpu0.uuid, {'xids': '79'}),
+            ('nvidia.ecc_single_bit_errors', 0, gpu0.uuid, None),
+            ('nvidia.ecc_double_bit_errors', 1, gpu0.uuid, None),
+            ('nvidia.xid_errors', 0, gpu1.uuid, None),
+        ]), sorted(self._gauges(mock_gauge, 'nvidia.xid_errors') + (
+            self._gauges(mock_gauge, 'nvidia.ecc_')), key=str))
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    def test_check_throttle_metrics(self, mock_gauge):
+        gpu0, gpu1 = self.nvml.gpus
+        gpu0.supported_throttle_reasons = (
+            self.nvml.nvmlClocksThrottleReasonSwPowerCap)
+        gpu0.throttle_reasons = self.nvml.nvmlClocksThrottleReasonSwPowerCap
+        gpu1.supported_throttle_reasons = 0
+        for _ in range(3):
+            self.nvidia.check({})
+        gpu0.throttle_reasons = self.nvml.nvmlClocksThrottleReasonNone
+        mock_gauge.reset_mock()
+        self.nvidia.check({})
+        self.assertEqual(
+            [('nvidia.clocks_throttle.sw_power_cap_count', 3, gpu0.uuid,
+              None)],
+            self._gauges(mock_gauge, 'nvidia.clocks_throttle.'))
+        # Throttle reasons are not queried from GPUs which support none
+        self.assertEqual(
+            4, self.nvml.calls['nvmlDeviceGetCurrentClocksThrottleReasons'])
+
+
+class TestNvidiaDcgmExporter(unittest.TestCase):
+    _INSTANCE = {'backend': 'dcgm_exporter',
+                 'dcgm_exporter_endpoint': 'http://gpu-0:9400/metrics'}
+
+    def setUp(self):
+        filepath = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'example_dcgm_exporter_metrics')
+        with open(filepath, 'r') as f:
+            self.example = f.read()
+        self.nvidia = MockNvidiaPlugin()
+        self.addCleanup(self.nvidia.stop)
+
+    def test_parse(self):
+        gpu_info = nvidia.Nvidia._parse_dcgm_exporter_metrics(self.example)
+        self.assertEqual(2, len(gpu_info))
+        expected = {
+            'name': 'Tesla V100-SXM2-16GB_'
+                    'GPU-00000000-0000-0000-0000-000000000001',
+            'dimensions': {
+                'uuid': 'GPU-00000000-0000-0000-0000-000000000001',
+                'driver_version': '418.87.01',
+            },
+            'measurements': {
+                'clock_freq_sm_mhz': 1530.0,
+                'temperature_deg_c': 65.0,
+                'power_watts': 250.25,
+                'utilisation_gpu_percent': 98.0,
+                'memory_fb_used_bytes': 15360.0 * 1024 ** 2,
+                'dev_xid_errors': 0.0,
+                'prof_sm_occupancy': 0.42,
+                'prof_pipe_tensor_active': 0.71,
+                'pcie_tx_bytes_per_second': 1048576.0,
+            }
+        }
+        self.assertEqual(expected, gpu_info[1])
+
+    def test_parse_mig(self):
+        text = ('DCGM_FI_DEV_FB_USED{gpu="0",UUID="GPU-0",device="nvidia0",'
+                'GPU_I_PROFILE="1g.5gb",GPU_I_ID="7"} 10\n'
+                'DCGM_FI_DEV_FB_USED{gpu="0",UUID="GPU-0",device="nvidia0",'
+                'GPU_I_PROFILE="1g.5gb",GPU_I_ID="8"} 20\n')
+        gpu_info = nvidia.Nvidia._parse_dcgm_exporter_metrics(text)
+        self.assertEqual(
+            [({'uuid': 'GPU-0', 'gpu_instance_id': '7'}, 10 * 1024 ** 2),
+             ({'uuid': 'GPU-0', 'gpu_instance_id': '8'}, 20 * 1024 ** 2)],
+            [(gpu['dimensions'], gpu['measurements']['memory_fb_used_bytes'])
+             for gpu in gpu_info])
+
+    @staticmethod
+    def _gpu_metric_calls(mock_gauge):
+        return [c for c in mock_gauge.call_args_list
+                if not c[0][1].startswith('nvidia.collector.')]
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    @mock.patch.object(nvidia.requests.Session, 'get', autospec=True)
+    def test_check(self, mock_get, mock_gauge):
+        mock_get.return_value.text = self.example
+        with mock.patch.object(nvidia, 'pynvml') as mock_pynvml:
+            self.nvidia.check(self._INSTANCE)
+            self.nvidia.check(self._INSTANCE)
+        # NVML is not used
+        self.assertEqual([], mock_pynvml.mock_calls)
+        self.assertEqual(2, mock_get.call_count)
+        mock_get.assert_called_with(mock.ANY, 'http://gpu-0:9400/metrics',
+                                    timeout=3)
+        # The connection is kept open between checks
+        self.assertEqual(mock_get.call_args_list[0][0][0],
+                         mock_get.call_args_list[1][0][0])
+        mock_gauge.assert_any_call(
+            mock.ANY, 'nvidia.prof_pipe_tensor_active', 0.71,
+            device_name='Tesla V100-SXM2-16GB_'
+                        'GPU-00000000-0000-0000-0000-000000000001',
+            dimensions={'uuid': 'GPU-00000000-0000-0000-0000-000000000001',
+                        'driver_version': '418.87.01'},
+            value_meta=None)
+        self.assertEqual(2 * 18, len(self._gpu_metric_calls(mock_gauge)))
+        self.assertEqual(
+            ['check_seconds', 'fetch_seconds', 'parse_seconds',
+             'emit_seconds'],
+            [c[0][1][len('nvidia.collector.'):]
+             for c in mock_gauge.call_args_list[-4:]])
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    @mock.patch.object(nvidia.requests.Session, 'get', autospec=True)
+    def test_check_unavailable(self, mock_get, mock_gauge):
+        mock_get.side_effect = nvidia.requests.ConnectionError()
+        self.nvidia.check(self._INSTANCE)
+        self.assertEqual([], self._gpu_metric_calls(mock_gauge))
@@ -18,6 +18,7 @@ import unittest
 import mock
 
 import stackhpc_monasca_agent_plugins.checks.prometheusv2 as prometheus
+from stackhpc_monasca_agent_plugins.common import instrumentation
 
 
 class MockPrometheusPlugin(prometheus.PrometheusV2):
@@ -26,6 +27,10 @@ class MockPrometheusPlugin(prometheus.PrometheusV2):
         pass
         self.connection_timeout = 1
         self.log = mock.Mock()
+        self._instrumentation = instrumentation.CheckInstrumentation(
+            'prometheusv2')
+        # Receives the collector metrics
+        self.gauge = mock.Mock()
 
     def _set_dimensions(self, dimensions, instance=None):
         # Cut down version of original, which doesn't get actual
@@ -894,4 +899,54 @@ class TestPrometheus(unittest.TestCase):
                                   'code': '4xx'}),
         ]
         mock_write_metric.assert_has_calls(calls, any_order=True)
+
+    @mock.patch('stackhpc_monasca_agent_plugins.checks.'
+                'prometheusv2.requests.get')
+    @mock.patch('stackhpc_monasca_agent_plugins.checks.'
+                'prometheusv2.PrometheusV2._write_metric')
+    def test_collector_metrics(self, mock_write_metric, mock_req):
+        instance = {'metric_endpoint': 'mocked_endpoint',
+                    'collector_trace_allocations': True}
+        mock_req.return_value.headers = {
+            'Content-Type': 'text/plain;charset=utf-8'}
+        mock_req.return_value.text = self.example
+        self.prometheus.check(instance)
+        self.assertEqual(
+            ['prometheusv2.collector.allocated_bytes',
+             'prometheusv2.collector.check_seconds',
+             'prometheusv2.collector.derive_seconds',
+             'prometheusv2.collector.emit_seconds',
+             'prometheusv2.collector.fetch_seconds',
+             'prometheusv2.collector.parse_seconds',
+             'prometheusv2.collector.peak_allocated_bytes'],
+            sorted(c[0][0] for c in self.prometheus.gauge.call_args_list))
+        for c in self.prometheus.gauge.call_args_list:
+            self.assertEqual({'hostname': 'squawky',
+                              'check_instance': 'mocked_endpoint'},
+                             c[1]['dimensions'])
+        self.assertEqual(8, mock_write_metric.call_count)
+
+    @mock.patch('stackhpc_monasca_agent_plugins.checks.'
+                'prometheusv2.requests.get')
+    @mock.patch('stackhpc_monasca_agent_plugins.checks.'
+                'prometheusv2.PrometheusV2._write_metric')
+    def test_collector_metrics_instances(self, mock_write_metric, mock_req):
+        mock_req.return_value.headers = {
+            'Content-Type': 'text/plain;charset=utf-8'}
+        mock_req.return_value.text = self.example
+        # For example, two exporters configured by monasca-setup
+        for name, port in (('ceph_9283', 9283), ('node_9100', 9100)):
+            self.prometheus.check({
+                'name': name,
+                'metric_endpoint': 'http://localhost:{}/metrics'.format(port)})
+        check_seconds = [
+            c[1]['dimensions'] for c in self.prometheus.gauge.call_args_list
+            if c[0][0] == 'prometheusv2.collector.check_seconds']
+        self.assertEqual([{'hostname': 'squawky',
+                           'check_instance': 'ceph_9283'},
+                          {'hostname': 'squawky',
+                           'check_instance': 'node_9100'}],
+                         check_seconds)
+
+
 # Test func (get rid of Mock.ANY)
@@ -12,12 +12,23 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+import json
 import os
+import re
+import shutil
+import socketserver
+import tempfile
+import threading
 import unittest
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
 
 import mock
 
 import stackhpc_monasca_agent_plugins.checks.slurm as slurm
+from stackhpc_monasca_agent_plugins.common import instrumentation
 
 # Example output from $ scontrol -o show node
 _EXAMPLE_SLURM_NODE_LIST_FILENAME = 'example_slurm_node_list'
@@ -25,16 +36,28 @@ _EXAMPLE_SLURM_NODE_LIST_FILENAME = 'example_slurm_node_list'
 # Example output from $ scontrol -o show job
 _EXAMPLE_SLURM_JOB_LIST_FILENAME = 'example_slurm_job_list'
 
+_EXAMPLE_INSTANCE = {'name': 'slurm_stats',
+                     'dimensions': {'instance': 'openhpc-login-0'}}
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is only available from Python 3.7
+    daemon_threads = True
+
 
 class MockSlurmPlugin(slurm.Slurm):
     def __init__(self):
         # Don't call the base class constructor
-        pass
+        self.hostname = 'openhpc-login-0'
+        self._collector_locks = {}
+        self._job_cache = {}
+        self._rest_clients = {}
+        self._instrumentation = instrumentation.CheckInstrumentation('slurm')
 
     @staticmethod
     def _set_dimensions(dimensions, instance=None):
         if instance:
-            dimensions['instance'] = instance
+            dimensions.update(instance.get('dimensions', {}))
         return dimensions
 
     @staticmethod
@@ -55,6 +78,13 @@ class MockSlurmPlugin(slurm.Slurm):
         return MockSlurmPlugin._get_raw_data(_EXAMPLE_SLURM_NODE_LIST_FILENAME)
 
 
+class AggregatedSlurmPlugin(slurm.Slurm):
+    """Posts metrics through the agent's own aggregator"""
+
+    _get_raw_job_data = staticmethod(MockSlurmPlugin._get_raw_job_data)
+    _get_raw_node_data = staticmethod(MockSlurmPlugin._get_raw_node_data)
+
+
 class TestSlurm(unittest.TestCase):
     def setUp(self):
         self.slurm = MockSlurmPlugin()
@@ -241,8 +271,113 @@ class TestSlurm(unittest.TestCase):
         }
         self.assertEqual(expected, actual)
 
+    def test__parse_jobs_pending(self):
+        pending = [job for job in self.slurm._parse_jobs()
+                   if job['job_state'] == 'PENDING']
+        expected = [
+            {'job_id': '691', 'job_name': 'test_ompi.sh',
+             'user_id': 'john', 'user_group': 'john',
+             'job_state': 'PENDING', 'node_list': '(null)',
+             'reason': 'Resources',
+             'submit_time': slurm.Slurm._parse_time('2018-01-25T12:06:06'),
+             'partition': 'compute'},
+            {'job_id': '692', 'job_name': 'test_ompi.sh',
+             'user_id': 'john', 'user_group': 'john',
+             'job_state': 'PENDING', 'node_list': '(null)',
+             'reason': 'Priority',
+             'submit_time': slurm.Slurm._parse_time('2018-01-25T12:06:19'),
+             'partition': 'compute'},
+        ]
+        self.assertEqual(expected, pending)
+
+    def test__parse_jobs_cached(self):
+        first = self.slurm._parse_jobs()
+        with mock.patch.object(slurm.Slurm, '_parse_job') as mock_parse_job:
+            second = self.slurm._parse_jobs()
+        mock_parse_job.assert_not_called()
+        self.assertEqual(first, second)
+
+    def test__parse_jobs_changed(self):
+        raw_job_data = self.slurm._get_raw_job_data()
+        self.slurm._parse_jobs()
+        # Job 691 starts and job 688 finishes
+        raw_job_data[3] = raw_job_data[3].replace(
+            'JobState=PENDING Reason=Resources',
+            'JobState=RUNNING Reason=None').replace(
+            ' NodeList=(null)', ' NodeList=openhpc-compute-[0-15]')
+        raw_job_data[0] = raw_job_data[0].replace(
+            'JobState=RUNNING', 'JobState=COMPLETED')
+        with mock.patch.object(self.slurm, '_get_raw_job_data',
+                               return_value=raw_job_data):
+            with mock.patch.object(slurm.Slurm, '_parse_job',
+                                   wraps=slurm.Slurm._parse_job) as parse:
+                job_records = self.slurm._parse_jobs()
+                self.assertEqual(2, parse.call_count)
+                # The finished job is not parsed again
+                self.slurm._parse_jobs()
+                self.assertEqual(2, parse.call_count)
+        states = {r['job_id']: r['job_state'] for r in job_records}
+        self.assertEqual({'689': 'RUNNING', '690': 'RUNNING',
+                          '691': 'RUNNING', '692': 'PENDING'}, states)
+        self.assertIsNone(self.slurm._job_cache['688'][1])
+
+    def test__parse_jobs_evicted(self):
+        self.slurm._parse_jobs()
+        raw_job_data = self.slurm._get_raw_job_data()[1:]
+        with mock.patch.object(self.slurm, '_get_raw_job_data',
+                               return_value=raw_job_data):
+            self.slurm._parse_jobs()
+        self.assertNotIn('688', self.slurm._job_cache)
+        self.assertEqual({'689', '690', '691', '692'},
+                         set(self.slurm._job_cache))
+
+    def test__get_queue_stats(self):
+        now = slurm.Slurm._parse_time('2018-01-25T13:06:06')
+        stats = self.slurm._get_queue_stats(self.slurm._parse_jobs(), now)
+        self.assertEqual(['compute'], list(stats.keys()))
+        queue = stats['compute']
+        self.assertEqual(2, queue['pending'])
+        self.assertEqual(0, queue['held'])
+        self.assertEqual(3600.0, queue['wait_time'].max)
+        self.assertAlmostEqual(3587.0, queue['wait_time'].quantile(0.5),
+                               delta=3587.0 * 0.01)
+
+    def test__get_queue_stats_held(self):
+        job_records = [
+            {'job_state': 'PENDING', 'reason': 'JobHeldUser',
+             'submit_time': 1516881600.0, 'partition': 'gpu'},
+            {'job_state': 'PENDING', 'reason': 'Priority',
+             'submit_time': 1516881600.0, 'partition': 'compute,gpu'},
+            {'job_state': 'RUNNING', 'node_list': 'openhpc-compute-0'},
+        ]
+        now = 1516881660.0
+        stats = self.slurm._get_queue_stats(job_records, now)
+        self.assertEqual(1, stats['gpu']['held'])
+        self.assertEqual(1, stats['gpu']['pending'])
+        self.assertEqual(0, stats['compute']['held'])
+        self.assertEqual(1, stats['compute']['pending'])
+        self.assertEqual(60.0, stats['compute']['wait_time'].max)
+
+    def test__quantile_sketch(self):
+        sketch = slurm._QuantileSketch(relative_accuracy=0.01)
+        for value in range(0, 100001):
+            sketch.add(float(value))
+        self.assertEqual(100001, sketch.count)
+        self.assertEqual(100000.0, sketch.max)
+        self.assertEqual(0.0, sketch.quantile(0.0))
+        self.assertAlmostEqual(50000.0, sketch.quantile(0.5),
+                               delta=50000.0 * 0.01)
+        self.assertAlmostEqual(95000.0, sketch.quantile(0.95),
+                               delta=95000.0 * 0.01)
+        self.assertLessEqual(len(sketch.buckets), 600)
+
+    def test__quantile_sketch_empty(self):
+        sketch = slurm._QuantileSketch()
+        self.assertIsNone(sketch.quantile(0.5))
+
     def test__get_nodes(self):
-        actual = self.slurm._get_nodes()
+        actual = {name: {'node_state': node['node_state']}
+                  for name, node in self.slurm._get_nodes().items()}
         expected = {
             'openhpc-compute-17': {'node_state': 'DOWN*'},
             'openhpc-compute-16': {'node_state': 'DOWN*'},
@@ -275,10 +410,244 @@ class TestSlurm(unittest.TestCase):
         }
         self.assertEqual(expected, actual)
 
+    def test__get_nodes_resources(self):
+        nodes = self.slurm._get_nodes()
+        expected = {
+            'node_state': 'IDLE',
+            'cpus_allocated': 0,
+            'cpus_total': 64,
+            'cpu_load': 0.01,
+            'memory_allocated_mb': 0,
+            'memory_total_mb': 1,
+            'gpus_allocated': 0,
+            'gpus_total': 0,
+        }
+        self.assertEqual(expected, nodes['openhpc-compute-0'])
+        self.assertIsNone(nodes['openhpc-compute-20']['cpu_load'])
+
+    def test__tokenize(self):
+        line = ('NodeName=gpu-0 CPUAlloc=8 CPUTot=32 CPULoad=7.50 '
+                'Gres=gpu:tesla:4(S:0-1) OS=Linux 3.10.0 #1 SMP '
+                'RealMemory=64000 AllocMem=32000 State=MIXED '
+                'CfgTRES=cpu=32,mem=62.50G,gres/gpu=4 '
+                'GresUsed=gpu:tesla:2(IDX:0,2),mps:0 Reason=Not responding\n')
+        expected = {
+            'NodeName': 'gpu-0',
+            'CPUAlloc': '8',
+            'CPUTot': '32',
+            'CPULoad': '7.50',
+            'Gres': 'gpu:tesla:4(S:0-1)',
+            'OS': 'Linux 3.10.0 #1 SMP',
+            'RealMemory': '64000',
+            'AllocMem': '32000',
+            'State': 'MIXED',
+            'CfgTRES': 'cpu=32,mem=62.50G,gres/gpu=4',
+            'GresUsed': 'gpu:tesla:2(IDX:0,2),mps:0',
+            'Reason': 'Not responding',
+        }
+        self.assertEqual(expected, self.slurm._tokenize(line))
+
+    def test__count_gpus(self):
+        self.assertEqual(0, slurm._count_gpus('(null)'))
+        self.assertEqual(0, slurm._count_gpus(None))
+        self.assertEqual(4, slurm._count_gpus('gpu:4'))
+        self.assertEqual(2, slurm._count_gpus('gpu:tesla:2(IDX:0,2),mps:0'))
+        self.assertEqual(6, slurm._count_gpus('gpu:a100:4,gpu:v100:2'))
+
+    def test__get_node_utilisation(self):
+        node = slurm._node_record('MIXED', cpus_allocated=8, cpus_total=32,
+                                  cpu_load=6.0, memory_allocated_mb=16000,
+                                  memory_total_mb=64000, gres='gpu:4',
+                                  gres_used='gpu:1(IDX:0)')
+        expected = {
+            'cpus_allocated': 8.0,
+            'cpus_total': 32.0,
+            'cpus_allocated_percent': 25.0,
+            'memory_allocated_mb': 16000.0,
+            'memory_total_mb': 64000.0,
+            'memory_allocated_percent': 25.0,
+            'gpus_allocated': 1.0,
+            'gpus_total': 4.0,
+            'gpus_allocated_percent': 25.0,
+            'cpu_load': 6.0,
+            'cpu_efficiency_percent': 75.0,
+        }
+        self.assertEqual(expected, self.slurm._get_node_utilisation(node))
+
+    def test__get_node_utilisation_down(self):
+        node = slurm._node_record('DOWN*', cpus_allocated=0, cpus_total=64,
+                                  memory_allocated_mb=0, memory_total_mb=1,
+                                  gres='(null)')
+        expected = {
+            'cpus_allocated': 0.0,
+            'cpus_total': 64.0,
+            'cpus_allocated_percent': 0.0,
+            'memory_allocated_mb': 0.0,
+            'memory_total_mb': 1.0,
+            'memory_allocated_percent': 0.0,
+        }
+        self.assertEqual(expected, self.slurm._get_node_utilisation(node))
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    def test_check_nodes(self, mock_gauge):
+        self.slurm.hostname = 'openhpc-compute-2.example.com'
+        self.slurm.check(_EXAMPLE_INSTANCE)
+        dimensions = {'instance': 'openhpc-login-0'}
+        calls = [
+            mock.call(mock.ANY, 'slurm.node.cpus_total', 64.0,
+                      device_name='openhpc-compute-2', dimensions=dimensions),
+            mock.call(mock.ANY, 'slurm.node.cpus_allocated_percent', 0.0,
+                      device_name='openhpc-compute-2', dimensions=dimensions),
+            mock.call(mock.ANY, 'slurm.node.cpu_load', 0.10,
+                      device_name='openhpc-compute-2', dimensions=dimensions),
+        ]
+        mock_gauge.assert_has_calls(calls, any_order=True)
+        # Without a cluster collector, only the agent's own node is reported
+        self.assertEqual(
+            {'openhpc-compute-2'},
+            {c[1]['device_name'] for c in mock_gauge.call_args_list
+             if c[0][1].startswith('slurm.node.')})
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    def test_check_nodes_not_a_node(self, mock_gauge):
+        # For example, an agent on a login node
+        self.slurm.check(_EXAMPLE_INSTANCE)
+        self.assertEqual([], [c for c in mock_gauge.call_args_list
+                              if c[0][1].startswith('slurm.node.')])
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    def test_check_queue(self, mock_gauge):
+        now = slurm.Slurm._parse_time('2018-01-25T13:06:06')
+        with mock.patch('time.time', return_value=now):
+            self.slurm.check(_EXAMPLE_INSTANCE)
+        dimensions = {'partition': 'compute', 'instance': 'openhpc-login-0'}
+        calls = [
+            mock.call(mock.ANY, 'slurm.queue.pending_jobs', 2.0,
+                      dimensions=dimensions, hostname=None),
+            mock.call(mock.ANY, 'slurm.queue.held_jobs', 0.0,
+                      dimensions=dimensions, hostname=None),
+            mock.call(mock.ANY, 'slurm.queue.wait_time_p50_seconds',
+                      mock.ANY, dimensions=dimensions, hostname=None),
+            mock.call(mock.ANY, 'slurm.queue.wait_time_p95_seconds',
+                      mock.ANY, dimensions=dimensions, hostname=None),
+            mock.call(mock.ANY, 'slurm.queue.wait_time_max_seconds',
+                      3600.0, dimensions=dimensions, hostname=None),
+        ]
+        mock_gauge.assert_has_calls(calls, any_order=True)
+
+    def test__get_cluster_collector_not_configured(self):
+        self.assertIsNone(self.slurm._get_cluster_collector({}))
+
+    def test__get_cluster_collector_flag(self):
+        self.assertTrue(self.slurm._get_cluster_collector(
+            {'cluster_collector': True}))
+        self.assertFalse(self.slurm._get_cluster_collector(
+            {'cluster_collector': False}))
+
+    def test__get_cluster_collector_lock(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+        instance = {'cluster_collector_lock':
+                    os.path.join(lock_dir, 'slurm-collector.lock')}
+        other = MockSlurmPlugin()
+        other.hostname = 'openhpc-login-1'
+        self.assertTrue(self.slurm._get_cluster_collector(instance))
+        # The lock is kept between checks
+        self.assertTrue(self.slurm._get_cluster_collector(instance))
+        self.assertFalse(other._get_cluster_collector(instance))
+        with open(instance['cluster_collector_lock']) as f:
+            self.assertEqual('openhpc-login-0\n', f.read())
+        # Another agent takes over once the collector stops
+        self.slurm.stop()
+        self.assertTrue(other._get_cluster_collector(instance))
+        self.assertFalse(self.slurm._get_cluster_collector(instance))
+        other.stop()
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    def test_check_not_cluster_collector(self, mock_gauge):
+        with mock.patch.object(self.slurm, '_get_raw_job_data') as job_data:
+            self.slurm.check({'cluster_collector': False})
+        job_data.assert_not_called()
+        mock_gauge.assert_not_called()
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    def test_check_collector_metrics(self, mock_gauge):
+        self.slurm.check(_EXAMPLE_INSTANCE)
+        collector_metrics = {
+            c[0][1]: c[1]['dimensions'] for c in mock_gauge.call_args_list
+            if c[0][1].startswith('slurm.collector.')}
+        self.assertEqual({'slurm.collector.check_seconds',
+                          'slurm.collector.subprocess_seconds',
+                          'slurm.collector.parse_seconds',
+                          'slurm.collector.emit_seconds'},
+                         set(collector_metrics))
+        for dimensions in collector_metrics.values():
+            self.assertEqual({'instance': 'openhpc-login-0',
+                              'check_instance': 'slurm_stats'}, dimensions)
+        last_run = self.slurm._instrumentation.last_run
+        # Running scontrol is not counted as parsing
+        self.assertGreaterEqual(
+            last_run['check_seconds'],
+            sum(v for k, v in last_run.items() if k != 'check_seconds'))
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    def test_check_cluster_collector(self, mock_gauge):
+        instance = {'cluster_collector': True,
+                    'dimensions': {'hostname': 'openhpc-login-0'}}
+        self.slurm.check(instance)
+        metric_name = '{}.{}'.format(slurm._METRIC_NAME_PREFIX,
+                                     slurm._METRIC_NAME)
+        calls = [
+            mock.call(mock.ANY, metric_name, 0.0,
+                      device_name='openhpc-compute-18',
+                      dimensions={'hostname': 'openhpc-compute-18'},
+                      value_meta={}),
+            mock.call(mock.ANY, metric_name, 688.0,
+                      device_name='openhpc-compute-4', dimensions={
+                          'user_id': 'john', 'job_state': 'RUNNING',
+                          'user_group': 'john',
+                          'hostname': 'openhpc-compute-4'},
+                      value_meta={'job_name': 'test_ompi.sh'}),
+            mock.call(mock.ANY, 'slurm.queue.pending_jobs', 2.0,
+                      dimensions={'partition': 'compute'},
+                      hostname='SUPPRESS'),
+        ]
+        mock_gauge.assert_has_calls(calls, any_order=True)
+
+    @mock.patch('monasca_agent.common.util.get_hostname',
+                return_value='collector-host')
+    def test_check_cluster_collector_aggregated(self, mock_get_hostname):
+        check = AggregatedSlurmPlugin('slurm', {}, {})
+        check.check({'cluster_collector': True})
+        dimensions = {}
+        for metric in check.get_metrics():
+            measurement = metric['measurement']
+            dimensions.setdefault(measurement['name'], []).append(
+                measurement['dimensions'])
+        # Queues belong to the cluster, so have no hostname
+        self.assertEqual([{'partition': 'compute'}],
+                         dimensions['slurm.queue.pending_jobs'])
+        # Nodes are reported against their own hostname
+        self.assertIn({'hostname': 'openhpc-compute-2',
+                       'device': 'openhpc-compute-2'},
+                      dimensions['slurm.node.cpus_total'])
+        self.assertNotIn(
+            'collector-host',
+            [d['hostname'] for d in dimensions['slurm.node.cpus_total']])
+        # The collector reports its own timings
+        self.assertEqual([{'hostname': 'collector-host'}],
+                         dimensions['slurm.collector.check_seconds'])
+
     @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
                 autospec=True)
     def test_check(self, mock_gauge):
-        self.slurm.check('openhpc-login-0')
+        self.slurm.check(_EXAMPLE_INSTANCE)
         metric_name = '{}.{}'.format(slurm._METRIC_NAME_PREFIX,
                                      slurm._METRIC_NAME)
         calls = [
@@ -412,3 +781,193 @@ class TestSlurm(unittest.TestCase):
                       value_meta={})
         ]
         mock_gauge.assert_has_calls(calls, any_order=True)
+
+
+def _fixture_to_dicts(filename):
+    """Split each line of scontrol output into a dict of fields"""
+    records = []
+    for line in MockSlurmPlugin._get_raw_data(filename):
+        tokens = re.split(r'(?:^|\s)([\w:/]+)=', line.strip())[1:]
+        records.append(dict(zip(tokens[::2], tokens[1::2])))
+    return records
+
+
+def _slurmrestd_number(value):
+    return {'set': True, 'infinite': False, 'number': value}
+
+
+def _slurmrestd_jobs():
+    jobs = []
+    for job in _fixture_to_dicts(_EXAMPLE_SLURM_JOB_LIST_FILENAME):
+        jobs.append({
+            'job_id': int(job['JobId']),
+            'name': job['JobName'],
+            'user_name': slurm.Slurm._extract_name(job['UserId']),
+            'group_name': slurm.Slurm._extract_name(job['GroupId']),
+            'job_state': [job['JobState']],
+            'state_reason': job['Reason'],
+            'nodes': '' if job['NodeList'] == '(null)' else job['NodeList'],
+            'partition': job['Partition'],
+            'submit_time': _slurmrestd_number(
+                int(slurm.Slurm._parse_time(job['SubmitTime']))),
+        })
+    return jobs
+
+
+def _slurmrestd_nodes():
+    nodes = []
+    for node in _fixture_to_dicts(_EXAMPLE_SLURM_NODE_LIST_FILENAME):
+        cpu_load = node['CPULoad']
+        nodes.append({
+            'name': node['NodeName'],
+            'state': node['State'].split('+'),
+            'alloc_cpus': int(node['CPUAlloc']),
+            'cpus': int(node['CPUTot']),
+            'cpu_load': _slurmrestd_number(
+                int(round(float(cpu_load) * 100))
+                if cpu_load != 'N/A' else None),
+            'alloc_memory': int(node['AllocMem']),
+            'real_memory': int(node['RealMemory']),
+            'gres': node['Gres'],
+        })
+    return nodes
+
+
+class _SlurmrestdHandler(BaseHTTPRequestHandler):
+    """Serves the example scontrol output in the form used by slurmrestd"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        self.server.requests.append(
+            (url.path, query, dict(self.headers), self.client_address))
+        if url.path == '/slurm/v0.0.39/jobs':
+            update_time = int(query.get('update_time', [0])[0])
+            changed = update_time < self.server.last_update
+            body = {'jobs': self.server.jobs if changed else [],
+                    'last_update': _slurmrestd_number(
+                        self.server.last_update),
+                    'errors': []}
+        elif url.path == '/slurm/v0.0.39/nodes':
+            body = {'nodes': self.server.nodes, 'errors': []}
+        else:
+            body = {'errors': [{'error': 'Unknown path'}]}
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSlurmRestd(unittest.TestCase):
+    def setUp(self):
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0),
+                                           _SlurmrestdHandler)
+        self.server.requests = []
+        self.server.jobs = _slurmrestd_jobs()
+        self.server.nodes = _slurmrestd_nodes()
+        self.server.last_update = 1516885000
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        self.slurm = MockSlurmPlugin()
+        self.instance = {
+            'backend': 'slurmrestd',
+            'slurmrestd_endpoint': 'http://127.0.0.1:{0}'.format(
+                self.server.server_address[1]),
+            'slurmrestd_user': 'monasca',
+            'slurmrestd_token': 'dummy-jwt',
+            'dimensions': {'instance': 'openhpc-login-0'},
+        }
+
+    def tearDown(self):
+        self.slurm.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_job_records(self):
+        client = self.slurm._get_rest_client(self.instance)
+        expected = MockSlurmPlugin()._parse_jobs()
+        self.assertEqual(expected, client.get_job_records())
+
+    def test_get_nodes(self):
+        client = self.slurm._get_rest_client(self.instance)
+        expected = MockSlurmPlugin()._get_nodes()
+        self.assertEqual(expected, client.get_nodes())
+
+    def test_get_job_records_unchanged(self):
+        client = self.slurm._get_rest_client(self.instance)
+        first = client.get_job_records()
+        second = client.get_job_records()
+        self.assertIs(first, second)
+        queries = [query for path, query, _, _ in self.server.requests]
+        self.assertEqual([{}, {'update_time': ['1516885000']}], queries)
+        # Jobs are listed again once they change
+        self.server.jobs = self.server.jobs[1:]
+        self.server.last_update += 30
+        self.assertEqual(first[1:], client.get_job_records())
+
+    def test_get_job_records_full_refresh(self):
+        client = self.slurm._get_rest_client(self.instance)
+        client.get_job_records()
+        client._jobs_full_refresh_time -= (
+            slurm._SLURMRESTD_FULL_REFRESH_SECONDS)
+        client.get_job_records()
+        queries = [query for path, query, _, _ in self.server.requests]
+        self.assertEqual([{}, {}], queries)
+
+    def test_get_error(self):
+        client = self.slurm._get_rest_client(self.instance)
+        self.assertRaisesRegex(
+            Exception, 'Failed to query slurmrestd at .*/licenses',
+            client._get, '/licenses')
+
+    def test_token_file(self):
+        token_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, token_dir)
+        token_file = os.path.join(token_dir, 'token')
+        with open(token_file, 'w') as f:
+            f.write('rotated-jwt\n')
+        del self.instance['slurmrestd_token']
+        self.instance['slurmrestd_token_file'] = token_file
+        self.slurm._get_rest_client(self.instance).get_nodes()
+        headers = self.server.requests[0][2]
+        self.assertEqual('rotated-jwt', headers['X-SLURM-USER-TOKEN'])
+
+    @mock.patch('monasca_agent.collector.checks.AgentCheck.gauge',
+                autospec=True)
+    def test_check(self, mock_gauge):
+        self.slurm.check(self.instance)
+        self.slurm.check(self.instance)
+        metric_name = '{}.{}'.format(slurm._METRIC_NAME_PREFIX,
+                                     slurm._METRIC_NAME)
+        calls = [
+            mock.call(mock.ANY, metric_name, 0.0,
+                      device_name='openhpc-compute-18',
+                      dimensions={'instance': 'openhpc-login-0'},
+                      value_meta={}),
+            mock.call(mock.ANY, metric_name, 690.0,
+                      device_name='openhpc-compute-14', dimensions={
+                          'user_id': 'john', 'job_state': 'RUNNING',
+                          'user_group': 'john', 'instance': 'openhpc-login-0'},
+                      value_meta={'job_name': 'test_ompi.sh'}),
+            mock.call(mock.ANY, 'slurm.queue.pending_jobs', 2.0,
+                      dimensions={'partition': 'compute',
+                                  'instance': 'openhpc-login-0'},
+                      hostname=None),
+        ]
+        mock_gauge.assert_has_calls(calls, any_order=True)
+        # One connection is reused for every request
+        self.assertEqual(4, len(self.server.requests))
+        self.assertEqual(1, len({request[3]
+                                 for request in self.server.requests}))
+        for _, _, headers, _ in self.server.requests:
+            self.assertEqual('monasca', headers['X-SLURM-USER-NAME'])
+            self.assertEqual('dummy-jwt', headers['X-SLURM-USER-TOKEN'])
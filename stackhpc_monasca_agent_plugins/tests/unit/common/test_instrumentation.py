@@ -0,0 +1,158 @@
+# Copyright (c) 2018 StackHPC Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from stackhpc_monasca_agent_plugins.common import instrumentation
+
+
+class TestCheckInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.instrumentation = instrumentation.CheckInstrumentation('test')
+        self.clock = [0.0]
+        patcher = mock.patch.object(instrumentation.time, 'perf_counter',
+                                    side_effect=lambda: self.clock[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _tick(self, seconds):
+        self.clock[0] += seconds
+
+    def test_stages(self):
+        with self.instrumentation.run({}):
+            with self.instrumentation.stage('fetch'):
+                self._tick(2)
+            with self.instrumentation.stage('parse'):
+                self._tick(1)
+                # Time in the nested stage is only counted against it
+                with self.instrumentation.stage('subprocess'):
+                    self._tick(4)
+            with self.instrumentation.stage('fetch'):
+                self._tick(3)
+        self.assertEqual({'check_seconds': 10,
+                          'fetch_seconds': 5,
+                          'parse_seconds': 1,
+                          'subprocess_seconds': 4},
+                         self.instrumentation.last_run)
+
+    def test_stages_reset_between_runs(self):
+        with self.instrumentation.run({}):
+            with self.instrumentation.stage('fetch'):
+                self._tick(2)
+        with self.instrumentation.run({}):
+            self._tick(1)
+        self.assertEqual({'check_seconds': 1},
+                         self.instrumentation.last_run)
+
+    def test_stage_fails(self):
+        with self.assertRaises(ValueError):
+            with self.instrumentation.run({}):
+                with self.instrumentation.stage('fetch'):
+                    self._tick(2)
+                    raise ValueError()
+        self.assertEqual({'check_seconds': 2, 'fetch_seconds': 2},
+                         self.instrumentation.last_run)
+
+    def test_timed_threads(self):
+        barrier = threading.Barrier(4)
+
+        def query(gpu):
+            barrier.wait()
+            return gpu * 2
+
+        timed = self.instrumentation.timed('gpu_queries', query)
+        results = []
+        with self.instrumentation.run({}):
+            threads = [threading.Thread(target=lambda g=g: results.append(
+                timed(g))) for g in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual([0, 2, 4, 6], sorted(results))
+        self.assertIn('gpu_queries_seconds', self.instrumentation.last_run)
+
+    def test_send_metrics(self):
+        with self.instrumentation.run({}):
+            with self.instrumentation.stage('fetch'):
+                self._tick(2)
+        check = mock.Mock()
+        self.instrumentation.send_metrics(check, {'hostname': 'dummy'})
+        check.gauge.assert_has_calls([
+            mock.call('test.collector.check_seconds', 2,
+                      dimensions={'hostname': 'dummy'}),
+            mock.call('test.collector.fetch_seconds', 2,
+                      dimensions={'hostname': 'dummy'}),
+        ], any_order=True)
+
+    def test_send_metrics_instance_name(self):
+        with self.instrumentation.run({'name': 'ceph_9283'}):
+            pass
+        check = mock.Mock()
+        dimensions = {'hostname': 'dummy'}
+        self.instrumentation.send_metrics(check, dimensions, 'ceph_9283')
+        check.gauge.assert_called_once_with(
+            'test.collector.check_seconds', 0.0,
+            dimensions={'hostname': 'dummy', 'check_instance': 'ceph_9283'})
+        # The dimensions passed in are left alone
+        self.assertEqual({'hostname': 'dummy'}, dimensions)
+
+    def test_trace_allocations(self):
+        with self.instrumentation.run({'collector_trace_allocations': True}):
+            data = [bytearray(1024) for _ in range(100)]
+        self.assertGreaterEqual(
+            self.instrumentation.last_run['peak_allocated_bytes'],
+            100 * 1024)
+        self.assertIn('allocated_bytes', self.instrumentation.last_run)
+        self.assertEqual(100, len(data))
+        self.assertFalse(instrumentation.tracemalloc.is_tracing())
+
+
+class TestCheckInstrumentationProfile(unittest.TestCase):
+    def setUp(self):
+        self.instrumentation = instrumentation.CheckInstrumentation('test')
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, 'test.prof')
+
+    def test_profile(self):
+        instance = {'name': 'test',
+                    'collector_profile_path': self.path,
+                    'collector_profile_interval': 2}
+        profiled = []
+        for _ in range(4):
+            with self.instrumentation.run(instance):
+                pass
+            profiled.append(os.path.exists(self.path))
+            if os.path.exists(self.path):
+                pstats.Stats(self.path)
+                os.remove(self.path)
+        # The first run, and every second run after it
+        self.assertEqual([True, False, True, False], profiled)
+
+    def test_profile_unwritable(self):
+        instance = {'collector_profile_path': os.path.join(
+            self.tempdir, 'missing', 'test.prof')}
+        with mock.patch.object(instrumentation.log, 'warning') as mock_warn:
+            with self.instrumentation.run(instance):
+                pass
+        self.assertEqual(1, mock_warn.call_count)
+        self.assertIn('check_seconds', self.instrumentation.last_run)
@@ -0,0 +1,45 @@
+# Copyright (c) 2018 StackHPC Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+
+from prometheus_client.parser import text_string_to_metric_families
+
+from stackhpc_monasca_agent_plugins.common import prometheus
+
+
+class TestParseMetrics(unittest.TestCase):
+    def test_parse_metrics(self):
+        text = ('# TYPE requests_total counter\n'
+                'requests_total{code="200",path=""} 10\n'
+                'requests_total{code="500",path=""} NaN\n'
+                '# TYPE temperature gauge\n'
+                'temperature{sensor="cpu"} 42.5\n')
+        metrics = prometheus.MetricStore(whitelist=[r'requests'])
+        prometheus.parse_metrics(metrics,
+                                 text_string_to_metric_families(text))
+        # NaN samples are skipped, and empty labels are dropped
+        self.assertEqual(
+            [{'name': 'requests_total', 'value': 10.0,
+              'dimensions': {'code': '200'}, 'timestamp': None,
+              'type': 'counter'}],
+            metrics.get_metrics())
+        self.assertEqual('gauge', metrics.get_type('temperature'))
+
+    def test_label_whitelist(self):
+        metrics = prometheus.MetricStore(label_whitelist=['sensor'])
+        metrics.add_sample('temperature', 'gauge', 42.5,
+                           {'sensor': 'cpu', 'host': 'node-0'})
+        self.assertEqual({'sensor': 'cpu'},
+                         metrics.get_metrics()[0]['dimensions'])
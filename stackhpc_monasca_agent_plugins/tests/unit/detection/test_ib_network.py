@@ -12,6 +12,9 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import os
+import shutil
+import tempfile
 import unittest
 
 import mock
@@ -33,6 +36,25 @@ class TestIBNetworkDetect(unittest.TestCase):
         config = self.ib_network.build_config()
         self.assertIn('ib_network', config)
 
+    def test_build_config_ports(self):
+        sysfs = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, sysfs)
+        for hca, port in (('mlx5_0', '1'), ('mlx5_1', '2'), ('mlx5_1', '1'),
+                          ('mlx5_1', '10')):
+            os.makedirs(os.path.join(sysfs, hca, 'ports', port))
+        with mock.patch.object(ib_network, '_IB_DEVICE_PATH', sysfs):
+            config = self.ib_network.build_config()
+        self.assertEqual([
+            {'name': 'ib_network_stats_mlx5_0_1', 'hca': 'mlx5_0',
+             'port': '1'},
+            {'name': 'ib_network_stats_mlx5_1_1', 'hca': 'mlx5_1',
+             'port': '1'},
+            {'name': 'ib_network_stats_mlx5_1_2', 'hca': 'mlx5_1',
+             'port': '2'},
+            {'name': 'ib_network_stats_mlx5_1_10', 'hca': 'mlx5_1',
+             'port': '10'},
+        ], config['ib_network']['instances'])
+
     @mock.patch('os.path.isdir')
     def test__detect_ok(self, mock_isdir):
         mock_isdir.return_value = True
@@ -12,8 +12,14 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import os
+import shutil
+import tempfile
 import unittest
 
+import mock
+from py3nvml import py3nvml as pynvml
+
 import stackhpc_monasca_agent_plugins.detection.nvidia as nvidia
 
 
@@ -26,7 +32,85 @@ class MockNvidiaDetectPlugin(nvidia.NvidiaDetect):
 class TestNvidiaDetect(unittest.TestCase):
     def setUp(self):
         self.nvidia = MockNvidiaDetectPlugin()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.pci_path = os.path.join(self.root, 'pci')
+        self.driver_path = os.path.join(self.root, 'gpus')
+        os.mkdir(self.pci_path)
+        for name, value in (('_PCI_DEVICES_PATH', self.pci_path),
+                            ('_NVIDIA_DRIVER_GPUS_PATH', self.driver_path)):
+            patcher = mock.patch.object(nvidia, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Don't probe the real NVML
+        patcher = mock.patch.object(
+            pynvml, 'nvmlInit',
+            side_effect=pynvml.NVMLError(pynvml.NVML_ERROR_LIBRARY_NOT_FOUND))
+        self.mock_nvml_init = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _add_pci_device(self, address, vendor, pci_class):
+        device_path = os.path.join(self.pci_path, address)
+        os.mkdir(device_path)
+        for name, value in (('vendor', vendor), ('class', pci_class)):
+            with open(os.path.join(device_path, name), 'w') as attr_file:
+                attr_file.write(value + '\n')
 
     def test_build_config(self):
+        self.nvidia.gpu_count = 0
+        config = self.nvidia.build_config()
+        self.assertEqual([{'name': 'nvidia_stats'}],
+                         config['nvidia']['instances'])
+
+    def test_build_config_gpus(self):
+        self.nvidia.gpu_count = 2
+        config = self.nvidia.build_config()
+        self.assertEqual([{'name': 'nvidia_stats',
+                           'collection_threads': 2}],
+                         config['nvidia']['instances'])
+
+    def test_build_config_many_gpus(self):
+        self.nvidia.gpu_count = 16
         config = self.nvidia.build_config()
-        self.assertIn('nvidia', config)
+        instance = config['nvidia']['instances'][0]
+        self.assertNotIn('gpus', instance)
+        self.assertEqual(nvidia._MAX_COLLECTION_THREADS,
+                         instance['collection_threads'])
+
+    def test_detect_pci(self):
+        # Two GPUs, the HDMI audio function of one, an NVSwitch and a NIC
+        self._add_pci_device('0000:3b:00.0', '0x10de', '0x030200')
+        self._add_pci_device('0000:5e:00.0', '0x10DE', '0x030000')
+        self._add_pci_device('0000:5e:00.1', '0x10de', '0x040300')
+        self._add_pci_device('0000:c0:00.0', '0x10de', '0x068000')
+        self._add_pci_device('0000:af:00.0', '0x15b3', '0x020700')
+        self.nvidia._detect()
+        self.assertTrue(self.nvidia.available)
+        self.assertEqual(2, self.nvidia.gpu_count)
+        self.mock_nvml_init.assert_not_called()
+
+    def test_detect_driver(self):
+        os.makedirs(os.path.join(self.driver_path, '0000:3b:00.0'))
+        self.nvidia._detect()
+        self.assertTrue(self.nvidia.available)
+        self.assertEqual(1, self.nvidia.gpu_count)
+
+    @mock.patch.object(pynvml, 'nvmlShutdown')
+    @mock.patch.object(pynvml, 'nvmlDeviceGetCount', return_value=4)
+    def test_detect_nvml(self, mock_count, mock_shutdown):
+        self.mock_nvml_init.side_effect = None
+        self.nvidia._detect()
+        self.assertTrue(self.nvidia.available)
+        self.assertEqual(4, self.nvidia.gpu_count)
+        mock_shutdown.assert_called_once_with()
+
+    def test_detect_no_gpus(self):
+        self._add_pci_device('0000:af:00.0', '0x15b3', '0x020700')
+        self.nvidia._detect()
+        self.assertFalse(self.nvidia.available)
+        self.assertEqual(0, self.nvidia.gpu_count)
+
+    def test_detect_no_sysfs(self):
+        shutil.rmtree(self.pci_path)
+        self.nvidia._detect()
+        self.assertFalse(self.nvidia.available)
@@ -0,0 +1,213 @@
+# Copyright (c) 2018 StackHPC Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import unittest
+
+import mock
+
+import stackhpc_monasca_agent_plugins.detection.prometheusv2 as prometheusv2
+
+_EXAMPLES_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'checks')
+
+_TCP_HEADER = ('  sl  local_address rem_address   st tx_queue rx_queue tr '
+               'tm->when retrnsmt   uid  timeout inode\n')
+_TCP_LINE = ('   {0}: {1}:{2:04X} 00000000:0000 {3} 00000000:00000000 '
+             '00:00000000 00000000     0        0 1234 1 0 100 0 0 10 0\n')
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # Serves each scrape on its own thread, like the ThreadingHTTPServer
+    # which http.server only has from Python 3.7
+    daemon_threads = True
+
+
+class MockPrometheusV2DetectPlugin(prometheusv2.PrometheusV2Detect):
+    def __init__(self, args=None):
+        # Don't call the base class constructor
+        self.args = args
+
+
+class _ExporterHandler(BaseHTTPRequestHandler):
+    """Serves an example exporter payload from /metrics"""
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(self.server.payload)))
+        self.end_headers()
+        self.wfile.write(self.server.payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPrometheusV2Detect(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.tcp_path = os.path.join(self.root, 'tcp')
+        self.tcp6_path = os.path.join(self.root, 'tcp6')
+        patcher = mock.patch.object(prometheusv2, '_PROC_NET_TCP_PATHS',
+                                    (self.tcp_path, self.tcp6_path))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.servers = []
+
+    def _start_exporter(self, example):
+        server = _ThreadingHTTPServer(('127.0.0.1', 0), _ExporterHandler)
+        server.requests = []
+        with open(os.path.join(_EXAMPLES_PATH, example), 'rb') as f:
+            server.payload = f.read()
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.servers.append(server)
+        return server, server.server_address[1]
+
+    def _write_tcp(self, path, sockets):
+        with open(path, 'w') as tcp_file:
+            tcp_file.write(_TCP_HEADER)
+            for i, (address, port, state) in enumerate(sockets):
+                tcp_file.write(_TCP_LINE.format(i, address, port, state))
+
+    def test_decode_address(self):
+        self.assertEqual('localhost',
+                         prometheusv2._decode_address('00000000'))
+        self.assertEqual('localhost',
+                         prometheusv2._decode_address('0100007F'))
+        self.assertEqual('10.0.0.1',
+                         prometheusv2._decode_address('0100000A'))
+        self.assertEqual('localhost',
+                         prometheusv2._decode_address('0' * 32))
+        self.assertEqual(
+            'localhost',
+            prometheusv2._decode_address('00000000000000000000000001000000'))
+        self.assertEqual(
+            '10.0.0.1',
+            prometheusv2._decode_address('0000000000000000FFFF00000100000A'))
+        self.assertEqual(
+            '[fd00::1]',
+            prometheusv2._decode_address('000000FD000000000000000001000000'))
+
+    def test_find_listening_ports(self):
+        self._write_tcp(self.tcp_path, [('0100000A', 9100, '0A'),
+                                        ('0100007F', 9283, '0A'),
+                                        ('0100000A', 8080, '01')])
+        self._write_tcp(self.tcp6_path, [('0' * 32, 9100, '0A')])
+        self.assertEqual({9100: 'localhost', 9283: 'localhost'},
+                         prometheusv2.PrometheusV2Detect
+                         ._find_listening_ports())
+
+    def test_find_listening_ports_missing(self):
+        self.assertEqual({}, prometheusv2.PrometheusV2Detect
+                         ._find_listening_ports())
+
+    def test_identify_exporter(self):
+        for name, example in (('ceph', 'example_prometheus_ceph_metrics'),
+                              ('haproxy',
+                               'example_prometheus_haproxy_metrics'),
+                              ('cadvisor',
+                               'example_prometheus_cadvisor_metrics')):
+            with open(os.path.join(_EXAMPLES_PATH, example)) as f:
+                self.assertEqual(
+                    name, prometheusv2.PrometheusV2Detect._identify_exporter(
+                        f.read()))
+        self.assertIsNone(prometheusv2.PrometheusV2Detect._identify_exporter(
+            '# TYPE foo gauge\nfoo 1\n'))
+
+    def test_estimate_payload(self):
+        with open(os.path.join(_EXAMPLES_PATH,
+                               'example_prometheus_ceph_metrics')) as f:
+            text = f.read()
+        self.assertEqual(
+            (5, 4), prometheusv2.PrometheusV2Detect._estimate_payload(
+                text, ['ceph_cluster_total_bytes', 'ceph_osd_op_out']))
+        self.assertEqual(
+            (5, 0), prometheusv2.PrometheusV2Detect._estimate_payload(text))
+
+    def test_detect(self):
+        _, ceph_port = self._start_exporter('example_prometheus_ceph_metrics')
+        _, haproxy_port = self._start_exporter(
+            'example_prometheus_haproxy_metrics')
+        _, other_port = self._start_exporter(
+            'example_prometheus_timestamped_metrics')
+        self._write_tcp(self.tcp_path, [('0100007F', ceph_port, '0A'),
+                                        ('00000000', haproxy_port, '0A'),
+                                        ('0100007F', other_port, '01')])
+        plugin = MockPrometheusV2DetectPlugin(
+            {'ports': '{},{},{}'.format(ceph_port, haproxy_port, other_port)})
+        plugin._detect()
+        self.assertTrue(plugin.available)
+        config = plugin.build_config()
+        instances = sorted(config['prometheusv2']['instances'],
+                           key=lambda i: i['name'])
+        profiles = prometheusv2._EXPORTER_PROFILES
+        self.assertEqual([
+            {'name': 'ceph_{}'.format(ceph_port),
+             'metric_endpoint': 'http://localhost:{}/metrics'.format(
+                 ceph_port),
+             'whitelist': profiles['ceph']['whitelist'],
+             'label_whitelist': profiles['ceph']['label_whitelist'],
+             'remove_hostname': True},
+            {'name': 'haproxy_{}'.format(haproxy_port),
+             'metric_endpoint': 'http://localhost:{}/metrics'.format(
+                 haproxy_port),
+             'whitelist': profiles['haproxy']['whitelist'],
+             'label_whitelist': profiles['haproxy']['label_whitelist']},
+        ], instances)
+        # Each exporter is only probed once, and sockets which aren't
+        # listening aren't probed at all
+        self.assertEqual([['/metrics'], ['/metrics'], []],
+                         [server.requests for server in self.servers])
+
+    def test_detect_unrecognised(self):
+        server, port = self._start_exporter(
+            'example_prometheus_timestamped_metrics')
+        server.payload = b'# TYPE foo gauge\nfoo 1\n'
+        self._write_tcp(self.tcp_path, [('0100007F', port, '0A')])
+        plugin = MockPrometheusV2DetectPlugin({'ports': str(port)})
+        plugin._detect()
+        self.assertFalse(plugin.available)
+        self.assertEqual(['/metrics'], server.requests)
+
+    def test_detect_not_exporter(self):
+        _, port = self._start_exporter('example_prometheus_ceph_metrics')
+        with mock.patch.object(_ExporterHandler, 'do_GET',
+                               lambda handler: handler.send_error(404)):
+            self._write_tcp(self.tcp_path, [('0100007F', port, '0A')])
+            plugin = MockPrometheusV2DetectPlugin({'ports': str(port)})
+            plugin._detect()
+        self.assertFalse(plugin.available)
+
+    def test_detect_nothing_listening(self):
+        plugin = MockPrometheusV2DetectPlugin()
+        with mock.patch.object(plugin, '_probe_exporter') as mock_probe:
+            plugin._detect()
+        self.assertFalse(plugin.available)
+        mock_probe.assert_not_called()
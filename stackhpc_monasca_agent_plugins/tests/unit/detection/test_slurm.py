@@ -12,6 +12,9 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import os
+import shutil
+import tempfile
 import unittest
 
 import mock
@@ -29,9 +32,45 @@ class TestSlurmDetect(unittest.TestCase):
     def setUp(self):
         self.slurm = MockSlurmDetectPlugin()
 
+    def _write_conf(self, conf):
+        conf_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, conf_dir)
+        conf_path = os.path.join(conf_dir, 'slurm.conf')
+        with open(conf_path, 'w') as conf_file:
+            conf_file.write(conf)
+        patcher = mock.patch.dict(os.environ, {'SLURM_CONF': conf_path})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch.object(slurm, '_SLURM_CONF_PATHS', ())
     def test_build_config(self):
         config = self.slurm.build_config()
-        self.assertIn('slurm', config)
+        self.assertEqual([{'name': 'slurm_stats'}],
+                         config['slurm']['instances'])
+
+    @mock.patch('socket.gethostname')
+    def test_build_config_controller(self, mock_gethostname):
+        mock_gethostname.return_value = 'openhpc-login-0.example.com'
+        self._write_conf('ClusterName=openhpc\n'
+                         '# SlurmctldHost=old-controller\n'
+                         'SlurmctldHost=openhpc-login-0(10.0.0.1)\n'
+                         'SlurmctldHost=openhpc-login-1(10.0.0.2)\n')
+        config = self.slurm.build_config()
+        self.assertEqual([{'name': 'slurm_stats', 'cluster_collector': True}],
+                         config['slurm']['instances'])
+
+    @mock.patch('socket.gethostname')
+    def test_build_config_compute(self, mock_gethostname):
+        mock_gethostname.return_value = 'openhpc-compute-0'
+        self._write_conf('ControlMachine=openhpc-login-0\n')
+        config = self.slurm.build_config()
+        self.assertEqual(
+            [{'name': 'slurm_stats', 'cluster_collector': False}],
+            config['slurm']['instances'])
+
+    def test_find_controller_missing(self):
+        self._write_conf('ClusterName=openhpc\n')
+        self.assertIsNone(self.slurm._find_controller())
 
     @mock.patch('os.path.exists')
     def test__detect_ok(self, mock_exists):